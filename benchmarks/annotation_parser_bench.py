@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Measures the throughput of annotation parsing, in MB/s.
+
+Writes a synthetic log of --size-mb megabytes, in which one line in
+--annotation-every is an annotation, and parses it:
+  * line: one MatchAnnotation call per line, as the annotator's consumers do;
+  * string: parse_annotations over the whole log in memory;
+  * mmap: parse_annotations over the log file, which it maps;
+  * chunks: parse_annotations over the log read as a pipe would deliver it.
+
+Usage: annotation_parser_bench.py [--size-mb N] [--annotation-every N]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine.third_party import annotator
+
+
+class _Ignore(object):
+  def __getattr__(self, _name):
+    return lambda *_args: None
+
+
+def make_log(size, annotation_every):
+  lines = []
+  total = 0
+  i = 0
+  while total < size:
+    if i % annotation_every == 0:
+      line = '@@@STEP_LOG_LINE@log@output line %d@@@\n' % i
+    else:
+      line = '[%6d/20000] CXX obj/base/file_%d.o -Wall -O2 -c base.cc\n' % (
+          i, i)
+    lines.append(line)
+    total += len(line)
+    i += 1
+  return ''.join(lines)
+
+
+def parse_lines(path):
+  callbacks = _Ignore()
+  with open(path) as f:
+    for line in f:
+      annotator.MatchAnnotation(line.rstrip('\n'), callbacks)
+
+
+def parse_string(path):
+  with open(path) as f:
+    data = f.read()
+  for _ in annotator.parse_annotations(data):
+    pass
+
+
+def parse_mmap(path):
+  with open(path) as f:
+    for _ in annotator.parse_annotations(f):
+      pass
+
+
+def parse_chunks(path):
+  with open(path) as f:
+    for _ in annotator.parse_annotations(iter(lambda: f.read(65536), '')):
+      pass
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--size-mb', type=int, default=64)
+  parser.add_argument('--annotation-every', type=int, default=20)
+  args = parser.parse_args()
+
+  size = args.size_mb * 1024 * 1024
+  with tempfile.NamedTemporaryFile(suffix='.log') as f:
+    f.write(make_log(size, args.annotation_every))
+    f.flush()
+    for name, fn in (('line', parse_lines), ('string', parse_string),
+                     ('mmap', parse_mmap), ('chunks', parse_chunks)):
+      start = time.time()
+      fn(f.name)
+      elapsed = time.time() - start
+      print '%-8s %8.1f MB/s' % (name, size / elapsed / (1024 * 1024))
+
+
+if __name__ == '__main__':
+  main()
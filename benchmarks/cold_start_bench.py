@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Measures the cold start of a recipe run.
+
+Each sample starts a fresh interpreter, which loads the recipe's universe, the
+recipe and its modules (recursively) and instantiates their APIs, as
+`recipes.py run` does before RunSteps is called, and reports how long that
+took and how many recipe module files were imported. With --full, each sample
+instead times a whole `recipes.py run` of the recipe.
+
+Run it against two trees to compare them.
+
+Usage: cold_start_bench.py [--package PATH] [--samples N] [--full] [RECIPE]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(BASE_DIR))
+
+
+def child(package, recipe):
+  """Loads |recipe|, and prints the time taken and modules imported."""
+  start = time.time()
+  from recipe_engine import loader
+  from recipe_engine import package as package_mod
+  from recipe_engine import recipe_test_api
+
+  class FakeEngine(object):
+    properties = {}
+
+  config = package_mod.ProtoFile(package)
+  repo_root = os.path.dirname(os.path.dirname(os.path.dirname(
+      os.path.realpath(package))))
+  deps = package_mod.PackageDeps.create(repo_root, config, allow_fetch=False)
+  universe = loader.RecipeUniverse(deps)
+  recipe_script = universe.load_recipe(recipe)
+  loader.create_recipe_api(recipe_script.LOADED_DEPS, FakeEngine(),
+                           recipe_test_api.DisabledTestData())
+  elapsed = time.time() - start
+  modules = [name for name in sys.modules
+             if name.startswith('RECIPE_MODULES.') and sys.modules[name]]
+  json.dump({'seconds': elapsed, 'modules': len(modules)}, sys.stdout)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument(
+      '--package',
+      default=os.path.join(BASE_DIR, 'infra', 'config', 'recipes.cfg'))
+  parser.add_argument('--samples', type=int, default=10)
+  parser.add_argument('--full', action='store_true')
+  parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+  parser.add_argument('recipe', nargs='?', default='step:example')
+  args = parser.parse_args()
+
+  if args.child:
+    child(args.package, args.recipe)
+    return
+
+  times = []
+  modules = None
+  for _ in xrange(args.samples):
+    if args.full:
+      start = time.time()
+      with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(
+            [sys.executable, os.path.join(BASE_DIR, 'recipes.py'),
+             '--package', args.package, '--no-fetch', 'run', args.recipe],
+            stdout=devnull, stderr=devnull)
+      times.append(time.time() - start)
+    else:
+      result = json.loads(subprocess.check_output(
+          [sys.executable, os.path.abspath(__file__), '--child',
+           '--package', args.package, args.recipe]))
+      times.append(result['seconds'])
+      modules = result['modules']
+
+  times.sort()
+  print '%s: min %.1f ms, median %.1f ms over %d samples' % (
+      'recipes.py run' if args.full else 'load',
+      times[0] * 1000, times[len(times) // 2] * 1000, len(times))
+  if modules is not None:
+    print 'recipe module files imported: %d' % modules
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Compares the CPU and wall time of the step output pumps.
+
+Runs a child which prints many lines, pipes its stdout/stderr through each
+pump in output_pump.py into /dev/null, and reports the cost in the pumping
+(parent) process.
+
+Usage: output_pump_bench.py [--lines N] [--line-length N] [--repeat N]
+"""
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import output_pump
+
+
+CHILD = (
+    'import sys\n'
+    'line = "x" * %(line_length)d + "\\n"\n'
+    'for i in xrange(%(lines)d):\n'
+    '  sys.stdout.write(line)\n'
+    '  if i %% 50 == 0:\n'
+    '    sys.stderr.write(line)\n')
+
+
+def measure(pump_fn, args, devnull):
+  proc = subprocess.Popen(
+      [sys.executable, '-c', CHILD % vars(args)],
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+  start_cpu = resource.getrusage(resource.RUSAGE_SELF)
+  start = time.time()
+  pump_fn([(proc.stdout, devnull), (proc.stderr, devnull)], False)
+  proc.wait()
+  wall = time.time() - start
+  end_cpu = resource.getrusage(resource.RUSAGE_SELF)
+  cpu = ((end_cpu.ru_utime - start_cpu.ru_utime) +
+         (end_cpu.ru_stime - start_cpu.ru_stime))
+  return wall, cpu
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--lines', type=int, default=200000)
+  parser.add_argument('--line-length', type=int, default=80)
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args()
+
+  pumps = [
+    ('threaded', output_pump.pump_threaded),
+    ('multiplexed', output_pump.pump_multiplexed),
+  ]
+  print '%d lines of %d bytes, best of %d' % (
+      args.lines, args.line_length, args.repeat)
+  print '%-12s %10s %10s' % ('pump', 'wall (s)', 'cpu (s)')
+  with open(os.devnull, 'w') as devnull:
+    for name, pump_fn in pumps:
+      results = [measure(pump_fn, args, devnull) for _ in xrange(args.repeat)]
+      wall = min(r[0] for r in results)
+      cpu = min(r[1] for r in results)
+      print '%-12s %10.3f %10.3f' % (name, wall, cpu)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Measures the memory held by the step history, and the cost of reading
+StepData.step.
+
+Builds a history of step records shaped like the ones the engine produces, in
+two ways:
+  * mutable: plain dicts, read through a deep copy per access (the way
+    StepData.step used to work);
+  * frozen: shared FrozenDicts, as RecipeEngine now stores them once a step is
+    complete, read through StepData.step (which copies each step once).
+and reports the retained size of each history, plus the time and memory spent
+reading every step's 'cmd' --reads times.
+
+Usage: step_history_bench.py [--steps N] [--reads N]
+"""
+
+import argparse
+import collections
+import copy
+import gc
+import os
+import resource
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import run
+
+from infra.libs import infra_types
+
+
+def make_step(i):
+  return collections.OrderedDict([
+    ('name', 'step %d' % i),
+    ('cmd', ['python', '-u', '/b/build/scripts/tool_%d.py' % (i % 50),
+             '--target', 'Release', '--build-dir', '/b/build/slave/out',
+             '--output-json', '/tmp/tmp%06d.json' % i] +
+            ['--flag-%d' % j for j in xrange(10)]),
+    ('cwd', '/b/build/slave/linux/build'),
+    ('env', {'PATH': '/b/depot_tools:%(PATH)s', 'GYP_DEFINES': 'x=1 y=2',
+             'BUILD_ID': str(i)}),
+    ('~followup_annotations', ['@@@STEP_LOG_LINE@json.output@{}@@@',
+                               '@@@STEP_LOG_END@json.output@@@']),
+  ])
+
+
+def deep_size(obj, seen=None):
+  """Returns the size of |obj| and everything it refers to, counting shared
+  objects once."""
+  if seen is None:
+    seen = set()
+  if id(obj) in seen:
+    return 0
+  seen.add(id(obj))
+  size = sys.getsizeof(obj)
+  if isinstance(obj, collections.Mapping):
+    for k, v in obj.iteritems():
+      size += deep_size(k, seen) + deep_size(v, seen)
+  elif isinstance(obj, (list, tuple, set, frozenset)):
+    for v in obj:
+      size += deep_size(v, seen)
+  # A dict's items are counted above; OrderedDict's __dict__ only holds its
+  # linked list of keys.
+  if hasattr(obj, '__dict__') and not isinstance(obj, dict):
+    size += deep_size(obj.__dict__, seen)
+  return size
+
+
+def build(steps, frozen):
+  history = collections.OrderedDict()
+  results = []
+  for i in xrange(steps):
+    result = run.StepData(make_step(i), 0)
+    # pylint: disable=W0212
+    record = result._freeze() if frozen else result._step
+    history[record['name']] = record
+    results.append(result)
+  return history, results
+
+
+def read_all(results, reads, frozen):
+  start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  start = time.time()
+  for _ in xrange(reads):
+    for result in results:
+      if frozen:
+        step = result.step
+      else:
+        step = copy.deepcopy(result._step)  # pylint: disable=W0212
+      step['cmd'][0]
+  elapsed = time.time() - start
+  peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+  return elapsed, peak_rss
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--steps', type=int, default=5000)
+  parser.add_argument('--reads', type=int, default=10)
+  args = parser.parse_args()
+
+  print '%-8s %14s %12s %16s' % ('records', 'history bytes', 'read time',
+                                  'read RSS growth')
+  for name, frozen in (('mutable', False), ('frozen', True)):
+    gc.collect()
+    history, results = build(args.steps, frozen)
+    size = deep_size(history)
+    elapsed, rss = read_all(results, args.reads, frozen)
+    print '%-8s %14d %11.3fs %13dKB' % (name, size, elapsed, rss)
+    del history, results
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Measures recipe runs per second with and without a zygote.
+
+Runs `recipes.py run RECIPE` --runs times one after another, first as usual,
+then with --zygote against a zygote started up front (whose start is timed
+separately), and reports the runs per second of each.
+
+Usage: zygote_bench.py [--package PATH] [--runs N] [RECIPE]
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(BASE_DIR))
+
+from recipe_engine import zygote
+
+
+def time_runs(cmd, runs):
+  """Returns the seconds |runs| runs of |cmd| take."""
+  start = time.time()
+  with open(os.devnull, 'w') as devnull:
+    for _ in xrange(runs):
+      subprocess.check_call(cmd, stdout=devnull, stderr=devnull)
+  return time.time() - start
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument(
+      '--package',
+      default=os.path.join(BASE_DIR, 'infra', 'config', 'recipes.cfg'))
+  parser.add_argument('--runs', type=int, default=20)
+  parser.add_argument('recipe', nargs='?', default='step:example')
+  args = parser.parse_args()
+
+  if not zygote.is_supported():
+    sys.exit('zygotes are not supported on this platform')
+
+  recipes_py = [sys.executable, os.path.join(BASE_DIR, 'recipes.py'),
+                '--package', os.path.abspath(args.package), '--no-fetch']
+  tmp = tempfile.mkdtemp()
+  try:
+    socket_path = os.path.join(tmp, 'zygote')
+    run = ['run', '--workdir', os.path.join(tmp, 'workdir'), args.recipe]
+
+    plain = time_runs(recipes_py + run, args.runs)
+
+    start = time.time()
+    client = zygote.ensure_zygote(
+        socket_path, os.path.realpath(args.package),
+        recipes_py + ['zygote', '--idle-timeout', '2', socket_path])
+    startup = time.time() - start
+    zygoted = time_runs(recipes_py + ['--zygote', socket_path] + run, args.runs)
+
+    print 'without zygote: %.2f runs/s' % (args.runs / plain)
+    print 'with zygote:    %.2f runs/s (zygote start: %.2f s)' % (
+        args.runs / zygoted, startup)
+
+    # Let the zygote exit before its socket's directory goes away.
+    deadline = time.time() + 10
+    while client.ping() and time.time() < deadline:
+      time.sleep(0.1)
+  finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == '__main__':
+  main()
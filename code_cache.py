@@ -0,0 +1,71 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A cache of compiled recipe scripts.
+
+Recipes are exec'd from their source rather than imported, so Python never
+writes a .pyc for them, and each load re-reads and re-compiles the script.
+A CodeCache keeps the compiled code object of each script it has compiled as
+
+  <root>/<sha1 of the script's path>.code
+
+holding the marshalled (key, code) pair, where key is the script's path,
+mtime and size, and the interpreter's bytecode magic and version. An entry
+whose key doesn't match the script (or which can't be read) is recompiled and
+rewritten. Failing to write an entry (e.g. a read-only checkout) only costs
+the compile.
+"""
+
+import hashlib
+import imp
+import marshal
+import os
+import sys
+import tempfile
+
+
+class CodeCache(object):
+  """Compiles scripts, through the cache in the directory |root|."""
+
+  def __init__(self, root):
+    self.root = root
+
+  def _entry_path(self, path):
+    return os.path.join(self.root, hashlib.sha1(path).hexdigest() + '.code')
+
+  def compile(self, path):
+    """Returns the code object of the script at |path|, from the cache if it's
+    up to date."""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    key = (path, st.st_mtime, st.st_size, imp.get_magic(), sys.version)
+    entry_path = self._entry_path(path)
+
+    try:
+      with open(entry_path, 'rb') as f:
+        cached_key, code = marshal.load(f)
+      if cached_key == key:
+        return code
+    except (IOError, EOFError, ValueError, TypeError):
+      pass
+
+    with open(path, 'rU') as f:
+      code = compile(f.read(), path, 'exec', 0, True)
+    self._store(entry_path, key, code)
+    return code
+
+  def _store(self, entry_path, key, code):
+    try:
+      if not os.path.isdir(self.root):
+        os.makedirs(self.root)
+      fd, tmp = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+      try:
+        with os.fdopen(fd, 'wb') as f:
+          marshal.dump((key, code), f)
+        os.rename(tmp, entry_path)
+      except:
+        os.unlink(tmp)
+        raise
+    except (IOError, OSError):
+      pass
@@ -82,6 +82,21 @@ def typeAssert(obj, typearg):
     raise TypeError("Expected %r to be of type %r" % (obj, typearg))
 
 
+def _type_checker(typearg):
+  """Returns a function which typeAsserts its argument against |typearg|, and
+  remembers the types which passed, so that it only checks each type once.
+  (Instances of old-style classes, which all share one type, are always
+  checked.)"""
+  accepted = set()
+  def check(obj):
+    obj_type = type(obj)
+    if obj_type not in accepted:
+      typeAssert(obj, typearg)
+      if obj_type is not types.InstanceType:
+        accepted.add(obj_type)
+  return check
+
+
 class ConfigContext(object):
   """A configuration context for a recipe module.
 
@@ -306,6 +321,15 @@ class ConfigBase(object):
     """Resets the value of this config object using data in val."""
     raise NotImplementedError
 
+  def validator(self):
+    """Returns a function which raises TypeError for a value which set_val
+    would reject, e.g. to check many values against one schema.
+
+    The default is set_val itself; types which can check a value without
+    storing it override this.
+    """
+    return self.set_val
+
   def reset(self):
     """Resets the value of this config object to it's initial state."""
     raise NotImplementedError
@@ -588,6 +612,13 @@ class List(ConfigBase, collections.MutableSequence):
       typeAssert(v, self.inner_type)
     self.data = list(val)
 
+  def validator(self):
+    check = _type_checker(self.inner_type)
+    def validate(val):
+      for v in val:
+        check(v)
+    return validate
+
   def as_jsonish(self, _include_hidden=None):
     return self.jsonish_fn(self.data)
 
@@ -644,6 +675,13 @@ class Set(ConfigBase, collections.MutableSet):
       typeAssert(v, self.inner_type)
     self.data = set(val)
 
+  def validator(self):
+    check = _type_checker(self.inner_type)
+    def validate(val):
+      for v in val:
+        check(v)
+    return validate
+
   def as_jsonish(self, _include_hidden=None):
     return self.jsonish_fn(sorted(self.data))
 
@@ -691,6 +729,16 @@ class Single(ConfigBase):
       typeAssert(val, self.inner_type)
     self.data = val
 
+  def validator(self):
+    check = _type_checker(self.inner_type)
+    empty_val = self.empty_val
+    def validate(val):
+      if isinstance(val, Single):
+        val = val.data
+      if val is not empty_val:
+        check(val)
+    return validate
+
   def as_jsonish(self, _include_hidden=None):
     return self.jsonish_fn(self.data)
 
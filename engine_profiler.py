@@ -0,0 +1,213 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Measures how much of a recipe run is spent in recipe and module python
+code, rather than waiting for steps.
+
+While an OverheadProfiler runs RunSteps, the time of the recipe's thread is
+split into time blocked on steps (see blocked()) and the recipe-side gaps
+between them. Each gap is charged to the innermost recipe module method which
+was running, as tracked by the wrappers RecipeApiMeta puts around module
+methods (see profiled()), or to the recipe itself outside of any of them.
+
+Optionally RunSteps also runs under cProfile, whose stats are written out in
+pstats format, and summarized per module.
+"""
+
+import collections
+import contextlib
+import cProfile
+import functools
+import os
+import pstats
+import threading
+import time
+
+
+_ACTIVE = None
+
+# What time outside of any module method is charged to.
+RECIPE = '<recipe>'
+
+_ENGINE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _module_of(func):
+  """Returns the recipe module name for a function defined in a module's
+  api.py (loaded as RECIPE_MODULES.<name>.api)."""
+  parts = (func.__module__ or '').split('.')
+  if len(parts) > 1 and parts[0] == 'RECIPE_MODULES':
+    return parts[1]
+  return parts[-1]
+
+
+def _module_of_file(filename):
+  """Guesses the recipe module which the source file |filename| belongs to,
+  for grouping cProfile stats."""
+  parts = filename.replace(os.sep, '/').split('/')
+  if 'recipe_modules' in parts:
+    index = parts.index('recipe_modules')
+    if index + 1 < len(parts):
+      return parts[index + 1]
+  if 'recipes' in parts:
+    return RECIPE
+  if os.path.abspath(filename).startswith(_ENGINE_DIR + os.sep):
+    return '<engine>'
+  return '<other>'
+
+
+class OverheadProfiler(object):
+  def __init__(self, use_cprofile=False, clock=time.time):
+    self._clock = clock
+    self._use_cprofile = use_cprofile
+    self._stats = None
+
+    self._thread = None
+    self._last = None
+    self._stack = []
+    self._blocked = 0
+
+    self._self_time = collections.defaultdict(float)
+    self._calls = collections.defaultdict(int)
+    self._step_time = 0.0
+    self._total_time = 0.0
+
+  def _charge(self):
+    now = self._clock()
+    elapsed = now - self._last
+    self._last = now
+    if self._blocked:
+      self._step_time += elapsed
+    else:
+      self._self_time[self._stack[-1] if self._stack else RECIPE] += elapsed
+
+  def enter(self, label):
+    """Starts charging time to |label|. Returns False (and does nothing) when
+    not called from the recipe's thread."""
+    if threading.current_thread().ident != self._thread:
+      return False
+    self._charge()
+    self._stack.append(label)
+    self._calls[label] += 1
+    return True
+
+  def exit(self):
+    self._charge()
+    self._stack.pop()
+
+  @contextlib.contextmanager
+  def blocked(self):
+    if threading.current_thread().ident != self._thread:
+      yield
+      return
+    self._charge()
+    self._blocked += 1
+    try:
+      yield
+    finally:
+      self._charge()
+      self._blocked -= 1
+
+  def run(self, fn):
+    """Calls |fn| (i.e. RunSteps) while profiling, and returns its result."""
+    global _ACTIVE
+    assert _ACTIVE is None, 'Only one OverheadProfiler may run at a time'
+    self._thread = threading.current_thread().ident
+    profile = cProfile.Profile() if self._use_cprofile else None
+    start = self._last = self._clock()
+    _ACTIVE = self
+    try:
+      if profile:
+        return profile.runcall(fn)
+      return fn()
+    finally:
+      _ACTIVE = None
+      self._charge()
+      self._total_time += self._last - start
+      if profile:
+        self._stats = pstats.Stats(profile)
+
+  def write_pstats(self, path):
+    """Writes the cProfile stats of the run to |path|, if there are any."""
+    if self._stats is not None:
+      self._stats.dump_stats(path)
+
+  def summary(self):
+    """Returns the recipe-side time and call count of every module method, as
+    a list of (label, calls, seconds), most expensive first."""
+    return sorted(
+        ((label, self._calls[label], seconds)
+         for label, seconds in self._self_time.iteritems()),
+        key=lambda row: -row[2])
+
+  def format_summary(self):
+    """Returns a text report of where the recipe-side time went, per module
+    and per method."""
+    recipe_time = sum(self._self_time.itervalues())
+    lines = [
+      'RunSteps wall time:   %9.3fs' % self._total_time,
+      'Blocked on steps:     %9.3fs' % self._step_time,
+      'Recipe-side overhead: %9.3fs' % recipe_time,
+      '',
+    ]
+
+    def table(title, rows):
+      lines.append('%-40s %8s %10s %7s' % (title, 'calls', 'seconds', '%'))
+      for label, calls, seconds in rows:
+        lines.append('%-40s %8s %10.3f %6.1f%%' % (
+            label, calls, seconds,
+            100.0 * seconds / self._total_time if self._total_time else 0))
+      lines.append('')
+
+    per_module = collections.OrderedDict()
+    for label, calls, seconds in self.summary():
+      module = label.split('.', 1)[0]
+      prev_calls, prev_seconds = per_module.get(module, (0, 0.0))
+      per_module[module] = (prev_calls + calls, prev_seconds + seconds)
+    table('module', sorted(
+        ((m, c, s) for m, (c, s) in per_module.iteritems()),
+        key=lambda row: -row[2]))
+    table('method', self.summary())
+
+    if self._stats:
+      per_file_module = collections.defaultdict(float)
+      for (filename, _, _), stat in self._stats.stats.iteritems():
+        per_file_module[_module_of_file(filename)] += stat[2]  # tottime
+      table('cProfile self time by module', sorted(
+          ((m, '', s) for m, s in per_file_module.iteritems()),
+          key=lambda row: -row[2]))
+    return '\n'.join(lines)
+
+
+def profiled(func):
+  """Wraps a recipe module method so that the active OverheadProfiler charges
+  the time spent in it to '<module>.<method>'.
+
+  Generator functions (including contextmanagers) are only charged for the
+  call which creates them.
+  """
+  label = '%s.%s' % (_module_of(func), func.__name__)
+
+  @functools.wraps(func)
+  def _inner(*a, **kw):
+    profiler = _ACTIVE
+    if profiler is None or not profiler.enter(label):
+      return func(*a, **kw)
+    try:
+      return func(*a, **kw)
+    finally:
+      profiler.exit()
+  return _inner
+
+
+@contextlib.contextmanager
+def blocked():
+  """Marks the body of the with statement as time the recipe spends waiting
+  for steps, rather than running its own code."""
+  profiler = _ACTIVE
+  if profiler is None:
+    yield
+    return
+  with profiler.blocked():
+    yield
@@ -7,12 +7,14 @@ import imp
 import inspect
 import os
 import sys
+import types
 
+from .code_cache import CodeCache
 from .config import ConfigContext
 from .config_types import Path, ModuleBasePath, RECIPE_MODULE_PREFIX
 from .recipe_api import RecipeApi, RecipeApiPlain, Property, UndefinedPropertyException
+from .recipe_index import RecipeIndex
 from .recipe_test_api import RecipeTestApi, DisabledTestData
-from .util import scan_directory
 
 
 class NoSuchRecipe(Exception):
@@ -38,8 +40,9 @@ class RecipeScript(object):
     script_vars = {}
     script_vars['__file__'] = script_path
 
+    code = universe.code_cache.compile(script_path)
     with _preserve_path():
-      execfile(script_path, script_vars)
+      exec code in script_vars
 
     script_vars['LOADED_DEPS'] = universe.deps_from_spec(
         script_vars.get('DEPS', []))
@@ -89,12 +92,10 @@ class PathDependency(Dependency):
 
 class NamedDependency(PathDependency):
   def __init__(self, name, universe):
-    for path in universe.module_dirs:
-      mod_path = os.path.join(path, name)
-      if _is_recipe_module_dir(mod_path):
-        super(NamedDependency, self).__init__(mod_path, name, universe=universe)
-        return
-    raise NoSuchRecipe('Recipe module named %s does not exist' % name)
+    mod_path = universe.index.module_path(name)
+    if mod_path is None:
+      raise NoSuchRecipe('Recipe module named %s does not exist' % name)
+    super(NamedDependency, self).__init__(mod_path, name, universe=universe)
 
 
 class PackageDependency(PathDependency):
@@ -110,7 +111,14 @@ class PackageDependency(PathDependency):
 class RecipeUniverse(object):
   def __init__(self, package_deps):
     self._loaded = {}
+    self._recipes = {}
+    self._api_plans = {}
     self._package_deps = package_deps
+    self.code_cache = CodeCache(
+        os.path.join(package_deps.package_dir, 'code_cache'))
+    self.index = RecipeIndex(
+        os.path.join(package_deps.package_dir, 'recipe_index'),
+        self.recipe_dirs, self.module_dirs)
 
   @property
   def module_dirs(self):
@@ -134,10 +142,42 @@ class RecipeUniverse(object):
       return mod
     else:
       self._loaded[name] = None
-      mod = dep.load(self)
+      try:
+        mod = dep.load(self)
+      except:
+        del self._loaded[name]
+        raise
       self._loaded[name] = mod
       return mod
 
+  def api_plan(self, toplevel_deps):
+    """Returns the ApiPlan for |toplevel_deps|, e.g. a recipe's LOADED_DEPS.
+    It is built the first time, and kept (with |toplevel_deps|) after that.
+    """
+    key = id(toplevel_deps)
+    cached = self._api_plans.get(key)
+    if cached is None or cached[0] is not toplevel_deps:
+      cached = (toplevel_deps, ApiPlan(toplevel_deps))
+      self._api_plans[key] = cached
+    return cached[1]
+
+  def preload_modules(self):
+    """Loads every recipe module (the first of each name, as NamedDependency
+    finds them), including its test API. Returns a list of (path, exception)
+    for the modules which failed to load."""
+    failures = []
+    names = set()
+    for path in self.loop_over_recipe_modules():
+      name = os.path.basename(path)
+      if name in names:
+        continue
+      names.add(name)
+      try:
+        self.load(PathDependency(path, name, universe=self)).TEST_API
+      except Exception as e:  # pylint: disable=W0703
+        failures.append((path, e))
+    return failures
+
   def _dep_from_name(self, name):
     if '/' in name:
       [package,module] = name.split('/')
@@ -167,6 +207,9 @@ class RecipeUniverse(object):
   def load_recipe(self, recipe):
     """Given name of a recipe, loads and returns it as RecipeScript instance.
 
+    Each recipe is only loaded once per universe; later calls return the same
+    RecipeScript.
+
     Args:
       recipe (str): name of a recipe, can be in form '<module>:<recipe>'.
 
@@ -176,54 +219,40 @@ class RecipeUniverse(object):
     Raises:
       NoSuchRecipe: recipe is not found.
     """
+    if recipe not in self._recipes:
+      self._recipes[recipe] = self._load_recipe(recipe)
+    return self._recipes[recipe]
+
+  def _load_recipe(self, recipe):
     # If the recipe is specified as "module:recipe", then it is an recipe
     # contained in a recipe_module as an example. Look for it in the modules
     # imported by load_recipe_modules instead of the normal search paths.
     if ':' in recipe:
       module_name, example = recipe.split(':')
       assert example.endswith('example')
-      for module_dir in self.module_dirs:
-        if os.path.isdir(module_dir):
-          for subitem in os.listdir(module_dir):
-            if module_name == subitem:
-              return RecipeScript.from_script_path(
-                  os.path.join(module_dir, subitem, 'example.py'), self)
-      raise NoSuchRecipe(recipe,
-                         'Recipe example %s:%s does not exist' %
-                         (module_name, example))
+      example_path = self.index.example_path(module_name)
+      if example_path is None:
+        raise NoSuchRecipe(recipe,
+                           'Recipe example %s:%s does not exist' %
+                           (module_name, example))
+      return RecipeScript.from_script_path(example_path, self)
     else:
-      for recipe_path in (os.path.join(p, recipe) for p in self.recipe_dirs):
-        if os.path.exists(recipe_path + '.py'):
-          return RecipeScript.from_script_path(recipe_path + '.py', self)
-    raise NoSuchRecipe(recipe)
+      recipe_path = self.index.recipe_path(recipe)
+      if recipe_path is None:
+        raise NoSuchRecipe(recipe)
+      return RecipeScript.from_script_path(recipe_path, self)
 
   def loop_over_recipe_modules(self):
-    for path in self.module_dirs:
-      if os.path.isdir(path):
-        for item in os.listdir(path):
-          subpath = os.path.join(path, item)
-          if _is_recipe_module_dir(subpath):
-            yield subpath
+    for path in self.index.modules():
+      yield path
 
   def loop_over_recipes(self):
     """Yields pairs (path to recipe, recipe name).
 
     Enumerates real recipes in recipes/* as well as examples in recipe_modules/*.
     """
-    for path in self.recipe_dirs:
-      for recipe in scan_directory(
-          path, lambda f: f.endswith('.py') and f[0] != '_'):
-        yield recipe, recipe[len(path)+1:-len('.py')]
-    for path in self.module_dirs:
-      for recipe in scan_directory(
-          path, lambda f: f.endswith('example.py')):
-        module_name = os.path.dirname(recipe)[len(path)+1:]
-        yield recipe, '%s:example' % module_name
-
-
-def _is_recipe_module_dir(path):
-  return (os.path.isdir(path) and
-          os.path.isfile(os.path.join(path, '__init__.py')))
+    for recipe_path, recipe_name in self.index.recipes():
+      yield recipe_path, recipe_name
 
 
 @contextlib.contextmanager
@@ -252,10 +281,77 @@ def _find_and_load_module(fullname, modname, path):
     imp.release_lock()
 
 
+def _find_and_load_package(fullname, path, code_cache=None):
+  """Like _find_and_load_module, for the package at |path|, which is loaded
+  as a _LazyPackage. Its __init__.py is compiled through |code_cache|, if
+  given."""
+  # Module names from recipe DEPS (e.g. parsed from JSON) may be unicode,
+  # which module objects don't accept as names.
+  fullname = str(fullname)
+  imp.acquire_lock()
+  try:
+    if fullname not in sys.modules:
+      init = os.path.join(path, '__init__.py')
+      if code_cache is not None:
+        code = code_cache.compile(init)
+      else:
+        with open(init) as f:
+          code = compile(f.read(), init, 'exec')
+      mod = _LazyPackage(fullname)
+      mod.__file__ = init
+      mod.__path__ = [path]
+      mod.__package__ = fullname
+      sys.modules[fullname] = mod
+      try:
+        exec code in mod.__dict__
+      except:
+        del sys.modules[fullname]
+        raise
+    return sys.modules[fullname]
+  finally:
+    imp.release_lock()
+
+
+class _LazyPackage(types.ModuleType):
+  """A package whose submodules and subpackages are imported on first
+  attribute access (or by an import statement, as usual), rather than all up
+  front.
+
+  Recipe modules are _LazyPackages, so e.g. test_api.py is only imported if
+  the module's TEST_API is used, i.e. in simulation tests, and example.py only
+  if it's run as a recipe.
+  """
+
+  def __getattr__(self, name):
+    if name == 'TEST_API':
+      value = _find_test_api(self)
+    else:
+      subpath = _submodule_path(self, name)
+      if subpath is None:
+        raise AttributeError(
+            'module %r has no attribute %r' % (self.__name__, name))
+      value = _recursive_import(subpath, self.__name__)
+    setattr(self, name, value)
+    return value
+
+
+def _submodule_path(package, name):
+  """Returns the path of the submodule or subpackage |name| of |package|, or
+  None if there is none."""
+  if name.startswith('_'):
+    return None
+  base = os.path.join(package.__path__[0], name)
+  if os.path.isfile(os.path.join(base, '__init__.py')):
+    return base
+  if os.path.isfile(base + '.py'):
+    return base + '.py'
+  return None
+
+
 def _load_recipe_module_module(path, universe):
   modname = os.path.splitext(os.path.basename(path))[0]
   fullname = '%s.%s' % (RECIPE_MODULE_PREFIX, modname)
-  mod = _find_and_load_module(fullname, modname, path)
+  mod = _find_and_load_package(fullname, path, universe.code_cache)
 
   # This actually loads the dependencies.
   mod.LOADED_DEPS = universe.deps_from_spec(getattr(mod, 'DEPS', []))
@@ -264,38 +360,21 @@ def _load_recipe_module_module(path, universe):
   with _preserve_path():
     # TODO(luqui): Remove this hack once configs are cleaned.
     sys.modules['%s.DEPS' % fullname] = mod.LOADED_DEPS
-    _recursive_import(path, RECIPE_MODULE_PREFIX)
     _patchup_module(modname, mod)
 
   return mod
 
 
 def _recursive_import(path, prefix):
+  """Imports the module or package at |path| as a submodule of |prefix|.
+  Packages' own submodules are imported lazily; see _LazyPackage."""
   modname = os.path.splitext(os.path.basename(path))[0]
   fullname = '%s.%s' % (prefix, modname)
-  mod = _find_and_load_module(fullname, modname, path)
-  if not os.path.isdir(path):
-    return mod
-
-  for subitem in os.listdir(path):
-    subpath = os.path.join(path, subitem)
-    subname = os.path.splitext(subitem)[0]
-    if os.path.isdir(subpath):
-      if not os.path.exists(os.path.join(subpath, '__init__.py')):
-        continue
-    elif not subpath.endswith('.py') or subitem.startswith('__init__.py'):
-      continue
-
-    submod = _recursive_import(subpath, fullname)
-
-    if not hasattr(mod, subname):
-      setattr(mod, subname, submod)
-    else:
-      prev = getattr(mod, subname)
-      assert submod is prev, (
-        'Conflicting modules: %s and %s' % (prev, mod))
-
-  return mod
+  # Prevent any modules that mess with sys.path from leaking.
+  with _preserve_path():
+    if os.path.isdir(path):
+      return _find_and_load_package(fullname, path)
+    return _find_and_load_module(fullname, modname, path)
 
 
 def _patchup_module(name, submod):
@@ -329,24 +408,30 @@ def _patchup_module(name, submod):
       submod.API = v
   assert submod.API, 'Submodule has no api? %s' % (submod)
 
-  submod.TEST_API = getattr(submod, 'TEST_API', None)
-  if hasattr(submod, 'test_api'):
-    for v in submod.test_api.__dict__.itervalues():
-      if inspect.isclass(v) and issubclass(v, RecipeTestApi):
-        assert not submod.TEST_API, (
-          'More than one TestApi subclass: %s' % submod.api)
-        submod.TEST_API = v
-    assert submod.API, (
-      'Submodule has test_api.py but no TestApi subclass? %s'
-      % (submod)
-    )
-
   submod.PROPERTIES = getattr(submod, 'PROPERTIES', {})
   # Let each property object know about the property name.
   for name, value in submod.PROPERTIES.items():
     value.name = name
 
 
+def _find_test_api(submod):
+  """Returns the RecipeTestApi subclass in |submod|'s test_api.py, or None if
+  it has none."""
+  if _submodule_path(submod, 'test_api') is None:
+    return None
+  test_api = None
+  for v in submod.test_api.__dict__.itervalues():
+    if inspect.isclass(v) and issubclass(v, RecipeTestApi):
+      assert not test_api, (
+        'More than one TestApi subclass: %s' % submod.api)
+      test_api = v
+  assert submod.API, (
+    'Submodule has test_api.py but no TestApi subclass? %s'
+    % (submod)
+  )
+  return test_api
+
+
 class DependencyMapper(object):
   """DependencyMapper topologically traverses the dependency DAG beginning at
   a module, executing a callback ("instantiator") for each module.
@@ -383,6 +468,47 @@ class DependencyMapper(object):
     self._instances[mod] = self._instantiator(mod, deps_dict)
     return self._instances[mod]
 
+# Maps (callable, additional argument names) to (prop_defs, _call_plan()),
+# for invoke_with_properties.
+_CALL_PLANS = {}
+
+
+def _call_plan(callable_obj, prop_defs, additional_names):
+  """Returns how to call |callable_obj| (a function, or a class to
+  instantiate), as invoke_with_properties does: a list of (name, prop_def)
+  for each of its arguments, where prop_def is None for one of
+  |additional_names|, and the list of |additional_names| which aren't
+  arguments, which are passed as keyword arguments.
+
+  Raises UndefinedPropertyException for an argument which is neither an
+  additional name nor in |prop_defs|.
+  """
+  # To detect when they didn't specify a property that they have as a
+  # function argument, list the arguments, through inspection,
+  # and then comparing this list to the provided properties.
+  if inspect.isclass(callable_obj):
+    arg_names = inspect.getargspec(callable_obj.__init__).args
+
+    arg_names.pop(0)
+  else:
+    arg_names = inspect.getargspec(callable_obj).args
+
+  args = []
+  for arg in arg_names:
+    if arg in additional_names:
+      args.append((arg, None))
+      continue
+
+    if arg not in prop_defs:
+      raise UndefinedPropertyException(
+        "Missing property definition for '{}'.".format(arg))
+
+    args.append((arg, prop_defs[arg]))
+
+  kwarg_names = [name for name in additional_names if name not in arg_names]
+  return args, kwarg_names
+
+
 def invoke_with_properties(callable_obj, all_props, prop_defs,
                            **additional_args):
   """
@@ -403,57 +529,108 @@ def invoke_with_properties(callable_obj, all_props, prop_defs,
     The result of calling callable with the filtered properties
     and additional arguments.
   """
-  # To detect when they didn't specify a property that they have as a
-  # function argument, list the arguments, through inspection,
-  # and then comparing this list to the provided properties. We use a list
-  # instead of a dict because getargspec returns a list which we would have to
-  # convert to a dictionary, and the benefit of the dictionary is pretty small.
+  # Which argument is which only depends on the callable, the names of the
+  # additional arguments and the property definitions, which are the same
+  # for every call from a given recipe or module.
+  key = (callable_obj, tuple(sorted(additional_args)))
+  cached = _CALL_PLANS.get(key)
+  if cached is None or cached[0] is not prop_defs:
+    cached = (prop_defs, _call_plan(callable_obj, prop_defs, additional_args))
+    _CALL_PLANS[key] = cached
+  args, kwarg_names = cached[1]
   props = []
-  if inspect.isclass(callable_obj):
-    arg_names = inspect.getargspec(callable_obj.__init__).args
-
-    arg_names.pop(0)
-  else:
-    arg_names = inspect.getargspec(callable_obj).args
-
-  for arg in arg_names:
-    if arg in additional_args:
-      props.append(additional_args.pop(arg))
-      continue
-
-    if arg not in prop_defs:
-      raise UndefinedPropertyException(
-        "Missing property definition for '{}'.".format(arg))
+  for name, prop_def in args:
+    if prop_def is None:
+      props.append(additional_args[name])
+    else:
+      props.append(prop_def.interpret(all_props.get(name, Property.sentinel)))
+  kwargs = dict((name, additional_args[name]) for name in kwarg_names)
+  return callable_obj(*props, **kwargs)
 
-    props.append(prop_defs[arg].interpret(all_props.get(
-      arg, Property.sentinel)))
 
-  return callable_obj(*props, **additional_args)
+class ApiPlan(object):
+  """A plan to instantiate the APIs of a recipe's dependencies, as
+  create_recipe_api does.
 
-def create_recipe_api(toplevel_deps, engine, test_data=DisabledTestData()):
-  def instantiator(mod, deps):
-    kwargs = {
-      'module': mod,
-      'engine': engine,
-      # TODO(luqui): test_data will need to use canonical unique names.
-      'test_data': test_data.get_module_test_data(mod.NAME)
-    }
-    prop_defs = mod.PROPERTIES
-    mod_api = invoke_with_properties(
-      mod.API, engine.properties, prop_defs, **kwargs)
-    mod_api.test_api = (getattr(mod, 'TEST_API', None)
-                        or RecipeTestApi)(module=mod)
-    for k, v in deps.iteritems():
-      setattr(mod_api.m, k, v)
-      setattr(mod_api.test_api.m, k, v.test_api)
-    return mod_api
+  It holds each module in dependency order, its API class, how to call the
+  class (which arguments are properties, and their definitions), and which of
+  the instances before it to inject into it. Instantiating is then a loop
+  over the plan, with no introspection. Build one with
+  RecipeUniverse.api_plan, which keeps it for later runs of the recipe.
+  """
 
-  mapper = DependencyMapper(instantiator)
-  api = RecipeApi(module=None, engine=engine,
-                  test_data=test_data.get_module_test_data(None))
-  for k, v in toplevel_deps.iteritems():
-    setattr(api, k, mapper.instantiate(v))
-  return api
+  # The arguments create_recipe_api passes to every module's API class.
+  _ADDITIONAL_NAMES = ('module', 'engine', 'test_data')
+
+  def __init__(self, toplevel_deps):
+    # (module, API class, [(name, prop_def)], keyword argument names,
+    #  [(dependency name, index of its entry)]), in dependency order.
+    self._entries = []
+    indices = {}
+
+    def visit(mod):
+      # Visits the modules in the order DependencyMapper would.
+      if mod not in indices:
+        deps = [(name, visit(dep))
+                for name, dep in mod.LOADED_DEPS.iteritems()]
+        args, kwarg_names = _call_plan(
+            mod.API, mod.PROPERTIES, self._ADDITIONAL_NAMES)
+        indices[mod] = len(self._entries)
+        self._entries.append((mod, mod.API, args, kwarg_names, deps))
+      return indices[mod]
+
+    self._toplevel = [(name, visit(mod))
+                      for name, mod in toplevel_deps.iteritems()]
+
+  def instantiate(self, engine, test_data):
+    """Returns the root RecipeApi for a run by |engine| with |test_data|."""
+    properties = engine.properties
+    sentinel = Property.sentinel
+    instances = []
+    for mod, api_class, args, kwarg_names, deps in self._entries:
+      additional = {
+        'module': mod,
+        'engine': engine,
+        # TODO(luqui): test_data will need to use canonical unique names.
+        'test_data': test_data.get_module_test_data(mod.NAME),
+      }
+      props = [additional[name] if prop_def is None else
+               prop_def.interpret(properties.get(name, sentinel))
+               for name, prop_def in args]
+      mod_api = api_class(
+          *props, **dict((name, additional[name]) for name in kwarg_names))
+      # Outside of simulation, step test data is never generated, so the
+      # module's test_api.py needn't be imported.
+      test_api = RecipeTestApi
+      if test_data.enabled:
+        test_api = getattr(mod, 'TEST_API', None) or RecipeTestApi
+      mod_api.test_api = test_api(module=mod)
+      for name, index in deps:
+        dep_api = instances[index]
+        setattr(mod_api.m, name, dep_api)
+        setattr(mod_api.test_api.m, name, dep_api.test_api)
+      instances.append(mod_api)
+
+    api = RecipeApi(module=None, engine=engine,
+                    test_data=test_data.get_module_test_data(None))
+    for name, index in self._toplevel:
+      setattr(api, name, instances[index])
+    return api
+
+
+def create_recipe_api(toplevel_deps, engine, test_data=DisabledTestData(),
+                      universe=None):
+  """Instantiates the APIs of |toplevel_deps| (and of their dependencies),
+  and returns the root RecipeApi with them injected.
+
+  Given the |universe| the dependencies were loaded in, its cached ApiPlan
+  for them is used.
+  """
+  if universe is not None:
+    plan = universe.api_plan(toplevel_deps)
+  else:
+    plan = ApiPlan(toplevel_deps)
+  return plan.instantiate(engine, test_data)
 
 
 def create_test_api(toplevel_deps, universe):
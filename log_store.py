@@ -0,0 +1,189 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Storage for the logs of finalized steps.
+
+Once a step is finalized its logs can no longer change, but recipes may still
+read them for as long as they hold on to the step's result. Rather than keeping
+big logs in memory for the rest of the build, logs with more than
+SPILL_THRESHOLD bytes of text are moved to a single temporary file shared by
+the whole process, and replaced by LogLines views which read them back on
+demand. Lines are spilled as they are written to the annotator, in batches of
+about BATCH_SIZE bytes, so spooling a log never holds a second copy of it in
+memory.
+"""
+
+import array
+import collections
+import struct
+import tempfile
+import threading
+
+
+# Logs holding more than this many bytes of text are spilled to disk.
+SPILL_THRESHOLD = 256 * 1024
+
+# Spilled lines are appended to the spill file in batches of about this many
+# bytes.
+BATCH_SIZE = 64 * 1024
+
+_HEADER = struct.Struct('<BI')
+_STR, _UNICODE = 0, 1
+
+
+class _SpillFile(object):
+  """An append-only temporary file of spilled log lines."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._file = None
+    self._size = 0
+
+  def append(self, data):
+    """Appends |data|, and returns its offset."""
+    with self._lock:
+      if self._file is None:
+        self._file = tempfile.TemporaryFile(prefix='recipe_logs')
+      offset = self._size
+      self._file.seek(offset)
+      self._file.write(data)
+      self._size += len(data)
+      return offset
+
+  def read(self, offset, length):
+    with self._lock:
+      self._file.flush()
+      self._file.seek(offset)
+      return self._file.read(length)
+
+  def read_line(self, offset):
+    """Returns the encoded line at |offset|, without its header, and its
+    kind."""
+    with self._lock:
+      self._file.flush()
+      self._file.seek(offset)
+      kind, length = _HEADER.unpack(self._file.read(_HEADER.size))
+      return kind, self._file.read(length)
+
+
+_SPILL_FILE = _SpillFile()
+
+
+def _encode(line):
+  if isinstance(line, unicode):
+    data = line.encode('utf-8')
+    return _HEADER.pack(_UNICODE, len(data)) + data
+  return _HEADER.pack(_STR, len(line)) + line
+
+
+def _decode_line(kind, data):
+  return data.decode('utf-8') if kind == _UNICODE else data
+
+
+def _decode(data):
+  pos = 0
+  while pos < len(data):
+    kind, length = _HEADER.unpack_from(data, pos)
+    pos += _HEADER.size
+    yield _decode_line(kind, data[pos:pos + length])
+    pos += length
+
+
+class LogLines(collections.Sequence):
+  """A read-only view of the lines of a finalized log."""
+
+  def __init__(self, lines=None, spilled=None):
+    # Exactly one of |lines| (an in-memory sequence) or |spilled| is set.
+    # |spilled| is a tuple of the (offset, length) regions of the spill file
+    # holding the lines, in order, and an array of the offset of each line.
+    self._lines = lines
+    self._spilled = spilled
+
+  def __iter__(self):
+    if self._spilled is None:
+      for line in self._lines:
+        yield line
+      return
+    for offset, length in self._spilled[0]:
+      for line in _decode(_SPILL_FILE.read(offset, length)):
+        yield line
+
+  def __len__(self):
+    if self._spilled is None:
+      return len(self._lines)
+    return len(self._spilled[1])
+
+  def __getitem__(self, index):
+    if self._spilled is None:
+      return self._lines[index]
+    if isinstance(index, slice):
+      return [self[i] for i in xrange(*index.indices(len(self)))]
+    return _decode_line(*_SPILL_FILE.read_line(self._spilled[1][index]))
+
+  def __eq__(self, other):
+    if not isinstance(other, collections.Sequence):
+      return NotImplemented
+    return list(self) == list(other)
+
+  def __ne__(self, other):
+    result = self.__eq__(other)
+    return result if result is NotImplemented else not result
+
+  def __repr__(self):
+    return 'LogLines(%r)' % (list(self),)
+
+
+def _should_spill(lines):
+  """Returns True if |lines| are strings, and more than SPILL_THRESHOLD bytes
+  of them."""
+  if isinstance(lines, basestring):
+    return False
+  size = 0
+  for line in lines:
+    if not isinstance(line, basestring):
+      return False
+    size += len(line)
+  return size > SPILL_THRESHOLD
+
+
+class LogSpooler(object):
+  """Iterates once over the lines of a log (e.g. while they are written to the
+  annotator), spilling them to disk on the way if they are big. view() then
+  returns a LogLines for them.
+  """
+
+  def __init__(self, lines):
+    if not isinstance(lines, (basestring, collections.Sequence)):
+      lines = list(lines)
+    self._lines = lines
+    self._view = None
+
+  def __iter__(self):
+    assert self._view is None, 'A log can only be spooled once'
+    if not _should_spill(self._lines):
+      for line in self._lines:
+        yield line
+      self._view = LogLines(lines=self._lines)
+      return
+
+    regions = []
+    offsets = array.array('L')
+    batch, batch_offsets, batch_size = [], [], 0
+    for i, line in enumerate(self._lines):
+      yield line
+      data = _encode(line)
+      batch.append(data)
+      batch_offsets.append(batch_size)
+      batch_size += len(data)
+      if batch_size >= BATCH_SIZE or i == len(self._lines) - 1:
+        offset = _SPILL_FILE.append(''.join(batch))
+        regions.append((offset, batch_size))
+        offsets.extend(offset + o for o in batch_offsets)
+        batch, batch_offsets, batch_size = [], [], 0
+    self._view = LogLines(spilled=(tuple(regions), offsets))
+    self._lines = None
+
+  def view(self):
+    assert self._view is not None, 'The log has not been spooled yet'
+    return self._view
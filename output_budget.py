@@ -0,0 +1,168 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Bounds how much of a step's output reaches the annotation stream.
+
+A step which writes gigabytes to stdout would otherwise push all of it through
+the output pump, the engine's stdout and every log consumer downstream. With
+an OutputBudget, the first |head_fraction| of |limit| bytes of each of a
+step's piped streams is logged as it is written, and the rest of the limit is
+kept from the end of the stream and logged when it ends. A stream longer than
+|limit| has a note of how many bytes were dropped in between, and is written
+in full, gzip compressed, to a side file.
+
+Budgets apply to the output as it is logged, i.e. after annotation escaping;
+annotations emitted by a step with allow_subannotations in the dropped part of
+its output are lost (but kept in the side file).
+"""
+
+import collections
+import gzip
+import os
+import re
+import tempfile
+
+
+# A stream cut short by an OutputBudget: the number of bytes which were
+# dropped, and the side file holding all of it.
+Truncation = collections.namedtuple('Truncation', 'dropped_bytes side_path')
+
+
+class BoundedOutput(object):
+  """A file-like wrapper around |outhandle| which writes the first
+  |head_bytes| of the output through straight away, and holds back the rest.
+  Once close()d, it writes the last (up to) |tail_bytes| of it, starting at a
+  line boundary.
+
+  If the output is more than head_bytes + tail_bytes, all of it is written to
+  the gzip file returned by |open_side_file|, as a (file, path) tuple.
+  """
+
+  def __init__(self, outhandle, head_bytes, tail_bytes, open_side_file):
+    self._out = outhandle
+    self._head_bytes = head_bytes
+    self._tail_bytes = tail_bytes
+    self._open_side_file = open_side_file
+
+    self._head_left = head_bytes
+    self._head = []
+    self._tail = collections.deque()
+    self._tail_size = 0
+    # The last byte written before what _tail holds (the output starts a line).
+    self._before_tail = '\n'
+    self._side = None
+    self._side_path = None
+    self._total = 0
+
+  def write(self, data):
+    self._total += len(data)
+    if self._head_left:
+      head = data[:self._head_left]
+      self._head_left -= len(head)
+      self._out.write(head)
+      if self._head is not None:
+        self._head.append(head)
+      if head:
+        self._before_tail = head[-1]
+      data = data[len(head):]
+    if not data:
+      return
+
+    self._tail.append(data)
+    self._tail_size += len(data)
+    if self._side is None:
+      if self._total <= self._head_bytes + self._tail_bytes:
+        return
+      self._side, self._side_path = self._open_side_file()
+      self._side.write(''.join(self._head))
+      self._side.write(''.join(self._tail))
+      self._head = None
+    else:
+      self._side.write(data)
+    while (self._tail and
+           self._tail_size - len(self._tail[0]) >= self._tail_bytes):
+      chunk = self._tail.popleft()
+      self._tail_size -= len(chunk)
+      self._before_tail = chunk[-1]
+
+  def flush(self):
+    self._out.flush()
+
+  def close(self):
+    """Writes what was held back: all of it if the output fit in head_bytes +
+    tail_bytes, otherwise a note of what was dropped and the tail.
+
+    Returns a Truncation, or None if all of the output was written.
+    """
+    tail = ''.join(self._tail)
+    self._tail.clear()
+    if self._side is None:
+      # It all fit.
+      self._out.write(tail)
+      self._out.flush()
+      return None
+    self._side.close()
+    self._side = None
+
+    # Don't start in the middle of a line: a line's end may look like an
+    # annotation.
+    start = max(len(tail) - self._tail_bytes, 0)
+    before = tail[start - 1] if start else self._before_tail
+    if before != '\n':
+      newline = tail.find('\n', start)
+      start = newline + 1 if newline != -1 else len(tail)
+    tail = tail[start:]
+    dropped = self._total - self._head_bytes - len(tail)
+
+    self._out.write('\n[%d bytes of output dropped; the full output is in '
+                    '%s]\n' % (dropped, self._side_path))
+    self._out.write(tail)
+    self._out.flush()
+    return Truncation(dropped, self._side_path)
+
+
+class OutputBudget(object):
+  """How much output each of a step's streams may log.
+
+  Args:
+    limit: bytes a stream may write before it's cut short, or None for no
+        limit.
+    head_fraction: the share of |limit| kept from the start of a stream which
+        is cut short; the rest is kept from its end.
+    side_dir: where full copies of streams which were cut short are written.
+        Defaults to the system's temporary directory.
+  """
+
+  def __init__(self, limit=None, head_fraction=0.5, side_dir=None):
+    assert 0 <= head_fraction <= 1, head_fraction
+    self.limit = limit
+    self.head_fraction = head_fraction
+    self.side_dir = side_dir
+
+  def for_step(self, limit):
+    """Returns the budget of a step which asked for |limit| (None to use this
+    budget's limit, 0 for no limit)."""
+    if limit is None:
+      return self
+    return OutputBudget(limit or None, self.head_fraction, self.side_dir)
+
+  def wrap(self, outhandle, step_name, stream_name):
+    """Returns |outhandle| bounded by this budget: a BoundedOutput, or
+    outhandle itself if there is no limit."""
+    if not self.limit:
+      return outhandle
+    head_bytes = int(self.limit * self.head_fraction)
+    prefix = re.sub(r'[^\w.-]+', '_', step_name)[:64] + '.'
+    suffix = '.%s.gz' % stream_name
+
+    def open_side_file():
+      side_dir = self.side_dir or tempfile.gettempdir()
+      if not os.path.isdir(side_dir):
+        os.makedirs(side_dir)
+      fd, path = tempfile.mkstemp(prefix=prefix, suffix=suffix, dir=side_dir)
+      os.close(fd)
+      return gzip.open(path, 'wb'), path
+
+    return BoundedOutput(
+        outhandle, head_bytes, self.limit - head_bytes, open_side_file)
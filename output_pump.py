@@ -0,0 +1,210 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Copies a step's piped stdout/stderr to the engine's own streams.
+
+Any output line which looks like an annotation is escaped with a leading '!',
+unless the step is allowed to emit its own annotations.
+
+Two pumps are provided:
+  * pump_threaded reads each pipe line by line in its own thread, flushing
+    after every line. It works everywhere, including Windows, where pipes can't
+    be waited on with select().
+  * pump_multiplexed reads every pipe in large chunks from a single thread,
+    escapes whole chunks at once and only flushes on a size or time budget. It
+    is much cheaper for steps which print a lot of output.
+
+pump() picks the best one for the current platform.
+"""
+
+import errno
+import os
+import select
+import sys
+import threading
+import time
+
+
+ANNOTATION_PREFIX = '@@@'
+
+# Number of bytes pump_multiplexed asks for on each read().
+READ_SIZE = 64 * 1024
+
+# pump_multiplexed flushes its output once this many bytes are buffered, or
+# once the oldest buffered byte is this many seconds old.
+FLUSH_SIZE = 64 * 1024
+FLUSH_INTERVAL = 0.1
+
+
+def pump_threaded(pairs, allow_subannotations, on_output=None):
+  """Copies each (inhandle, outhandle) pair using one thread per pair.
+
+  Blocks until every inhandle has reached EOF. Calls |on_output|, if given,
+  whenever something was read. Returns a list with the number of bytes read
+  from each inhandle.
+  """
+  outlock = threading.Lock()
+  counts = [0] * len(pairs)
+  def filter_lines(lock, allow_subannotations, inhandle, outhandle, index):
+    while True:
+      line = inhandle.readline()
+      if not line:
+        break
+      counts[index] += len(line)
+      if on_output:
+        on_output()
+      lock.acquire()
+      try:
+        if not allow_subannotations and line.startswith(ANNOTATION_PREFIX):
+          outhandle.write('!')
+        outhandle.write(line)
+        outhandle.flush()
+      finally:
+        lock.release()
+
+  threads = []
+  for index, (inhandle, outhandle) in enumerate(pairs):
+    threads.append(threading.Thread(
+        target=filter_lines,
+        args=(outlock, allow_subannotations, inhandle, outhandle, index)))
+
+  for th in threads:
+    th.start()
+  for th in threads:
+    th.join()
+  return counts
+
+
+class ChunkFilter(object):
+  """Incrementally translates a byte stream read in arbitrary chunks.
+
+  Applies universal newline translation (as a pipe opened with
+  universal_newlines=True would) and, unless |allow_subannotations|, escapes
+  every line which starts with ANNOTATION_PREFIX. Input which can't be decided
+  yet (a trailing '\\r', or a line start which may still become an annotation)
+  is held back until the next feed() or close().
+  """
+
+  def __init__(self, allow_subannotations):
+    self._escape = not allow_subannotations
+    self._at_line_start = True
+    self._pending = ''
+
+  def feed(self, data):
+    """Returns the filtered output for |data|, which may be empty."""
+    data = self._pending + data
+    self._pending = ''
+    if data.endswith('\r'):
+      data, self._pending = data[:-1], '\r'
+    data = data.replace('\r\n', '\n').replace('\r', '\n')
+
+    if self._escape:
+      start = data.rfind('\n') + 1
+      tail = data[start:]
+      if ((start or self._at_line_start) and tail and
+          len(tail) < len(ANNOTATION_PREFIX) and
+          ANNOTATION_PREFIX.startswith(tail)):
+        data, self._pending = data[:start], tail + self._pending
+    return self._emit(data)
+
+  def close(self):
+    """Returns any output still held back. The stream has ended."""
+    data = self._pending.replace('\r', '\n')
+    self._pending = ''
+    return self._emit(data)
+
+  def _emit(self, data):
+    if not data:
+      return ''
+    if self._escape:
+      data = data.replace('\n' + ANNOTATION_PREFIX, '\n!' + ANNOTATION_PREFIX)
+      if self._at_line_start and data.startswith(ANNOTATION_PREFIX):
+        data = '!' + data
+    self._at_line_start = data.endswith('\n')
+    return data
+
+
+def _retry_on_eintr(fn, *args):
+  while True:
+    try:
+      return fn(*args)
+    except (OSError, IOError, select.error) as e:
+      if e.args[0] != errno.EINTR:
+        raise
+
+
+def pump_multiplexed(pairs, allow_subannotations, on_output=None,
+                     read_size=READ_SIZE, flush_size=FLUSH_SIZE,
+                     flush_interval=FLUSH_INTERVAL):
+  """Copies each (inhandle, outhandle) pair from a single thread.
+
+  Reads whichever inhandle is ready in chunks of up to |read_size| bytes.
+  Output is flushed once |flush_size| bytes are pending, once the oldest
+  pending byte is |flush_interval| seconds old, before switching to writing a
+  different outhandle (so stdout/stderr interleaving is preserved at chunk
+  granularity), and at the end.
+
+  Blocks until every inhandle has reached EOF. Calls |on_output|, if given,
+  whenever something was read. Returns a list with the number of bytes read
+  from each inhandle. POSIX only.
+  """
+  readers = {}
+  counts = [0] * len(pairs)
+  for index, (inhandle, outhandle) in enumerate(pairs):
+    readers[inhandle.fileno()] = (
+        index, outhandle, ChunkFilter(allow_subannotations))
+
+  state = {'out': None, 'pending': 0, 'since': None}
+  def flush():
+    if state['out'] is not None and state['pending']:
+      state['out'].flush()
+    state['pending'] = 0
+    state['since'] = None
+
+  while readers:
+    timeout = None
+    if state['since'] is not None:
+      timeout = max(0, state['since'] + flush_interval - time.time())
+    ready, _, _ = _retry_on_eintr(select.select, list(readers), [], [],
+                                  timeout)
+
+    for fd in ready:
+      index, outhandle, chunk_filter = readers[fd]
+      data = _retry_on_eintr(os.read, fd, read_size)
+      if data:
+        counts[index] += len(data)
+        if on_output:
+          on_output()
+        data = chunk_filter.feed(data)
+      else:
+        data = chunk_filter.close()
+        del readers[fd]
+      if not data:
+        continue
+
+      if state['out'] is not outhandle:
+        flush()
+        state['out'] = outhandle
+      outhandle.write(data)
+      if state['since'] is None:
+        state['since'] = time.time()
+      state['pending'] += len(data)
+
+    if state['since'] is not None and (
+        state['pending'] >= flush_size or
+        time.time() - state['since'] >= flush_interval):
+      flush()
+
+  flush()
+  return counts
+
+
+def pump(pairs, allow_subannotations, on_output=None):
+  """Copies each (inhandle, outhandle) pair with the best available pump.
+
+  Returns a list with the number of bytes read from each inhandle.
+  """
+  if sys.platform.startswith('win'):
+    return pump_threaded(pairs, allow_subannotations, on_output)
+  return pump_multiplexed(pairs, allow_subannotations, on_output)
@@ -484,6 +484,11 @@ class PackageDeps(object):
   def get_package(self, package_id):
     return self._repos[package_id]
 
+  @property
+  def package_dir(self):
+    """The root package's .recipe_deps directory."""
+    return self._context.package_dir
+
   @property
   def all_recipe_dirs(self):
     for repo in self._repos.values():
@@ -0,0 +1,319 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A pool of pre-started python interpreters which run python steps.
+
+Starting a python interpreter costs tens of milliseconds, which adds up for
+recipes which run hundreds of small python.inline steps. With a WorkerPool,
+steps of the form 'python [-u] <script> <args...>' are instead handed to an
+idle worker, which forks, sets up the step's cwd, environment and stdio in the
+child, and runs the script there with runpy. The warm interpreter itself is
+never modified by a step.
+
+Each worker listens on its own unix socket, and serves one step at a time. For
+each step the client makes three connections, in order:
+  * control: the client sends one JSON request line,
+      {"argv": [...], "cwd": ..., "env": {...}, "unbuffered": bool,
+       "stdin": path or null, "stdout": path or null, "stderr": path or null}
+    and the worker answers with {"pid": <child pid>} once the child has
+    started, then {"returncode": n, "rusage": {...}} once it has exited.
+  * stdout, stderr: the child's stdout and stderr, unless they are redirected
+    to files by the request.
+
+Each child runs in its own process group, so it can be signalled just like a
+step started with subprocess. POSIX only.
+
+This file is also the worker's main program, so it only imports the standard
+library.
+"""
+
+import collections
+import errno
+import json
+import os
+import Queue
+import runpy
+import select
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+
+
+# Environment variables which change how the interpreter starts up. A step
+# which overrides any of them can't run in a worker started without them.
+_STARTUP_ENV = ('PATH', 'PYTHONHOME', 'PYTHONPATH', 'PYTHONSTARTUP',
+                'PYTHONOPTIMIZE', 'PYTHONDONTWRITEBYTECODE', 'PYTHONNOUSERSITE',
+                'PYTHONIOENCODING')
+
+_RUSAGE_FIELDS = ('ru_utime', 'ru_stime', 'ru_maxrss', 'ru_inblock',
+                  'ru_oublock')
+
+# The subset of resource.struct_rusage reported for a step run in a worker.
+Rusage = collections.namedtuple('Rusage', ' '.join(_RUSAGE_FIELDS))
+
+
+def is_supported():
+  return hasattr(socket, 'AF_UNIX') and hasattr(os, 'fork')
+
+
+def parse_command(cmd):
+  """Returns (argv, unbuffered) if |cmd| is 'python [-u] <script> <args...>',
+  which a worker can run as argv, or None."""
+  if len(cmd) < 2 or cmd[0] != 'python':
+    return None
+  unbuffered = cmd[1] == '-u'
+  argv = list(cmd[2:] if unbuffered else cmd[1:])
+  if not argv or argv[0].startswith('-'):
+    return None
+  return argv, unbuffered
+
+
+def can_run(cmd, env_overrides):
+  """Returns True if the step |cmd|, run with |env_overrides| on top of the
+  engine's environment, behaves the same in a worker as in a new process."""
+  if parse_command(cmd) is None:
+    return False
+  return not any(k in _STARTUP_ENV for k in (env_overrides or {}))
+
+
+def _retry_on_eintr(fn, *args):
+  while True:
+    try:
+      return fn(*args)
+    except (OSError, IOError, select.error, socket.error) as e:
+      if e.args[0] != errno.EINTR:
+        raise
+
+
+class WorkerProcess(object):
+  """A step running in a worker. Quacks enough like subprocess.Popen for
+  _run_annotated_step."""
+
+  def __init__(self, pool, worker, control, out, err):
+    self._pool = pool
+    self._worker = worker
+    self._conns = (control, out, err)
+    self._replies = control.makefile('rb')
+    self.stdout = out.makefile('rb')
+    self.stderr = err.makefile('rb')
+    self.returncode = None
+    self.pid = json.loads(self._reply())['pid']
+
+  def _reply(self):
+    line = _retry_on_eintr(self._replies.readline)
+    if not line:
+      raise OSError(errno.EPIPE, 'python worker died')
+    return line
+
+  def wait(self):
+    """Waits for the step to exit, and returns its Rusage."""
+    try:
+      reply = json.loads(self._reply())
+    except:
+      self._pool.discard(self._worker)
+      raise
+    finally:
+      for f in (self._replies, self.stdout, self.stderr) + self._conns:
+        f.close()
+    self.returncode = reply['returncode']
+    self._pool.release(self._worker)
+    return Rusage(**reply['rusage'])
+
+
+class _Worker(object):
+  def __init__(self, python, socket_dir, index):
+    self.socket_path = os.path.join(socket_dir, 'worker%d' % index)
+    self._ready = False
+    # The worker exits when its stdin is closed, so that it never outlives the
+    # engine.
+    self.proc = subprocess.Popen(
+        [python, '-u', os.path.abspath(__file__), self.socket_path],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, close_fds=True)
+
+  def connect(self):
+    if not self._ready:
+      if self.proc.stdout.readline() != 'ready\n':
+        raise OSError(errno.ECHILD, 'python worker failed to start')
+      self._ready = True
+    conns = []
+    for _ in xrange(3):
+      conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      _retry_on_eintr(conn.connect, self.socket_path)
+      conns.append(conn)
+    return conns
+
+  def close(self):
+    try:
+      self.proc.stdin.close()
+    except IOError:
+      pass
+    self.proc.wait()
+
+
+class WorkerPool(object):
+  """|size| warm python workers, shared by any number of threads."""
+
+  def __init__(self, size, python='python'):
+    self._python = python
+    self._socket_dir = tempfile.mkdtemp(prefix='python_workers')
+    self._lock = threading.Lock()
+    self._count = 0
+    self._workers = []
+    self._idle = Queue.Queue()
+    for _ in xrange(size):
+      self._idle.put(self._new_worker())
+
+  def _new_worker(self):
+    with self._lock:
+      worker = _Worker(self._python, self._socket_dir, self._count)
+      self._count += 1
+      self._workers.append(worker)
+    return worker
+
+  def start(self, argv, unbuffered, cwd, env, stdin=None, stdout=None,
+            stderr=None):
+    """Starts |argv| (a script and its arguments) in an idle worker.
+
+    |stdin|, |stdout| and |stderr| are paths to redirect the step's stdio to.
+    The step's stdout and stderr are otherwise available from the returned
+    WorkerProcess. Blocks while every worker is busy.
+    """
+    request = json.dumps({
+      'argv': argv, 'cwd': cwd, 'env': env, 'unbuffered': unbuffered,
+      'stdin': stdin, 'stdout': stdout, 'stderr': stderr,
+    })
+    worker = self._idle.get()
+    try:
+      control, out, err = worker.connect()
+      control.sendall(request + '\n')
+      return WorkerProcess(self, worker, control, out, err)
+    except:
+      self.discard(worker)
+      raise
+
+  def release(self, worker):
+    self._idle.put(worker)
+
+  def discard(self, worker):
+    """Replaces a worker which is no longer usable."""
+    with self._lock:
+      self._workers.remove(worker)
+    worker.proc.kill()
+    worker.close()
+    self._idle.put(self._new_worker())
+
+  def close(self):
+    with self._lock:
+      workers, self._workers = self._workers, []
+    for worker in workers:
+      worker.close()
+    shutil.rmtree(self._socket_dir, ignore_errors=True)
+
+
+def _exit_code(e):
+  """Returns the exit status for a SystemExit, as the interpreter would."""
+  if e.code is None:
+    return 0
+  if isinstance(e.code, (int, long)):
+    return e.code
+  sys.stderr.write('%s\n' % (e.code,))
+  return 1
+
+
+def _run_child(request, out, err):
+  """Runs a request in the forked child. Never returns."""
+  code = 1
+  try:
+    os.setpgrp()
+    for fd, path, conn, mode in ((0, request['stdin'], None, os.O_RDONLY),
+                                 (1, request['stdout'], out, os.O_WRONLY),
+                                 (2, request['stderr'], err, os.O_WRONLY)):
+      if path is None and conn is not None:
+        os.dup2(conn.fileno(), fd)
+        continue
+      if mode == os.O_WRONLY:
+        mode |= os.O_CREAT | os.O_TRUNC
+      handle = os.open(path or os.devnull, mode, 0666)
+      os.dup2(handle, fd)
+      os.close(handle)
+    out.close()
+    err.close()
+
+    bufsize = 0 if request['unbuffered'] else -1
+    sys.stdin = os.fdopen(0, 'r')
+    sys.stdout = os.fdopen(1, 'w', bufsize)
+    sys.stderr = os.fdopen(2, 'w', 0)
+
+    if request['cwd']:
+      os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    script = request['argv'][0]
+    sys.argv = request['argv']
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+
+    try:
+      runpy.run_path(script, run_name='__main__')
+      code = 0
+    except SystemExit as e:
+      code = _exit_code(e)
+    except BaseException:
+      traceback.print_exc()
+  finally:
+    try:
+      sys.stdout.flush()
+      sys.stderr.flush()
+    finally:
+      os._exit(code)
+
+
+def _serve_one(listener, control):
+  out, _ = _retry_on_eintr(listener.accept)
+  err, _ = _retry_on_eintr(listener.accept)
+  request = json.loads(control.makefile('rb').readline())
+
+  pid = os.fork()
+  if pid == 0:
+    listener.close()
+    control.close()
+    _run_child(request, out, err)
+  out.close()
+  err.close()
+
+  control.sendall(json.dumps({'pid': pid}) + '\n')
+  _, status, rusage = _retry_on_eintr(os.wait4, pid, 0)
+  if os.WIFSIGNALED(status):
+    returncode = -os.WTERMSIG(status)
+  else:
+    returncode = os.WEXITSTATUS(status)
+  control.sendall(json.dumps({
+    'returncode': returncode,
+    'rusage': dict((k, getattr(rusage, k)) for k in _RUSAGE_FIELDS),
+  }) + '\n')
+  control.close()
+
+
+def serve(socket_path):
+  """Serves steps on |socket_path| until stdin is closed."""
+  listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  listener.bind(socket_path)
+  listener.listen(3)
+  sys.stdout.write('ready\n')
+  sys.stdout.flush()
+
+  while True:
+    ready, _, _ = _retry_on_eintr(
+        select.select, [listener, sys.stdin], [], [])
+    if sys.stdin in ready:
+      return
+    control, _ = _retry_on_eintr(listener.accept)
+    _serve_one(listener, control)
+
+
+if __name__ == '__main__':
+  serve(sys.argv[1])
@@ -13,7 +13,9 @@ from .config import Single
 
 from .util import ModuleInjectionSite
 
+from . import engine_profiler
 from . import field_composer
+from . import trace_event
 
 
 class StepFailure(Exception):
@@ -80,6 +82,26 @@ class InfraFailure(StepFailure):
     return "Infra Failure in %s" % self.name
 
 
+class StepTimeout(InfraFailure):
+  """
+  A subclass of InfraFailure, raised when a step's process group was killed
+  because the step ran for longer than its |timeout|, or produced no output
+  for longer than its |no_output_timeout|.
+  """
+  def __init__(self, name, result, kind, limit, elapsed):
+    self.kind = kind
+    self.limit = limit
+    self.elapsed = elapsed
+    super(StepTimeout, self).__init__(name, result)
+
+  def reason_message(self):
+    return "Infra Failure: Step({!r}) timed out after {:.1f}s ({}={})".format(
+        self.name, self.elapsed, self.kind, self.limit)
+
+  def __str__(self):  # pragma: no cover
+    return "Step Timeout in %s" % self.name
+
+
 class AggregatedStepFailure(StepFailure):
   def __init__(self, result):
     super(AggregatedStepFailure, self).__init__(
@@ -216,6 +238,8 @@ def infer_composite_step(func):
       return func(*a, **kw)
 
     agg = _STEP_CONTEXT['aggregated_result']
+    recorder = trace_event.active()
+    start = recorder.now() if recorder else None
 
     # Setting the aggregated_result to None allows the contents of func to be
     # written in the same style (e.g. with exceptions) no matter how func is
@@ -230,6 +254,11 @@ def infer_composite_step(func):
       except StepFailure as ex:
         agg.add_failure(ex)
         return DeferredResult(None, ex)
+      finally:
+        # Only calls which turned out to be composite steps are recorded.
+        if recorder and _STEP_CONTEXT.get('ran_step', [False])[0]:
+          recorder.complete(func.__name__, 'composite_step', start,
+                            recorder.now())
   return _inner
 
 
@@ -252,14 +281,16 @@ def composite_step(func):
     _STEP_CONTEXT['ran_step'][0] = True
 
     if _STEP_CONTEXT.get('aggregated_result') is None:
-      return func(*a, **kw)
+      with trace_event.span(func.__name__, 'composite_step'):
+        return func(*a, **kw)
 
     agg = _STEP_CONTEXT['aggregated_result']
 
     # Setting the aggregated_result to None allows the contents of func to be
     # written in the same style (e.g. with exceptions) no matter how func is
     # being called.
-    with context({'aggregated_result': None}):
+    with context({'aggregated_result': None}), \
+         trace_event.span(func.__name__, 'composite_step'):
       try:
         ret = func(*a, **kw)
         agg.add_success(ret)
@@ -297,7 +328,8 @@ def defer_results():
   assert _STEP_CONTEXT.get('aggregated_result') is None, (
       "may not call defer_results in an active defer_results context")
   agg = AggregatedResult()
-  with context({'aggregated_result': agg}):
+  with context({'aggregated_result': agg}), \
+       trace_event.span('defer_results', 'defer_results'):
     yield
   if agg.failures:
     raise AggregatedStepFailure(agg)
@@ -308,9 +340,11 @@ class RecipeApiMeta(type):
   def __new__(mcs, name, bases, attrs):
     """Automatically wraps all methods of subclasses of RecipeApi with
     @infer_composite_step. This allows defer_results to work as intended without
-    manually decorating every method.
+    manually decorating every method. They are also wrapped for the
+    engine_profiler, which attributes recipe-side time to them.
     """
-    wrap = lambda f: infer_composite_step(f) if f else f
+    wrap = lambda f: (
+        engine_profiler.profiled(infer_composite_step(f)) if f else f)
     for attr in attrs:
       if attr in RecipeApiMeta.WHITELIST:
         continue
@@ -495,6 +529,8 @@ class Property(object):
     if isinstance(kind, type):
       kind = Single(kind)
     self.kind = kind
+    # (kind, kind.validator()), made the first time a value is interpreted.
+    self._validator = None
 
   def interpret(self, value):
     """
@@ -511,7 +547,9 @@ class Property(object):
     if value is not Property.sentinel:
       if self.kind is not None:
         # The config system handles type checking for us here.
-        self.kind.set_val(value)
+        if self._validator is None or self._validator[0] is not self.kind:
+          self._validator = (self.kind, self.kind.validator())
+        self._validator[1](value)
       return value
 
     if self._default is not Property.sentinel:
@@ -0,0 +1,201 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""An index of the recipes and recipe modules in a set of directories.
+
+Finding a recipe or module by name used to probe every recipe (or module)
+directory, and listing them all walked the whole tree. A RecipeIndex records
+the listing of each directory under the recipe and module directories (its
+subdirectories, and its .py files) with the directory's mtime, marshalled at
+|path|. Loading the index only stat()s each indexed directory: adding,
+removing or renaming an entry in a directory changes its mtime, so only the
+directories whose mtime changed are listed again, and the index is rewritten
+if any were.
+"""
+
+import marshal
+import os
+import tempfile
+import time
+
+
+# Bump this when the format changes.
+INDEX_VERSION = 1
+
+# A directory modified this recently (in seconds) may be modified again
+# without its mtime changing, on file systems with coarse timestamps. Its
+# listing is used, but not trusted by the next load.
+_RACY_SECONDS = 2
+
+
+def _list_dir(path):
+  """Returns the record of the directory at |path|."""
+  dirs, files = [], []
+  for name in os.listdir(path):
+    full = os.path.join(path, name)
+    if os.path.isdir(full):
+      # Like os.walk, don't follow symlinks to directories.
+      if not os.path.islink(full):
+        dirs.append(name)
+    elif name.endswith('.py'):
+      files.append(name)
+  return {'dirs': sorted(dirs), 'files': sorted(files)}
+
+
+class RecipeIndex(object):
+  """The index of |recipe_dirs| and |module_dirs|, stored at |path|.
+
+  The directories are scanned, and the index refreshed, the first time it's
+  used.
+  """
+
+  def __init__(self, path, recipe_dirs, module_dirs):
+    self.path = path
+    self._recipe_dirs = list(recipe_dirs)
+    self._module_dirs = list(module_dirs)
+    self._records = None
+
+    self._recipes = None
+    self._examples = None
+    self._modules = None
+    self._recipe_paths = None
+    self._module_paths = None
+
+  def _load(self):
+    try:
+      with open(self.path, 'rb') as f:
+        data = marshal.load(f)
+      if data.get('version') == INDEX_VERSION:
+        return data['dirs']
+    except (IOError, EOFError, ValueError, TypeError, AttributeError,
+            KeyError):
+      pass
+    return {}
+
+  def _store(self):
+    data = {'version': INDEX_VERSION, 'dirs': self._records}
+    try:
+      dirname = os.path.dirname(self.path)
+      if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+      fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+      try:
+        with os.fdopen(fd, 'wb') as f:
+          marshal.dump(data, f)
+        os.rename(tmp, self.path)
+      except:
+        os.unlink(tmp)
+        raise
+    except (IOError, OSError):
+      pass
+
+  def _walk(self, root):
+    """Yields (directory, record) for |root| and every directory below it,
+    parents first."""
+    stack = [root]
+    while stack:
+      path = stack.pop()
+      record = self._records.get(path)
+      if record is not None:
+        yield path, record
+        stack.extend(os.path.join(path, d) for d in reversed(record['dirs']))
+
+  def _scan(self):
+    if self._records is not None:
+      return
+    old = self._load()
+    self._records = {}
+    changed = False
+    now = time.time()
+
+    stack = self._recipe_dirs + self._module_dirs
+    while stack:
+      path = stack.pop()
+      if path in self._records:
+        continue
+      try:
+        mtime = os.stat(path).st_mtime
+      except OSError:
+        continue
+      record = old.get(path)
+      if record is None or record['mtime'] != mtime:
+        try:
+          record = _list_dir(path)
+        except OSError:
+          continue
+        record['mtime'] = mtime if now - mtime > _RACY_SECONDS else None
+        changed = True
+      self._records[path] = record
+      stack.extend(os.path.join(path, d) for d in record['dirs'])
+    if changed or set(old) != set(self._records):
+      self._store()
+
+    self._recipes = []
+    for root in self._recipe_dirs:
+      for path, record in self._walk(root):
+        for f in record['files']:
+          full = os.path.join(path, f)
+          self._recipes.append((full, full[len(root)+1:-len('.py')]))
+
+    self._examples = []
+    self._modules = []
+    for root in self._module_dirs:
+      if root not in self._records:
+        continue
+      for d in self._records[root]['dirs']:
+        mod_path = os.path.join(root, d)
+        record = self._records.get(mod_path)
+        if record is not None and '__init__.py' in record['files']:
+          self._modules.append(mod_path)
+      for path, record in self._walk(root):
+        for f in record['files']:
+          if f.endswith('example.py'):
+            self._examples.append(
+                (os.path.join(path, f), '%s:example' % path[len(root)+1:]))
+
+    self._recipe_paths = {}
+    for path, name in self._recipes:
+      self._recipe_paths.setdefault(name, path)
+    self._module_paths = {}
+    for path in self._modules:
+      self._module_paths.setdefault(os.path.basename(path), path)
+
+  def refresh(self):
+    """Makes the next lookup scan the directories again, only listing those
+    which changed since they were last scanned."""
+    self._records = None
+
+  def recipe_path(self, name):
+    """Returns the path of the recipe |name| (as in recipe_dirs/name.py), or
+    None."""
+    self._scan()
+    return self._recipe_paths.get(name.replace('/', os.sep))
+
+  def example_path(self, module_name):
+    """Returns the path of the example of the module |module_name|, or None.
+    """
+    self._scan()
+    path = self._module_paths.get(module_name)
+    if path is not None:
+      if 'example.py' in self._records[path]['files']:
+        return os.path.join(path, 'example.py')
+    return None
+
+  def module_path(self, name):
+    """Returns the path of the first recipe module named |name|, or None."""
+    self._scan()
+    return self._module_paths.get(name)
+
+  def recipes(self):
+    """Returns the (path, name) of every recipe, and of every module example
+    (named '<module>:example'), as RecipeUniverse.loop_over_recipes yields
+    them."""
+    self._scan()
+    return [(p, n) for p, n in self._recipes
+            if not os.path.basename(p).startswith('_')] + self._examples
+
+  def modules(self):
+    """Returns the path of every recipe module."""
+    self._scan()
+    return list(self._modules)
@@ -27,6 +27,8 @@ class JsonOutputPlaceholder(recipe_util.Placeholder):
   JSON document, which will be set as the json.output for that step in the
   step_history OrderedDict passed to your recipe generator.
   """
+  cache_role = 'output'
+
   def __init__(self, api, add_json_log):
     self.raw = api.m.raw_io.output('.json')
     self.add_json_log = add_json_log
@@ -8,7 +8,12 @@ import textwrap
 
 class PythonApi(recipe_api.RecipeApi):
   def __call__(self, name, script, args=None, unbuffered=True, **kwargs):
-    """Return a step to run a python script with arguments."""
+    """Return a step to run a python script with arguments.
+
+    If the engine runs with python workers, the script runs in a pre-started
+    interpreter (with its own cwd, environment and stdio). Pass
+    fresh_process=True to always start a new interpreter instead.
+    """
     cmd = ['python']
     if unbuffered:
       cmd.append('-u')
@@ -11,6 +11,8 @@ import tempfile
 
 
 class InputDataPlaceholder(recipe_util.Placeholder):
+  cache_role = 'input'
+
   def __init__(self, data, suffix):
     assert isinstance(data, basestring)
     self.data = data
@@ -43,6 +45,8 @@ class InputDataPlaceholder(recipe_util.Placeholder):
 
 
 class OutputDataPlaceholder(recipe_util.Placeholder):
+  cache_role = 'output'
+
   def __init__(self, suffix, leak_to):
     self.suffix = suffix
     self.leak_to = leak_to
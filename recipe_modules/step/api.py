@@ -5,6 +5,7 @@
 import contextlib
 
 from recipe_engine import recipe_api
+from recipe_engine import trace_event
 
 
 # Inherit from RecipeApiPlain because the only thing which is a step is
@@ -34,6 +35,11 @@ class StepApi(recipe_api.RecipeApiPlain):
     """ See recipe_api.py for docs. """
     return recipe_api.InfraFailure
 
+  @property
+  def StepTimeout(self):
+    """ See recipe_api.py for docs. """
+    return recipe_api.StepTimeout
+
   @property
   def active_result(self):
     """The currently active (open) result from the last step that was run.
@@ -80,10 +86,11 @@ class StepApi(recipe_api.RecipeApiPlain):
     above); the dummy step will govern annotation emission, while the implicit
     context will propagate the dummy step's name to subordinate steps.
     """
-    self(name, [])
-    context_dict = {'name': name, 'nest_level': 1}
-    with self.context(context_dict):
-      yield
+    with trace_event.span(name, 'nest'):
+      self(name, [])
+      context_dict = {'name': name, 'nest_level': 1}
+      with self.context(context_dict):
+        yield
 
   @property
   def defer_results(self):
@@ -105,11 +112,38 @@ class StepApi(recipe_api.RecipeApiPlain):
         steps will place the step in an EXCEPTION state and raise InfraFailure.
       wrapper: If supplied, a command to prepend to the executed step as a
           command wrapper.
+      timeout: If supplied, the number of seconds the step may run for.
+      no_output_timeout: If supplied, the number of seconds the step may go
+          without writing to stdout or stderr. Ignored if both are redirected
+          to files.
+          A step which exceeds either limit has its process group terminated
+          (SIGTERM, then SIGKILL) and raises StepTimeout, an InfraFailure.
+      cacheable: If True, and the engine has a step cache, a successful result
+          is cached keyed on the command, environment, working directory and
+          input files, and replayed instead of running the step again.
+      cache_inputs: Files or directories (other than input placeholders) whose
+          contents a cacheable step depends on.
+      fresh_process: If True, the step always runs in a new process, even if
+          the engine could run it in one of its pre-started python workers.
+      max_output_bytes: If supplied, how many bytes of each of stdout and
+          stderr the step may log, overriding the engine's output budget (0
+          for no limit). Beyond it, only the start and end of the stream are
+          logged, and all of it is written to a compressed side file.
+      resource_limits: If supplied, a dict of names of resource.RLIMIT_*
+          constants (e.g. 'RLIMIT_NOFILE') to the limit to set, both soft and
+          hard, in the step's process. Ignored on Windows.
       **kwargs: Additional entries to add to the annotator.py step dictionary.
 
     Returns:
       Opaque step object produced and understood by recipe engine.
     """
+    return self.run_from_dict(self._make_step(
+        name, cmd, ok_ret=ok_ret, infra_step=infra_step, wrapper=wrapper,
+        **kwargs))
+
+  def _make_step(self, name, cmd, ok_ret=None, infra_step=False, wrapper=(),
+                 **kwargs):
+    """Builds the engine step for __call__ and parallel."""
     assert 'shell' not in kwargs
     assert isinstance(cmd, list)
     if not ok_ret:
@@ -137,7 +171,33 @@ class StepApi(recipe_api.RecipeApiPlain):
 
     schema = self.make_config()
     schema.set_val(kwargs)
-    return self.run_from_dict(self._engine.create_step(schema))
+    return self._engine.create_step(schema)
+
+  def parallel(self, steps):
+    """Runs several independent steps concurrently.
+
+    Args:
+      steps (list of dict): one dict per step, holding the keyword arguments
+        that would otherwise be passed to api.step(), e.g.
+          {'name': 'test shard 0', 'cmd': ['run_tests', '--shard', '0']}
+
+    Returns:
+      A list of StepFuture objects, in the same order as |steps|. Calling
+      result() on a future blocks until that step has finished, and then
+      returns its result (or raises StepFailure) exactly as api.step() would.
+      Futures whose result() is never called are collected when the recipe
+      ends, and fail the build if their step failed.
+
+    Example:
+      futures = api.step.parallel([
+          {'name': 'shard %d' % i, 'cmd': ['run_tests', '--shard', str(i)]}
+          for i in xrange(4)])
+      for f in futures:
+        f.result()
+    """
+    recipe_api._STEP_CONTEXT['ran_step'][0] = True
+    return self._engine.run_steps_parallel(
+        [self._make_step(**kwargs) for kwargs in steps])
 
   # TODO(martiniss) delete, and make generator_script use **kwargs on step()
   @recipe_api.composite_step
@@ -33,6 +33,19 @@ def BaseConfig(**_kwargs):
 
     allow_subannotations = Single(bool, required=False),
 
+    timeout = Single((int, float), required=False),
+    no_output_timeout = Single((int, float), required=False),
+
+    cacheable = Single(bool, required=False),
+    cache_inputs = List(inner_type=(basestring, Path),
+                        jsonish_fn=lambda lst: map(str, lst)),
+
+    fresh_process = Single(bool, required=False),
+
+    max_output_bytes = Single(int, required=False),
+
+    resource_limits = Dict(value_type=int),
+
     trigger_specs = ConfigList(
         lambda: ConfigGroup(
             bucket=Single(basestring),
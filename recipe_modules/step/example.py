@@ -65,6 +65,22 @@ def RunSteps(api):
   api.step('application', ['echo', 'main', 'application'],
            wrapper=['python', '-c', 'import sys; print sys.argv'])
 
+  # Independent steps can run concurrently. Each future's result() returns (or
+  # raises) exactly what api.step would have.
+  futures = api.step.parallel([
+      {'name': 'shard %d' % i, 'cmd': ['echo', 'shard', str(i)]}
+      for i in xrange(2)])
+  for future in futures:
+    future.result()
+
+  # Steps can be given time limits. A step which runs for too long, or which
+  # stops producing output, has its process group killed and raises
+  # StepTimeout, a kind of InfraFailure.
+  try:
+    api.step('slow', ['sleep', '1'], timeout=600, no_output_timeout=300)
+  except api.step.StepTimeout as e:
+    assert e.result.presentation.status == api.step.EXCEPTION
+
   if api.properties.get('access_invalid_data'):
     result = api.step('no-op', ['echo', 'I', 'do', 'nothing'])
     # Trying to access non-existent attributes on the result should raise.
@@ -113,6 +129,11 @@ def GenTests(api):
       api.expect_exception('StepDataAttributeError')
     )
 
+  yield (
+      api.test('timeout') +
+      api.step_data('slow', times_out=True)
+    )
+
   yield (
       api.test('infra_failure') +
       api.properties(raise_infra_failure=True) +
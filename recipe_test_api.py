@@ -59,6 +59,7 @@ class StepTestData(BaseTestData):
     self._stdout = None
     self._stderr = None
     self._retcode = None
+    self.times_out = False
 
   def __add__(self, other):
     assert isinstance(other, StepTestData)
@@ -77,6 +78,7 @@ class StepTestData(BaseTestData):
     if other._retcode is not None:
       assert ret._retcode is None
       ret._retcode = other._retcode
+    ret.times_out = self.times_out or other.times_out
 
     return ret
 
@@ -130,6 +132,7 @@ class StepTestData(BaseTestData):
       'stdout': self._stdout,
       'stderr': self._stderr,
       'retcode': self._retcode,
+      'times_out': self.times_out,
       'override': self.override,
     },)
 
@@ -401,6 +404,8 @@ class RecipeTestApi(object):
              was set by |data|. This must be set as a keyword arg.
       stdout - StepTestData object with placeholder data for a step's stdout.
       stderr - StepTestData object with placeholder data for a step's stderr.
+      times_out=(bool) - Simulate the step being killed for exceeding its
+             timeout (or, if it has none, its no_output_timeout).
       override=(bool) - This step data completely replaces any previously
              generated step data, instead of adding on to it.
 
@@ -436,6 +441,8 @@ class RecipeTestApi(object):
       ret.step_data[name] = reduce(sum, data)
     if 'retcode' in kwargs:
       ret.step_data[name].retcode = kwargs['retcode']
+    if 'times_out' in kwargs:
+      ret.step_data[name].times_out = kwargs['times_out']
     if 'override' in kwargs:
       ret.step_data[name].override = kwargs['override']
     for key in ('stdout', 'stderr'):
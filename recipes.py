@@ -16,6 +16,18 @@ import sys
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
+# Commands which may be run in a zygote (see zygote.py).
+ZYGOTE_COMMANDS = ('run', 'plan', 'simulation_test')
+
+# Engine modules which the commands a zygote serves import.
+_ZYGOTE_PRELOAD = (
+  'engine_profiler', 'output_budget', 'run', 'simulation_test',
+  'step_executor', 'step_journal', 'step_plan', 'trace_event',
+  'third_party.annotator',
+)
+
+_UNIVERSE = None
+
 
 def get_package_config(args):
   from recipe_engine import package
@@ -28,22 +40,21 @@ def get_package_config(args):
   return repo_root, package.ProtoFile(args.package)
 
 
-def simulation_test(package_deps, args):
-  from recipe_engine import simulation_test
-  simulation_test.main(package_deps, args=json.loads(args.args))
-
+def get_universe(package_deps):
+  """Returns the RecipeUniverse of |package_deps|.
 
-def lint(package_deps, args):
-  from recipe_engine import lint_test
-  lint_test.main(package_deps, args.whitelist)
+  There is one per process, since recipe modules are loaded into sys.modules;
+  in particular, commands served by a zygote use the one it preloaded.
+  """
+  global _UNIVERSE
+  if _UNIVERSE is None:
+    from recipe_engine import loader
+    _UNIVERSE = loader.RecipeUniverse(package_deps)
+  return _UNIVERSE
 
 
-def run(package_deps, args):
-  from recipe_engine import run as recipe_run
-  from recipe_engine import loader
-  from recipe_engine import package
-  from recipe_engine.third_party import annotator
-
+def get_properties(args):
+  """Returns the properties given to a run or plan command."""
   def get_properties_from_args(args):
     properties = dict(x.split('=', 1) for x in args)
     for key, val in properties.iteritems():
@@ -72,12 +83,38 @@ def run(package_deps, args):
   else:
     properties = arg_properties
 
+  return properties
+
+
+def simulation_test(package_deps, args):
+  from recipe_engine import simulation_test
+  simulation_test.main(package_deps, args=json.loads(args.args),
+                       universe=get_universe(package_deps))
+
+
+def lint(package_deps, args):
+  from recipe_engine import lint_test
+  lint_test.main(package_deps, args.whitelist)
+
+
+def run(package_deps, args):
+  from recipe_engine import engine_profiler
+  from recipe_engine import output_budget
+  from recipe_engine import run as recipe_run
+  from recipe_engine import step_executor
+  from recipe_engine import step_journal
+  from recipe_engine import loader
+  from recipe_engine import package
+  from recipe_engine import trace_event
+  from recipe_engine.third_party import annotator
+
+  properties = get_properties(args)
   properties['recipe'] = args.recipe
 
   os.environ['PYTHONUNBUFFERED'] = '1'
   os.environ['PYTHONIOENCODING'] = 'UTF-8'
 
-  universe = loader.RecipeUniverse(package_deps)
+  universe = get_universe(package_deps)
 
   workdir = (args.workdir or
       os.path.join(os.path.dirname(os.path.realpath(__file__)), 'workdir'))
@@ -85,14 +122,144 @@ def run(package_deps, args):
   if not os.path.exists(workdir):
     os.makedirs(workdir)
 
+  event_file = None
+  if args.annotation_format == 'json':
+    # Events and output each get their own channel: the event file and
+    # stdout, or stdout and stderr if the events go to stdout.
+    if args.event_stream and args.event_stream != '-':
+      event_file = open(args.event_stream, 'w')
+      sink = annotator.JsonEventSink(events=event_file, output=sys.stdout)
+    else:
+      sink = annotator.JsonEventSink(events=sys.stdout, output=sys.stderr)
+    stream = annotator.StructuredAnnotationStream(stream=sink)
+  elif args.annotation_buffering == 'none':
+    stream = annotator.StructuredAnnotationStream()
+  else:
+    stream = annotator.StructuredAnnotationStream(
+        stream=annotator.BufferedAnnotationSink(
+            strict=args.annotation_buffering == 'strict'))
+
+  # Output paths are relative to where we were invoked, not to the workdir.
+  engine_kwargs = {}
+  if args.resource_summary:
+    engine_kwargs['resource_summary_path'] = os.path.abspath(
+        args.resource_summary)
+  if args.step_cache:
+    engine_kwargs['step_cache_dir'] = os.path.abspath(args.step_cache)
+    engine_kwargs['step_cache_max_bytes'] = args.step_cache_size_mb * 1024 ** 2
+  if args.python_workers:
+    engine_kwargs['python_workers'] = args.python_workers
+  engine_kwargs['step_runner'] = args.step_runner.replace('-', '_')
+  if args.executor and step_executor.is_supported():
+    engine_kwargs['executor'] = step_executor.ensure_executor(
+        os.path.abspath(args.executor))
+  # Even without a limit of its own, the budget applies to the steps which ask
+  # for one with max_output_bytes.
+  engine_kwargs['output_budget'] = output_budget.OutputBudget(
+      args.output_budget_mb and int(args.output_budget_mb * 1024 ** 2) or None,
+      head_fraction=args.output_budget_head_fraction,
+      side_dir=args.output_budget_dir and os.path.abspath(
+          args.output_budget_dir))
+  assert args.journal or not args.resume, '--resume needs --journal'
+  if args.journal:
+    engine_kwargs['journal'] = step_journal.StepJournal(
+        os.path.abspath(args.journal), resume=args.resume)
+  trace_output = None
+  if args.trace_output:
+    trace_output = os.path.abspath(args.trace_output)
+    engine_kwargs['trace_recorder'] = trace_event.TraceRecorder()
+  profiler = None
+  if args.profile_summary or args.profile_pstats:
+    profiler = engine_profiler.OverheadProfiler(
+        use_cprofile=bool(args.profile_pstats))
+    engine_kwargs['profiler'] = profiler
+
   old_cwd = os.getcwd()
   os.chdir(workdir)
   try:
     ret = recipe_run.run_steps(
-        properties, annotator.StructuredAnnotationStream(), universe=universe)
+        properties, stream, universe=universe, **engine_kwargs)
     return ret.status_code
   finally:
+    if args.annotation_format == 'json':
+      stream.stream.close()
+    else:
+      stream.flush()
+    if event_file:
+      event_file.close()
+    if args.journal:
+      engine_kwargs['journal'].close()
+    if trace_output:
+      engine_kwargs['trace_recorder'].write(trace_output)
     os.chdir(old_cwd)
+    if args.profile_summary:
+      with open(args.profile_summary, 'w') as f:
+        f.write(profiler.format_summary())
+    if args.profile_pstats:
+      profiler.write_pstats(args.profile_pstats)
+
+
+def plan(package_deps, args):
+  from recipe_engine import loader
+  from recipe_engine import step_plan
+
+  properties = get_properties(args)
+  properties['recipe'] = args.recipe
+  recorder = step_plan.plan(get_universe(package_deps), properties)
+  if args.output and args.output != '-':
+    recorder.write(args.output)
+  else:
+    json.dump(recorder.to_json(), sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+  return 0 if recorder.status_code in (None, 0) else 1
+
+
+def zygote(package_deps, args):
+  import importlib
+  from recipe_engine import zygote as zygote_server
+
+  for name in _ZYGOTE_PRELOAD:
+    importlib.import_module('recipe_engine.' + name)
+  universe = get_universe(package_deps)
+  for path, e in universe.preload_modules():
+    logging.warning('Could not preload %s: %s', path, e)
+
+  def handle(argv):
+    command_args = parse_args(argv)
+    if command_args.verbose:
+      logging.getLogger().setLevel(logging.INFO)
+    # Recipes may have been added or removed since the zygote started.
+    universe.index.refresh()
+    return run_command(package_deps, command_args)
+
+  package = os.path.realpath(args.package)
+  zygote_server.serve(
+      os.path.abspath(args.socket), package, handle,
+      files=zygote_server.loaded_files() + [package],
+      idle_timeout=args.idle_timeout or None)
+  return 0
+
+
+def run_in_zygote(args, argv):
+  """Runs the command line |argv| in the zygote on args.zygote, starting one
+  if needed. Returns its exit code, or None if it must run in this process.
+  """
+  from recipe_engine import zygote as zygote_client
+
+  if not zygote_client.is_supported():
+    return None
+  if getattr(args, 'properties_file', None) == '-':
+    # Zygote children can't read our stdin.
+    return None
+  package = os.path.realpath(args.package)
+  socket_path = os.path.abspath(args.zygote)
+  launch_cmd = [sys.executable, os.path.abspath(__file__),
+                '--package', package]
+  if args.no_fetch:
+    launch_cmd.append('--no-fetch')
+  launch_cmd += ['zygote', socket_path]
+  client = zygote_client.ensure_zygote(socket_path, package, launch_cmd)
+  return client.run(argv)
 
 
 def roll(args):
@@ -127,14 +294,12 @@ def doc(package_deps, args):
   doc.main(package_deps)
 
 
-def main():
-  from recipe_engine import package
-
+def parse_args(argv):
   # Super-annoyingly, we need to manually parse for simulation_test since
   # argparse is bonkers and doesn't allow us to forward --help to subcommands.
-  if 'simulation_test' in sys.argv:
-    index = sys.argv.index('simulation_test')
-    sys.argv = sys.argv[:index+1] + [json.dumps(sys.argv[index+1:])]
+  if 'simulation_test' in argv:
+    index = argv.index('simulation_test')
+    argv = argv[:index+1] + [json.dumps(argv[index+1:])]
 
   parser = argparse.ArgumentParser(description='Do things with recipes.')
 
@@ -151,6 +316,14 @@ def main():
   parser.add_argument(
       '--bootstrap-script',
       help='Path to the script used to bootstrap this tool (internal use only)')
+  parser.add_argument(
+      '--zygote',
+      help='Path of a unix socket on which to talk to a zygote: a process '
+           'with the engine and every recipe module already loaded, which '
+           'forks to run %s commands. One is started there if none is '
+           'running (or if any of its files changed); it is shared by later '
+           'commands, and exits after being idle for a while.'
+           % ', '.join(ZYGOTE_COMMANDS))
 
   subp = parser.add_subparsers()
 
@@ -187,6 +360,87 @@ def main():
   run_p.add_argument(
       '--workdir',
       help='The working directory of recipe execution')
+  run_p.add_argument(
+      '--annotation-buffering', choices=('none', 'buffered', 'strict'),
+      default='none',
+      help='How annotations are written to stdout. "buffered" batches them '
+           'and flushes at step boundaries; "strict" writes each one through '
+           'immediately, preserving ordering with stderr.')
+  run_p.add_argument(
+      '--annotation-format', choices=('text', 'json'), default='text',
+      help='"text" emits @@@ annotations interleaved with step output. "json" '
+           'emits one JSON object per annotation to the event stream, and '
+           'step output on a separate channel.')
+  run_p.add_argument(
+      '--event-stream',
+      help='With --annotation-format=json, the file to write events to. '
+           'Defaults to stdout, in which case step output goes to stderr; '
+           'otherwise step output goes to stdout.')
+  run_p.add_argument(
+      '--resource-summary',
+      help='Write a JSON summary of the wall time, CPU time, memory and output '
+           'of every step to this file')
+  run_p.add_argument(
+      '--step-cache',
+      help='Directory in which to cache the results of steps run with '
+           'cacheable=True. Unchanged steps are replayed from here instead of '
+           'being run again.')
+  run_p.add_argument(
+      '--step-cache-size-mb', type=int, default=5 * 1024,
+      help='Evict the least recently used step cache entries once the cache '
+           'is larger than this (default %(default)s)')
+  run_p.add_argument(
+      '--python-workers', type=int, default=0,
+      help='Start this many python interpreters up front, and run python '
+           'steps in them instead of starting a new interpreter for each one')
+  run_p.add_argument(
+      '--step-runner', choices=('threads', 'event-loop'), default='threads',
+      help='How steps started in parallel are supervised: by a pool of '
+           'threads, or all from a single event loop thread (POSIX only)')
+  run_p.add_argument(
+      '--executor',
+      help='Path of a unix socket on which to talk to a step executor daemon, '
+           'which starts the steps\' processes instead of the engine. One is '
+           'started there if none is running; it is shared by later runs, and '
+           'exits after being idle for a while.')
+  run_p.add_argument(
+      '--output-budget-mb', type=float,
+      help='How much of each of its stdout and stderr a step may log. Beyond '
+           'that, only the start and the end of the stream are logged, and '
+           'all of it is written to a compressed side file. Steps may ask for '
+           'another limit with max_output_bytes.')
+  run_p.add_argument(
+      '--output-budget-head-fraction', type=float, default=0.5,
+      help='The share of the output budget kept from the start of a stream '
+           'which exceeds it; the rest is kept from its end '
+           '(default %(default)s)')
+  run_p.add_argument(
+      '--output-budget-dir',
+      help='Directory for the side files of streams which exceed their '
+           'output budget. Defaults to the system temporary directory.')
+  run_p.add_argument(
+      '--journal',
+      help='Checkpoint the result of every step to this file as it completes, '
+           'so that the run can be resumed from it with --resume')
+  run_p.add_argument(
+      '--resume', action='store_true',
+      help='Replay the steps recorded in the --journal by an earlier run '
+           'instead of running them again, as long as the recipe issues the '
+           'same steps, and continue live from where it diverges or ends')
+  run_p.add_argument(
+      '--trace-output',
+      help='Write a Chrome trace (for chrome://tracing or Perfetto) of the '
+           'steps, nested steps, composite steps and defer_results blocks of '
+           'the run to this file')
+  run_p.add_argument(
+      '--profile-summary',
+      help='Write a table of the time spent in recipe and module code between '
+           'steps, per module and per method, to this file')
+  run_p.add_argument(
+      '--profile-pstats',
+      help='Run RunSteps under cProfile and write its stats (in pstats '
+           'format) to this file. The --profile-summary table then also '
+           'includes cProfile self time per module.')
   run_p.add_argument(
       'recipe',
       help='The recipe to execute')
@@ -195,6 +449,27 @@ def main():
       help='A list of property pairs; e.g. mastername=chromium.linux '
            'issue=12345')
 
+  plan_p = subp.add_parser(
+      'plan',
+      help='Print the steps a recipe would run, as JSON, without running them')
+  plan_p.set_defaults(command='plan')
+  plan_p.add_argument(
+      '--properties-file',
+      help='A file containing a json blob of properties')
+  plan_p.add_argument(
+      '--properties',
+      help='A json string containing the properties')
+  plan_p.add_argument(
+      '--output', '-o',
+      help='Write the plan to this file instead of stdout')
+  plan_p.add_argument(
+      'recipe',
+      help='The recipe to plan')
+  plan_p.add_argument(
+      'props', nargs=argparse.REMAINDER,
+      help='A list of property pairs; e.g. mastername=chromium.linux '
+           'issue=12345')
+
   roll_p = subp.add_parser(
       'roll',
       help='Roll dependencies of a recipe package forward (implies fetch)')
@@ -206,15 +481,22 @@ def main():
            'various info about each')
   show_me_the_modules_p.set_defaults(command='doc')
 
-  args = parser.parse_args()
+  zygote_p = subp.add_parser(
+      'zygote',
+      help='Serve commands given --zygote (internal use only)')
+  zygote_p.set_defaults(command='zygote')
+  zygote_p.add_argument(
+      '--idle-timeout', type=float, default=30 * 60,
+      help='Exit after this many seconds without commands (default '
+           '%(default)s; 0 for never)')
+  zygote_p.add_argument(
+      'socket',
+      help='The unix socket to listen on')
 
-  if args.verbose:
-    logging.getLogger().setLevel(logging.INFO)
+  return parser.parse_args(argv)
 
-  repo_root, config_file = get_package_config(args)
-  package_deps = package.PackageDeps.create(
-      repo_root, config_file, allow_fetch=not args.no_fetch)
 
+def run_command(package_deps, args):
   if args.command == 'fetch':
     # We already did everything in the create() call above.
     assert not args.no_fetch, 'Fetch? No-fetch? Make up your mind!'
@@ -225,10 +507,14 @@ def main():
     return lint(package_deps, args)
   elif args.command == 'run':
     return run(package_deps, args)
+  elif args.command == 'plan':
+    return plan(package_deps, args)
   elif args.command == 'roll':
     return roll(args)
   elif args.command == 'doc':
     return doc(package_deps, args)
+  elif args.command == 'zygote':
+    return zygote(package_deps, args)
   else:
     print """Dear sir or madam,
         It has come to my attention that a quite impossible condition has come
@@ -247,5 +533,25 @@ def main():
 
   return 0
 
+
+def main():
+  argv = sys.argv[1:]
+  args = parse_args(argv)
+
+  if args.verbose:
+    logging.getLogger().setLevel(logging.INFO)
+
+  if args.zygote and args.command in ZYGOTE_COMMANDS:
+    ret = run_in_zygote(args, argv)
+    if ret is not None:
+      return ret
+
+  from recipe_engine import package
+  repo_root, config_file = get_package_config(args)
+  package_deps = package.PackageDeps.create(
+      repo_root, config_file, allow_fetch=not args.no_fetch)
+  return run_command(package_deps, args)
+
+
 if __name__ == '__main__':
   sys.exit(main())
@@ -64,23 +64,44 @@ iterable_of_things.
 """
 
 import collections
-import contextlib
 import copy
+import errno
 import functools
 import json
+import multiprocessing
 import os
+import Queue
+import signal
 import subprocess
 import sys
 import threading
+import time
 import traceback
 
 import cStringIO
 
+try:
+  import resource
+except ImportError:  # pragma: no cover
+  resource = None
 
+
+from . import engine_profiler
 from . import loader
+from . import log_store
+from . import output_budget
+from . import output_pump
+from . import python_worker
 from . import recipe_api
 from . import recipe_test_api
+from . import step_cache
+from . import step_env
+from . import step_loop
+from . import trace_event
 from . import util
+from .third_party import annotator
+
+from infra.libs import infra_types
 
 
 SCRIPT_PATH = os.path.dirname(os.path.abspath(__file__))
@@ -246,28 +267,25 @@ class StepPresentation(object):
     if not self._finalized:
       return self._logs
     else:
-      return copy.deepcopy(self._logs)
+      return util.ReadOnlyMapping(self._logs)
 
   @property
   def links(self):
     if not self._finalized:
       return self._links
     else:
-      return copy.deepcopy(self._links)
+      return util.ReadOnlyMapping(self._links)
 
   @property
   def perf_logs(self):
     if not self._finalized:
       return self._perf_logs
     else:
-      return copy.deepcopy(self._perf_logs)
+      return util.ReadOnlyMapping(self._perf_logs)
 
   @property
   def properties(self):  # pylint: disable=E0202
-    if not self._finalized:
-      return self._properties
-    else:
-      return copy.deepcopy(self._properties)
+    return self._properties
 
   @properties.setter
   def properties(self, val):  # pylint: disable=E0202
@@ -281,10 +299,13 @@ class StepPresentation(object):
       annotator_step.step_text(self.step_text)
     if self.step_summary_text:
       annotator_step.step_summary_text(self.step_summary_text)
-    for name, lines in self.logs.iteritems():
-      annotator_step.write_log_lines(name, lines)
-    for name, lines in self.perf_logs.iteritems():
-      annotator_step.write_log_lines(name, lines, perf=True)
+    # Logs are read-only from now on; big ones are moved out of memory as they
+    # are written.
+    for logs, perf in ((self._logs, None), (self._perf_logs, True)):
+      for name, lines in logs.items():
+        spooler = log_store.LogSpooler(lines)
+        annotator_step.write_log_lines(name, spooler, perf=perf)
+        logs[name] = spooler.view()
     for label, url in self.links.iteritems():
       annotator_step.step_link(label, url)
     status_mapping = {
@@ -295,6 +316,7 @@ class StepPresentation(object):
     status_mapping.get(self.status, lambda: None)()
     for key, value in self._properties.iteritems():
       annotator_step.set_build_property(key, json.dumps(value, sort_keys=True))
+    self._properties = infra_types.freeze(self._properties)
 
 
 class StepDataAttributeError(AttributeError):
@@ -307,22 +329,55 @@ class StepDataAttributeError(AttributeError):
     super(StepDataAttributeError, self).__init__(message)
 
 
+# Resources consumed by a single step's process (and any of its descendants
+# which it waited for). Times are in seconds, max_rss in kilobytes. The rusage
+# fields are None where the platform can't report them (e.g. Windows).
+ResourceUsage = collections.namedtuple(
+    'ResourceUsage',
+    'wall_time user_time system_time max_rss block_input block_output '
+    'stdout_bytes stderr_bytes')
+
+
 class StepData(object):
-  def __init__(self, step, retcode):
+  def __init__(self, step, retcode, resource_usage=None):
     self._retcode = retcode
     self._step = step
+    self._step_copy = None
+    self._resource_usage = resource_usage
 
     self._presentation = StepPresentation()
     self.abort_reason = None
 
   @property
   def step(self):
-    return copy.deepcopy(self._step)
+    """A mutable copy of the step.
+
+    The copy is made the first time it's read, and the same copy is returned
+    from then on. Changing it doesn't change the engine's record of the step.
+    """
+    if self._step_copy is None:
+      if isinstance(self._step, infra_types.FrozenDict):
+        self._step_copy = infra_types.thaw(self._step)
+      else:
+        self._step_copy = copy.deepcopy(self._step)
+    return self._step_copy
+
+  def _freeze(self):
+    """Replaces the step with an immutable record, which the step history
+    shares, and returns it. Called by the engine once nothing can change the
+    step any more."""
+    self._step = infra_types.freeze(self._step)
+    return self._step
 
   @property
   def retcode(self):
     return self._retcode
 
+  @property
+  def resource_usage(self):
+    """ResourceUsage of the step's process, or None if nothing was run."""
+    return self._resource_usage
+
   @property
   def presentation(self):
     return self._presentation
@@ -414,11 +469,14 @@ RecipeExecutionResult = collections.namedtuple(
 def run_steps(properties,
               stream,
               universe,
-              test_data=recipe_test_api.DisabledTestData()):
+              test_data=recipe_test_api.DisabledTestData(),
+              **engine_kwargs):
   """Returns a tuple of (status_code, steps_ran).
 
   Only one of these values will be set at a time. This is mainly to support the
   testing interface used by unittests/recipes_test.py.
+
+  |engine_kwargs| are passed through to RecipeEngine.
   """
   stream.honor_zero_return_code()
 
@@ -442,7 +500,7 @@ def run_steps(properties,
     'TESTING_SLAVENAME' in os.environ)):
     properties['use_mirror'] = False
 
-  engine = RecipeEngine(stream, properties, test_data)
+  engine = RecipeEngine(stream, properties, test_data, **engine_kwargs)
 
   # Create all API modules and top level RunSteps function.  It doesn't launch
   # any recipe code yet; RunSteps needs to be called.
@@ -479,8 +537,9 @@ def run_steps(properties,
       prop_defs = recipe_module.PROPERTIES
 
       api = loader.create_recipe_api(recipe_module.LOADED_DEPS,
-                                            engine,
-                                            test_data)
+                                     engine,
+                                     test_data,
+                                     universe=universe)
 
       s.step_text('<br/>running recipe: "%s"' % recipe)
     except loader.NoSuchRecipe as e:
@@ -493,27 +552,6 @@ def run_steps(properties,
   return engine.run(recipe_module.RunSteps, api, prop_defs)
 
 
-def _merge_envs(original, override):
-  """Merges two environments.
-
-  Returns a new environment dict with entries from |override| overwriting
-  corresponding entries in |original|. Keys whose value is None will completely
-  remove the environment variable. Values can contain %(KEY)s strings, which
-  will be substituted with the values from the original (useful for amending, as
-  opposed to overwriting, variables like PATH).
-  """
-  result = original.copy()
-  if not override:
-    return result
-  for k, v in override.items():
-    if v is None:
-      if k in result:
-        del result[k]
-    else:
-      result[str(k)] = str(v) % original
-  return result
-
-
 def _print_step(step, env, stream):
   """Prints the step command and relevant metadata.
 
@@ -538,23 +576,6 @@ def _print_step(step, env, stream):
   stream.emit('\n'.join(step_info_lines))
 
 
-@contextlib.contextmanager
-def _modify_lookup_path(path):
-  """Places the specified path into os.environ.
-
-  Necessary because subprocess.Popen uses os.environ to perform lookup on the
-  supplied command, and only uses the |env| kwarg for modifying the environment
-  of the child process.
-  """
-  saved_path = os.environ['PATH']
-  try:
-    if path is not None:
-      os.environ['PATH'] = path
-    yield
-  finally:
-    os.environ['PATH'] = saved_path
-
-
 def _normalize_change(change):
   assert isinstance(change, dict), 'Change is not a dict'
   change = change.copy()
@@ -587,13 +608,411 @@ def _trigger_builds(step, trigger_specs):
     }, sort_keys=True))
 
 
-def _run_annotated_step(
+def _wait_with_rusage(proc):
+  """Waits for |proc| to exit.
+
+  Returns the resource.struct_rusage of the process, or None if the platform
+  can't report it.
+  """
+  if not isinstance(proc, subprocess.Popen):
+    # python_worker.WorkerProcess and step_executor.ExecutorProcess report
+    # their own rusage.
+    return proc.wait()
+  if not hasattr(os, 'wait4'):
+    proc.wait()
+    return None
+  while True:
+    try:
+      _, status, rusage = os.wait4(proc.pid, 0)
+      break
+    except OSError as e:
+      if e.errno != errno.EINTR:
+        raise
+  # The process is reaped, so Popen can no longer wait() for it; record its
+  # returncode the way Popen would.
+  if os.WIFSIGNALED(status):
+    proc.returncode = -os.WTERMSIG(status)
+  else:
+    proc.returncode = os.WEXITSTATUS(status)
+  return rusage
+
+
+def _resource_usage(wall_time, rusage, byte_counts):
+  max_rss = user_time = system_time = block_input = block_output = None
+  if rusage is not None:
+    user_time = rusage.ru_utime
+    system_time = rusage.ru_stime
+    # ru_maxrss is in bytes on OS X, and in kilobytes everywhere else.
+    max_rss = rusage.ru_maxrss
+    if sys.platform == 'darwin':
+      max_rss /= 1024
+    block_input = rusage.ru_inblock
+    block_output = rusage.ru_oublock
+  return ResourceUsage(
+      wall_time=wall_time, user_time=user_time, system_time=system_time,
+      max_rss=max_rss, block_input=block_input, block_output=block_output,
+      stdout_bytes=byte_counts.get('stdout', 0),
+      stderr_bytes=byte_counts.get('stderr', 0))
+
+
+# Seconds between asking a timed out step's process group to terminate, and
+# killing it.
+TIMEOUT_GRACE_PERIOD = 30
+
+
+def _signal_process_group(proc, sig):
+  """Sends |sig| to the process group led by |proc| (POSIX), or kills |proc|
+  (Windows, where there is nothing gentler)."""
+  try:
+    if sys.platform.startswith('win'):
+      proc.kill()
+    else:
+      os.killpg(proc.pid, sig)
+  except OSError as e:
+    if e.errno != errno.ESRCH:
+      raise
+
+
+class _StepWatchdog(object):
+  """Terminates a step whose process runs past |timeout| seconds, or which
+  produces no output for |no_output_timeout| seconds.
+
+  Sets |timed_out| to 'timeout' or 'no_output_timeout' if it fires.
+  """
+
+  def __init__(self, proc, timeout, no_output_timeout,
+               grace_period=TIMEOUT_GRACE_PERIOD):
+    self._proc = proc
+    self._timeout = timeout
+    self._no_output_timeout = no_output_timeout
+    self._grace_period = grace_period
+    self._stopped = threading.Event()
+    self._start = self._last_output = time.time()
+    self._thread = None
+    self.timed_out = None
+
+  def start(self):
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def output_seen(self):
+    self._last_output = time.time()
+
+  def stop(self):
+    self._stopped.set()
+    self._thread.join()
+
+  def _run(self):
+    while not self._stopped.is_set():
+      deadlines = []
+      if self._timeout:
+        deadlines.append((self._start + self._timeout, 'timeout'))
+      if self._no_output_timeout:
+        deadlines.append(
+            (self._last_output + self._no_output_timeout, 'no_output_timeout'))
+      deadline, kind = min(deadlines)
+      now = time.time()
+      if now < deadline:
+        self._stopped.wait(deadline - now)
+        continue
+
+      self.timed_out = kind
+      _signal_process_group(self._proc, signal.SIGTERM)
+      if not self._stopped.wait(self._grace_period):
+        _signal_process_group(self._proc, getattr(signal, 'SIGKILL', None))
+      return
+
+
+# Serializes Popen across worker threads, so that the child's ends of one step's
+# pipes (open in the engine until its Popen returns) can't leak into another
+# step's process and hold its output open.
+_POPEN_LOCK = threading.Lock()
+
+
+def _start_process(cmd, cwd, env, step_dict, executable=None,
+                   new_process_group=False, resource_limits=None):
+  """Starts |cmd|, with stdio redirected to the files named by step_dict's
+  'stdin', 'stdout' and 'stderr', and piped otherwise.
+
+  If |new_process_group| is set, the process leads a new process group, which
+  _signal_process_group can terminate as a whole. Otherwise it stays in the
+  engine's, so that e.g. Ctrl-C reaches it too.
+
+  |resource_limits| maps names of resource.RLIMIT_* constants to the (soft and
+  hard) limit to set in the process. Ignored on Windows.
+
+  |executable| is the path of |cmd|'s program, already resolved against the
+  step's PATH (see step_env), since Popen would search the engine's PATH rather
+  than the step's. argv[0] stays as the step gave it.
+
+  Returns the subprocess.Popen.
+  """
+  # Open file handles for IO redirection based on file names in step_dict.
+  fhandles = {
+    'stdout': subprocess.PIPE,
+    'stderr': subprocess.PIPE,
+    'stdin': None,
+  }
+  for key in fhandles:
+    if key in step_dict:
+      fhandles[key] = open(step_dict[key],
+                           'rb' if key == 'stdin' else 'wb')
+
+  if sys.platform.startswith('win'):
+    # Windows has a bad habit of opening a dialog when a console program
+    # crashes, rather than just letting it crash.  Therefore, when a program
+    # crashes on Windows, we don't find out until the build step times out.
+    # This code prevents the dialog from appearing, so that we find out
+    # immediately and don't waste time waiting for a user to close the
+    # dialog.
+    import ctypes
+    # SetErrorMode(SEM_NOGPFAULTERRORBOX). For more information, see:
+    # https://msdn.microsoft.com/en-us/library/windows/desktop/ms680621.aspx
+    ctypes.windll.kernel32.SetErrorMode(0x0002)
+    # CREATE_NO_WINDOW. For more information, see:
+    # https://msdn.microsoft.com/en-us/library/windows/desktop/ms684863.aspx
+    creationflags = 0x8000000
+    if new_process_group:
+      # CREATE_NEW_PROCESS_GROUP
+      creationflags |= 0x200
+    preexec_fn = None
+  else:
+    creationflags = 0
+    # preexec_fn isn't safe while other threads run, so only use it when the
+    # step needs its own group, or limits.
+    preexec_fn = None
+    if new_process_group or resource_limits:
+      def preexec_fn():
+        if new_process_group:
+          os.setpgrp()
+        for limit_name, limit in (resource_limits or {}).iteritems():
+          resource.setrlimit(getattr(resource, limit_name), (limit, limit))
+
+  with _POPEN_LOCK:
+    proc = subprocess.Popen(
+        cmd,
+        executable=executable,
+        env=env,
+        cwd=cwd,
+        universal_newlines=True,
+        creationflags=creationflags,
+        preexec_fn=preexec_fn,
+        **fhandles)
+
+  # Safe to close file handles now that subprocess has inherited them.
+  for handle in fhandles.itervalues():
+    if isinstance(handle, file):
+      handle.close()
+  return proc
+
+
+# Outcome of running a step's command; see _run_annotated_step.
+# truncated_output maps 'stdout' and 'stderr' to the output_budget.Truncation of
+# each stream which was cut short.
+ExecutionResult = collections.namedtuple(
+    'ExecutionResult', 'retcode resource_usage timed_out truncated_output')
+
+
+class _LaunchedStep(object):
+  """A step whose annotations have begun, and whose command is running as
+  |proc| (None if there was nothing to run, or the result was restored from
+  the step cache).
+
+  Produced by _launch_annotated_step. The process is then supervised, either
+  by supervise() on the calling thread or by a step_loop.StepLoop, and
+  finish() completes the step's annotations.
+  """
+
+  def __init__(self, annotation, trigger_specs, returncode=0, proc=None,
+               keys=(), pairs=(), allow_subannotations=False, timeout=None,
+               no_output_timeout=None, start_time=None, bounded=None):
+    self.annotation = annotation
+    self.trigger_specs = trigger_specs
+    self.returncode = returncode
+    self.proc = proc
+    self.keys = keys
+    self.pairs = pairs
+    self.allow_subannotations = allow_subannotations
+    self.timeout = timeout
+    self.no_output_timeout = no_output_timeout
+    self.start_time = start_time
+    # 'stdout'/'stderr' -> output_budget.BoundedOutput
+    self.bounded = bounded or {}
+
+  def process(self):
+    """Returns the step_loop.StepProcess to supervise, or None."""
+    if self.proc is None:
+      return None
+    return step_loop.StepProcess(
+        self.proc, self.pairs, self.allow_subannotations, self.timeout,
+        self.no_output_timeout)
+
+  def supervise(self):
+    """Pumps the process's output and waits for it to exit, enforcing its
+    timeouts, from the calling thread.
+
+    Returns a tuple of (byte_counts, rusage, timed_out), as finish() takes.
+    """
+    watchdog = None
+    if self.timeout or self.no_output_timeout:
+      watchdog = _StepWatchdog(self.proc, self.timeout, self.no_output_timeout)
+      watchdog.start()
+    try:
+      # Pump piped stdio to our own stdio. IO going to files on disk is not
+      # filtered.
+      byte_counts = output_pump.pump(
+          self.pairs, self.allow_subannotations,
+          on_output=watchdog and watchdog.output_seen)
+      rusage = _wait_with_rusage(self.proc)
+    except OSError:
+      self.annotation.step_exception_occured(*sys.exc_info())
+      raise
+    finally:
+      if watchdog:
+        watchdog.stop()
+    return byte_counts, rusage, watchdog and watchdog.timed_out
+
+  def finish(self, byte_counts=None, rusage=None, timed_out=None):
+    """Returns a tuple of (step annotation, ExecutionResult) for the step, once
+    its process (if any) has exited."""
+    returncode = self.returncode
+    usage = None
+    if self.proc is not None:
+      returncode = self.proc.returncode
+      usage = _resource_usage(
+          time.time() - self.start_time, rusage,
+          dict(zip(self.keys, byte_counts)))
+      self.annotation.write_log_lines(
+          'resource_usage',
+          json.dumps(usage._asdict(), indent=2, separators=(',', ': '),
+                     sort_keys=True).splitlines())
+
+    truncated = {}
+    for key, bounded in sorted(self.bounded.iteritems()):
+      truncation = bounded.close()
+      if truncation:
+        truncated[key] = truncation
+
+    # TODO(martiniss) move logic into own module?
+    if self.trigger_specs:
+      _trigger_builds(self.annotation, self.trigger_specs)
+
+    return self.annotation, ExecutionResult(
+        returncode, usage, timed_out, truncated)
+
+
+def _launch_annotated_step(
     stream, name, cmd, cwd=None, env=None, allow_subannotations=False,
-    trigger_specs=None, nest_level=0, **kwargs):
+    trigger_specs=None, timeout=None, no_output_timeout=None, nest_level=0,
+    output_handle=None, cache_entry=None, python_workers=None, executor=None,
+    environment=None, output_budget=None, resource_limits=None, **kwargs):
+  """Begins a step's annotations and starts its command.
+
+  Takes the same arguments as _run_annotated_step, and returns a
+  _LaunchedStep.
+  """
+  if isinstance(cmd, basestring):
+    cmd = (cmd,)
+  cmd = map(str, cmd)
+
+  # For error reporting.
+  step_dict = kwargs.copy()
+  step_dict.update({
+      'name': name,
+      'cmd': cmd,
+      'cwd': cwd,
+      'env': env,
+      'allow_subannotations': allow_subannotations,
+      })
+  environment = environment or step_env.StepEnvironment()
+  proc_env = environment.merge(env)
+  if 'stdout' in kwargs and 'stderr' in kwargs:
+    # None of the step's output is piped, so the engine would never see any.
+    no_output_timeout = None
+
+  step_annotation = stream.step(name)
+  step_annotation.step_started()
+
+  if nest_level:
+    step_annotation.step_nest_level(nest_level)
+
+  _print_step(step_dict, proc_env, stream)
+  # Annotations must reach the stream before any of the step's own output.
+  stream.flush()
+  if not cmd:
+    return _LaunchedStep(step_annotation, trigger_specs)
+  if cache_entry is not None and cache_entry.restore(
+      output_handle or sys.stdout, output_handle or sys.stderr):
+    stream.emit('step result restored from cache (%s)' % cache_entry.key)
+    return _LaunchedStep(step_annotation, trigger_specs, cache_entry.retcode)
+
+  try:
+    start_time = time.time()
+    if (python_workers is not None and not resource_limits and
+        python_worker.can_run(cmd, env)):
+      argv, unbuffered = python_worker.parse_command(cmd)
+      proc = python_workers.start(
+          argv, unbuffered, cwd or os.getcwd(), proc_env,
+          stdin=step_dict.get('stdin'), stdout=step_dict.get('stdout'),
+          stderr=step_dict.get('stderr'))
+    elif executor is not None:
+      proc = executor.start(
+          cmd, cwd or os.getcwd(), proc_env, stdin=step_dict.get('stdin'),
+          stdout=step_dict.get('stdout'), stderr=step_dict.get('stderr'),
+          limits=resource_limits,
+          executable=environment.resolve_executable(cmd, proc_env))
+    else:
+      proc = _start_process(
+          cmd, cwd, proc_env, step_dict,
+          executable=environment.resolve_executable(cmd, proc_env),
+          new_process_group=bool(timeout or no_output_timeout),
+          resource_limits=resource_limits)
+  except OSError:
+    # File wasn't found, error will be reported to stream when the exception
+    # crosses the context manager.
+    step_annotation.step_exception_occured(*sys.exc_info())
+    raise
+
+  keys = [k for k in ('stdout', 'stderr') if k not in step_dict]
+  pairs = [(getattr(proc, k), output_handle or getattr(sys, k)) for k in keys]
+  if cache_entry is not None:
+    pairs = [(inhandle, cache_entry.tee(k, outhandle))
+             for k, (inhandle, outhandle) in zip(keys, pairs)]
+  bounded = {}
+  if output_budget is not None:
+    # Outermost, so that the step cache only records what was logged.
+    for i, (k, (inhandle, outhandle)) in enumerate(zip(keys, pairs)):
+      wrapped = output_budget.wrap(outhandle, name, k)
+      if wrapped is not outhandle:
+        bounded[k] = wrapped
+        pairs[i] = (inhandle, wrapped)
+  return _LaunchedStep(
+      step_annotation, trigger_specs, proc=proc, keys=keys, pairs=pairs,
+      allow_subannotations=allow_subannotations, timeout=timeout,
+      no_output_timeout=no_output_timeout, start_time=start_time,
+      bounded=bounded)
+
+
+def _run_annotated_step(stream, name, cmd, **kwargs):
   """Runs a single step.
 
   Context:
     stream: StructuredAnnotationStream to use to emit step
+    output_handle: file-like object which receives the step's piped stdout and
+        stderr. Defaults to sys.stdout and sys.stderr respectively.
+    cache_entry: step_cache.CacheEntry for the step. If it holds a result, the
+        result is replayed instead of running |cmd|; otherwise the step's
+        piped output is recorded in it.
+    python_workers: python_worker.WorkerPool to run the step in, if |cmd| is a
+        python script which can run there.
+    executor: step_executor.ExecutorClient to start the step's process with,
+        instead of starting it from the engine.
+    environment: step_env.StepEnvironment to build the step's environment
+        from, and to find its executable with. Defaults to a snapshot of
+        os.environ.
+    output_budget: output_budget.OutputBudget bounding how much of the step's
+        piped output is written to the output handles.
 
   Step parameters:
     name: name of the step, will appear in buildbots waterfall
@@ -604,6 +1023,12 @@ def _run_annotated_step(
     trigger_specs: a list of trigger specifications, which are dict with keys:
         properties: a dict of properties.
             Buildbot requires buildername property.
+    timeout: seconds the command may run for before it's killed
+    no_output_timeout: seconds the command may go without producing output
+        before it's killed. Ignored if both stdout and stderr are redirected
+        to files.
+    resource_limits: dict of resource.RLIMIT_* names to the limit to set in
+        the command's process (POSIX only).
 
   Known kwargs:
     stdout: Path to a file to put step stdout into. If used, stdout won't appear
@@ -612,118 +1037,155 @@ def _run_annotated_step(
             in annotator's stderr.
     stdin: Path to a file to read step stdin from.
 
-  Returns the returncode of the step.
+  Returns a tuple of (step annotation, ExecutionResult). The ResourceUsage is
+  None if there was no command to run, timed_out is None unless the
+  command was killed for exceeding |timeout| ('timeout') or
+  |no_output_timeout| ('no_output_timeout'), and truncated_output lists the
+  streams which exceeded |output_budget|.
   """
-  if isinstance(cmd, basestring):
-    cmd = (cmd,)
-  cmd = map(str, cmd)
+  launched = _launch_annotated_step(stream, name, cmd, **kwargs)
+  if launched.proc is None:
+    return launched.finish()
+  return launched.finish(*launched.supervise())
 
-  # For error reporting.
-  step_dict = kwargs.copy()
-  step_dict.update({
-      'name': name,
-      'cmd': cmd,
-      'cwd': cwd,
-      'env': env,
-      'allow_subannotations': allow_subannotations,
-      })
-  step_env = _merge_envs(os.environ, env)
 
-  step_annotation = stream.step(name)
-  step_annotation.step_started()
+def _placeholder_files(placeholders):
+  """Returns (input_paths, output_paths): the files behind the input and
+  output placeholders of a step, in a stable order.
 
-  if nest_level:
-    step_annotation.step_nest_level(nest_level)
+  Returns None if the step uses a placeholder whose files aren't accounted
+  for by its cache_role.
+  """
+  used = []
+  for module_name in sorted(placeholders.cmd):
+    pholders = placeholders.cmd[module_name]
+    for placeholder_name in sorted(pholders):
+      used.extend(ph for ph, _ in pholders[placeholder_name])
+  for key in ('stdin', 'stdout', 'stderr'):
+    ph, _ = getattr(placeholders, key)
+    if ph:
+      used.append(ph)
+
+  inputs = []
+  outputs = []
+  for ph in used:
+    if ph.cache_role == 'input':
+      inputs.append(ph.backing_file)
+    elif ph.cache_role == 'output':
+      outputs.append(ph.backing_file)
+    else:
+      return None
+  return inputs, outputs
 
-  _print_step(step_dict, step_env, stream)
-  returncode = 0
-  if cmd:
-    try:
-      # Open file handles for IO redirection based on file names in step_dict.
-      fhandles = {
-        'stdout': subprocess.PIPE,
-        'stderr': subprocess.PIPE,
-        'stdin': None,
-      }
-      for key in fhandles:
-        if key in step_dict:
-          fhandles[key] = open(step_dict[key],
-                               'rb' if key == 'stdin' else 'wb')
-
-      if sys.platform.startswith('win'):
-        # Windows has a bad habit of opening a dialog when a console program
-        # crashes, rather than just letting it crash.  Therefore, when a program
-        # crashes on Windows, we don't find out until the build step times out.
-        # This code prevents the dialog from appearing, so that we find out
-        # immediately and don't waste time waiting for a user to close the
-        # dialog.
-        import ctypes
-        # SetErrorMode(SEM_NOGPFAULTERRORBOX). For more information, see:
-        # https://msdn.microsoft.com/en-us/library/windows/desktop/ms680621.aspx
-        ctypes.windll.kernel32.SetErrorMode(0x0002)
-        # CREATE_NO_WINDOW. For more information, see:
-        # https://msdn.microsoft.com/en-us/library/windows/desktop/ms684863.aspx
-        creationflags = 0x8000000
-      else:
-        creationflags = 0
-
-      with _modify_lookup_path(step_env.get('PATH')):
-        proc = subprocess.Popen(
-            cmd,
-            env=step_env,
-            cwd=cwd,
-            universal_newlines=True,
-            creationflags=creationflags,
-            **fhandles)
-
-      # Safe to close file handles now that subprocess has inherited them.
-      for handle in fhandles.itervalues():
-        if isinstance(handle, file):
-          handle.close()
-
-      outlock = threading.Lock()
-      def filter_lines(lock, allow_subannotations, inhandle, outhandle):
-        while True:
-          line = inhandle.readline()
-          if not line:
-            break
-          lock.acquire()
-          try:
-            if not allow_subannotations and line.startswith('@@@'):
-              outhandle.write('!')
-            outhandle.write(line)
-            outhandle.flush()
-          finally:
-            lock.release()
-
-      # Pump piped stdio through filter_lines. IO going to files on disk is
-      # not filtered.
-      threads = []
-      for key in ('stdout', 'stderr'):
-        if fhandles[key] == subprocess.PIPE:
-          inhandle = getattr(proc, key)
-          outhandle = getattr(sys, key)
-          threads.append(threading.Thread(
-              target=filter_lines,
-              args=(outlock, allow_subannotations, inhandle, outhandle)))
-
-      for th in threads:
-        th.start()
-      proc.wait()
-      for th in threads:
-        th.join()
-      returncode = proc.returncode
-    except OSError:
-      # File wasn't found, error will be reported to stream when the exception
-      # crosses the context manager.
-      step_annotation.step_exception_occured(*sys.exc_info())
-      raise
 
-  # TODO(martiniss) move logic into own module?
-  if trigger_specs:
-    _trigger_builds(step_annotation, trigger_specs)
+# A step which has been rendered and recorded in the step history, but which
+# has not necessarily run yet. Produced by RecipeEngine._prepare_step.
+PreparedStep = collections.namedtuple(
+    'PreparedStep',
+    'step ok_ret infra_step nest_level step_test placeholders journal_entry')
+
+
+class StepFuture(object):
+  """Handle to a step started by RecipeEngine.run_steps_parallel.
+
+  The step runs on the engine's worker pool, or its StepLoop. Its annotations
+  and output are collected into a private buffer. Once the step has finished,
+  the engine writes the buffer out to the annotation stream as soon as no
+  other step is open there (see RecipeEngine._flush_finished_steps); the
+  annotations of the step's presentation follow when it is collected.
+  """
+
+  def __init__(self, engine, prepared):
+    self._engine = engine
+    self._prepared = prepared
+    self._finished = threading.Event()
+    self._collected = False
+
+    self._buffer = None
+    self._flushed = False
+    self._annotation = None
+    self._execution = None
+    self._exc_info = None
+
+    self._result = None
+    self._result_exc_info = None
+
+  @property
+  def name(self):
+    return self._prepared.step['name']
+
+  def done(self):
+    """Returns True if the step's process has exited."""
+    return self._finished.is_set()
+
+  def result(self):
+    """Blocks until the step has finished, and returns its StepData.
+
+    The step becomes the engine's active result, exactly as if it had just been
+    run by api.step. Raises StepFailure (or a subclass) if the step failed.
+    Later calls return the same result, or raise the same exception.
+    """
+    if not self._collected:
+      self._collected = True
+      try:
+        self._result = self._engine._collect_step(self)  # pylint: disable=W0212
+      except:
+        self._result_exc_info = sys.exc_info()
+        raise
+    if self._result_exc_info is not None:
+      exc_type, exc_value, tb = self._result_exc_info
+      raise exc_type, exc_value, tb
+    return self._result
+
+  def _run(self, start_fn):
+    try:
+      self._annotation, self._execution = start_fn()
+    except Exception:  # pylint: disable=W0703
+      self._exc_info = sys.exc_info()
+    finally:
+      self._set_finished()
+
+  def _fail(self, exc_info):
+    self._exc_info = exc_info
+    self._set_finished()
+
+  def _set_finished(self):
+    steps_finished = self._engine._steps_finished  # pylint: disable=W0212
+    with steps_finished:
+      self._finished.set()
+      steps_finished.notify_all()
+
+
+class _StepWorkerPool(object):
+  """A bounded pool of daemon threads which run queued callables."""
+
+  def __init__(self, max_workers):
+    self._max_workers = max_workers
+    self._queue = Queue.Queue()
+    self._threads = []
+
+  def submit(self, fn):
+    if len(self._threads) < self._max_workers:
+      th = threading.Thread(target=self._worker)
+      th.daemon = True
+      th.start()
+      self._threads.append(th)
+    self._queue.put(fn)
+
+  def _worker(self):
+    while True:
+      fn = self._queue.get()
+      if fn is None:
+        return
+      fn()
+
+  def shutdown(self):
+    for _ in self._threads:
+      self._queue.put(None)
+    for th in self._threads:
+      th.join()
+    self._threads = []
 
-  return step_annotation, returncode
 
 class RecipeEngine(object):
   """
@@ -737,7 +1199,53 @@ class RecipeEngine(object):
     * step - uses engine.create_step(...).
 
   """
-  def __init__(self, stream, properties, test_data):
+  def __init__(self, stream, properties, test_data, max_parallel_steps=None,
+               resource_summary_path=None, step_cache_dir=None,
+               step_cache_max_bytes=step_cache.DEFAULT_MAX_BYTES,
+               python_workers=0, trace_recorder=None,
+               profiler=None, step_runner='threads', executor=None,
+               plan_recorder=None, journal=None, output_budget=None):
+    """
+    Args:
+      stream: StructuredAnnotationStream to emit the build's annotations to.
+      properties: dict of build properties.
+      test_data: TestData for simulation tests, or DisabledTestData.
+      max_parallel_steps: Size of the worker pool used by run_steps_parallel.
+          Defaults to the number of CPUs, or to no limit with the event_loop
+          step runner.
+      resource_summary_path: If set, a JSON summary of the resources used by
+          every step is written here at the end of run().
+      step_cache_dir: If set, results of steps run with cacheable=True are
+          cached in this directory, and replayed when the same step runs again.
+      step_cache_max_bytes: Size beyond which the least recently used entries
+          of the step cache are evicted.
+      python_workers: If non-zero, this many python interpreters are started
+          up front, and steps which run 'python [-u] <script>' are run in them
+          rather than in a new interpreter, unless they ask for
+          fresh_process=True.
+      trace_recorder: If set, a trace_event.TraceRecorder which records the
+          time spent in every step, nested step, composite step and
+          defer_results block.
+      profiler: If set, an engine_profiler.OverheadProfiler which runs
+          RunSteps, and measures the time spent in recipe and module code
+          between steps.
+      step_runner: How run_steps_parallel supervises steps. 'threads' uses a
+          pool of worker threads (plus output and watchdog threads for each
+          step); 'event_loop' supervises every step from a single
+          step_loop.StepLoop thread. POSIX only, falls back to 'threads'
+          elsewhere.
+      executor: If set, a step_executor.ExecutorClient which starts the
+          processes of steps (other than those run by python_workers) in an
+          executor daemon, rather than forking them from the engine.
+      plan_recorder: If set, a step_plan.PlanRecorder which records every
+          step as it is rendered.
+      journal: If set, a step_journal.StepJournal to which every completed
+          step is checkpointed, and from which the steps of a resumed run are
+          replayed.
+      output_budget: If set, an output_budget.OutputBudget bounding how much
+          output each step may log. Steps can ask for another limit with
+          max_output_bytes.
+    """
     self._stream = stream
     self._properties = properties
     self._test_data = test_data
@@ -745,8 +1253,45 @@ class RecipeEngine(object):
 
     self._previous_step_annotation = None
     self._previous_step_result = None
+    self._previous_step_buffer = None
     self._api = None
 
+    self._max_parallel_steps = (
+        max_parallel_steps or multiprocessing.cpu_count())
+    self._worker_pool = None
+    self._use_step_loop = (
+        step_runner == 'event_loop' and step_loop.is_supported())
+    self._step_loop_max_children = max_parallel_steps
+    self._step_loop = None
+    self._pending_futures = []
+    # Notified whenever one of the _pending_futures finishes.
+    self._steps_finished = threading.Condition()
+
+    self._resource_summary_path = resource_summary_path
+    self._resource_usage = collections.OrderedDict()
+
+    self._step_cache = None
+    if step_cache_dir:
+      self._step_cache = step_cache.StepCache(
+          step_cache_dir, step_cache_max_bytes)
+
+    # Started by run(), once the environment has been isolated, so that the
+    # workers' interpreters start up in the same environment as steps' do.
+    self._python_workers = None
+    self._python_worker_count = 0
+    if (python_workers and not self._test_data.enabled and
+        python_worker.is_supported()):
+      self._python_worker_count = python_workers
+
+    self._trace_recorder = trace_recorder
+    self._executor = None if self._test_data.enabled else executor
+    self._profiler = profiler
+    self._plan_recorder = plan_recorder
+    self._journal = None if self._test_data.enabled else journal
+    self._output_budget = output_budget
+    # Snapshotted by run(), once the environment has been isolated.
+    self._environment = None
+
   @property
   def properties(self):
     return self._properties
@@ -760,13 +1305,20 @@ class RecipeEngine(object):
     """Internal helper used to emit results."""
     annotation = self._previous_step_annotation
     step_result = self._previous_step_result
+    buf = self._previous_step_buffer
 
     self._previous_step_annotation = None
     self._previous_step_result = None
+    self._previous_step_buffer = None
 
     if not annotation or not step_result:
       return
 
+    if buf is not None:
+      # The step's start and output may already have been written out,
+      # followed by other steps'.
+      annotation.annotation_stream.step_cursor(
+          annotation.annotation_stream.current_step)
     step_result.presentation.finalize(annotation)
     if self._test_data.enabled:
       val = annotation.stream.getvalue()
@@ -779,15 +1331,34 @@ class RecipeEngine(object):
         step_result._step['~followup_annotations'] = lines
     annotation.step_ended()
 
-  def run_step(self, step):
+    # pylint: disable=w0212
+    step = step_result._freeze()
+    self._step_history[step['name']] = step
+
+    if buf is not None:
+      # Steps run in parallel annotate into a private buffer; emit the rest
+      # of it now that the step is complete.
+      self._stream.write_buffer(buf)
+
+  def _flush_finished_steps(self):
+    """Writes out the buffers of parallel steps which have finished, without
+    waiting for the recipe to collect them.
+
+    Only called from the recipe's thread while no step is open on the engine's
+    stream: the buffers' annotations move the stream's cursor, so writing
+    one in the middle of another step would credit the rest of that step to
+    the parallel one.
     """
-    Runs a step.
+    # pylint: disable=W0212
+    for future in self._pending_futures:
+      if future.done() and not future._flushed:
+        future._flushed = True
+        self._stream.write_buffer(future._buffer)
 
-    Args:
-      step: The step to run.
+  def _prepare_step(self, step):
+    """Renders |step| and records it in the step history.
 
-    Returns:
-      A StepData object containing the result of running the step.
+    Returns a PreparedStep.
     """
     ok_ret = step.pop('ok_ret')
     infra_step = step.pop('infra_step')
@@ -799,41 +1370,197 @@ class RecipeEngine(object):
     placeholders = render_step(step, step_test)
 
     self._step_history[step['name']] = step
-    self._emit_results()
+    prepared = PreparedStep(
+        step, ok_ret, infra_step, nest_level, step_test, placeholders,
+        self._journal_entry(step, placeholders))
+    if self._plan_recorder is not None:
+      self._plan_recorder.add(prepared)
+    return prepared
 
-    step_result = None
+  def _start_step(self, prepared, stream, output_handle=None):
+    """Runs (or, in simulation, pretends to run) a prepared step.
 
+    Returns a tuple of (annotation, ExecutionResult).
+    """
+    recorder = self._trace_recorder
+    if recorder is None:
+      return self._execute_step(prepared, stream, output_handle)
+    start = recorder.now()
+    annotation, execution = self._execute_step(prepared, stream, output_handle)
+    self._record_step(prepared, start, execution)
+    return annotation, execution
+
+  def _record_step(self, prepared, start, execution):
+    """Records a step which started at |start| and just finished in the trace
+    recorder."""
+    recorder = self._trace_recorder
+    recorder.complete(
+        prepared.step['name'], 'step', start, recorder.now(),
+        {'cmd': map(str, prepared.step['cmd']), 'retcode': execution.retcode})
+
+  def _execute_step(self, prepared, stream, output_handle):
+    step = prepared.step
     if not self._test_data.enabled:
-      self._previous_step_annotation, retcode = _run_annotated_step(
-        self._stream, nest_level=nest_level, **step)
-
-      step_result = StepData(step, retcode)
-      self._stream.step_cursor(step['name'])
-    else:
-      self._previous_step_annotation = annotation = self._stream.step(
-              step['name'])
-      annotation.step_started()
-      try:
-        annotation.stream = cStringIO.StringIO()
-        if nest_level:
-          annotation.step_nest_level(nest_level)
-
-        step_result = StepData(step, step_test.retcode)
-      except OSError:
-        exc_type, exc_value, exc_tb = sys.exc_info()
-        trace = traceback.format_exception(exc_type, exc_value, exc_tb)
-        trace_lines = ''.join(trace).split('\n')
-        annotation.write_log_lines('exception', filter(None, trace_lines))
-        annotation.step_exception()
-
-    get_placeholder_results(step_result, placeholders)
+      launched, cache_entry = self._launch_step(prepared, stream, output_handle)
+      supervised = launched.supervise() if launched.proc is not None else ()
+      return self._complete_step(
+          prepared, stream, launched, cache_entry, *supervised)
+
+    annotation = stream.step(step['name'])
+    annotation.step_started()
+    annotation.stream = cStringIO.StringIO()
+    if prepared.nest_level:
+      annotation.step_nest_level(prepared.nest_level)
+
+    timed_out = None
+    if prepared.step_test.times_out:
+      timed_out = 'timeout' if step.get('timeout') else 'no_output_timeout'
+      assert step.get(timed_out), (
+          'Step %r was simulated to time out, but has no timeout.' %
+          step['name'])
+    return annotation, ExecutionResult(
+        prepared.step_test.retcode, None, timed_out, {})
+
+  def _launch_step(self, prepared, stream, output_handle):
+    """Starts a prepared step's command.
+
+    Returns a tuple of (_LaunchedStep, step_cache.CacheEntry or None).
+    """
+    step = prepared.step
+    cache_entry = None
+    if self._step_cache is not None and step.get('cacheable'):
+      cache_entry = self._step_cache_entry(prepared)
+    if prepared.journal_entry is not None:
+      cache_entry = prepared.journal_entry.attach(cache_entry)
+    python_workers = None
+    if not step.get('fresh_process'):
+      python_workers = self._python_workers
+    budget = self._output_budget or output_budget.OutputBudget()
+    launched = _launch_annotated_step(
+      stream, nest_level=prepared.nest_level, output_handle=output_handle,
+      cache_entry=cache_entry, python_workers=python_workers,
+      executor=self._executor, environment=self._environment,
+      output_budget=budget.for_step(step.get('max_output_bytes')), **step)
+    return launched, cache_entry
+
+  def _complete_step(self, prepared, stream, launched, cache_entry,
+                     byte_counts=None, rusage=None, timed_out=None):
+    """Finishes a step started by _launch_step, whose process has exited.
+
+    Returns a tuple of (annotation, ExecutionResult).
+    """
+    if cache_entry is not None and cache_entry.hit:
+      timed_out = cache_entry.timed_out
+    annotation, execution = launched.finish(byte_counts, rusage, timed_out)
+    stream.step_cursor(prepared.step['name'])
+    journal_entry = prepared.journal_entry
+    if journal_entry is not None and not journal_entry.replayed:
+      journal_entry.record(execution.retcode, execution.timed_out)
+    # Only successful results are cached, so that a flaky failure isn't
+    # replayed forever.
+    if (cache_entry is not None and not cache_entry.hit and
+        not execution.timed_out and execution.retcode in prepared.ok_ret):
+      cache_entry.save(execution.retcode)
+    return annotation, execution
+
+  def _submit_to_step_loop(self, prepared, stream, future):
+    """Starts a parallel step on the StepLoop, which completes |future| once
+    the step's process has exited."""
+    # pylint: disable=W0212
+    recorder = self._trace_recorder
+    state = {}
+
+    def launch():
+      state['start'] = recorder.now() if recorder else None
+      state['launched'], state['cache_entry'] = self._launch_step(
+          prepared, stream, future._buffer)
+      return state['launched'].process()
+
+    def on_done(*supervised):
+      def complete():
+        annotation, execution = self._complete_step(
+            prepared, stream, state['launched'], state['cache_entry'],
+            *supervised)
+        if recorder:
+          self._record_step(prepared, state['start'], execution)
+        return annotation, execution
+      future._run(complete)
+
+    self._step_loop.submit(launch, on_done, future._fail)
+
+  def _journal_entry(self, step, placeholders):
+    """Returns the step_journal.JournalEntry for a rendered step, or None if
+    there is no journal or the step's result can't be journaled."""
+    if self._journal is None:
+      return None
+    files = _placeholder_files(placeholders)
+    if files is None:
+      return None
+    return self._journal.entry(
+        step['name'], map(str, step['cmd']),
+        step.get('cwd') and str(step['cwd']), step.get('env'), *files)
+
+  def _step_cache_entry(self, prepared):
+    """Returns the step_cache.CacheEntry for a cacheable step.
+
+    Returns None if the step uses a placeholder whose files the cache can't
+    account for.
+    """
+    step = prepared.step
+    files = _placeholder_files(prepared.placeholders)
+    if files is None:
+      return None
+    inputs = map(str, step.get('cache_inputs', ()))
+    placeholder_inputs, outputs = files
+
+    # The magic buildbot variables differ from build to build, but don't
+    # affect what a step does.
+    env = dict(
+        (k, v) for k, v in self._environment.merge(step.get('env')).iteritems()
+        if k not in BUILDBOT_MAGIC_ENV)
+    return self._step_cache.entry(
+        map(str, step['cmd']), step.get('cwd'), env, inputs, outputs,
+        placeholder_inputs=placeholder_inputs)
+
+  def _finish_step(self, prepared, annotation, execution, buf=None):
+    """Builds the StepData for a step which has run, and makes it the active
+    result.
+
+    Raises StepFailure or InfraFailure if the step's retcode is not acceptable,
+    or StepTimeout if it timed out.
+    """
+    step = prepared.step
+    usage = execution.resource_usage
+    if usage is not None:
+      step['resource_usage'] = usage._asdict()
+      self._resource_usage[step['name']] = usage
+    step_result = StepData(step, execution.retcode, usage)
+    get_placeholder_results(step_result, prepared.placeholders)
+    if execution.truncated_output:
+      step_result.presentation.logs['truncated output'] = [
+          '%s: %d bytes dropped, full output in %s' % (
+              key, truncation.dropped_bytes, truncation.side_path)
+          for key, truncation in sorted(execution.truncated_output.iteritems())]
+
+    self._previous_step_annotation = annotation
     self._previous_step_result = step_result
-
-    if step_result.retcode in ok_ret:
+    self._previous_step_buffer = buf
+
+    if execution.timed_out:
+      limit = step[execution.timed_out]
+      # Simulated steps take exactly as long as they're allowed to.
+      elapsed = usage.wall_time if usage else limit
+      step_result.presentation.status = 'EXCEPTION'
+      annotation.emit('step timed out after %.1fs (%s=%s)' % (
+          elapsed, execution.timed_out, limit))
+      raise recipe_api.StepTimeout(
+          step['name'], step_result, execution.timed_out, limit, elapsed)
+
+    if step_result.retcode in prepared.ok_ret:
       step_result.presentation.status = 'SUCCESS'
       return step_result
     else:
-      if not infra_step:
+      if not prepared.infra_step:
         state = 'FAILURE'
         exc = recipe_api.StepFailure
       else:
@@ -841,13 +1568,103 @@ class RecipeEngine(object):
         exc = recipe_api.InfraFailure
 
       step_result.presentation.status = state
-      if step_test.enabled:
+      if prepared.step_test.enabled:
         # To avoid cluttering the expectations, don't emit this in testmode.
-        self._previous_step_annotation.emit(
+        annotation.emit(
             'step returned non-zero exit code: %d' % step_result.retcode)
 
       raise exc(step['name'], step_result)
 
+  def run_step(self, step):
+    """
+    Runs a step.
+
+    Args:
+      step: The step to run.
+
+    Returns:
+      A StepData object containing the result of running the step.
+    """
+    prepared = self._prepare_step(step)
+    self._emit_results()
+    self._flush_finished_steps()
+    with engine_profiler.blocked():
+      annotation, execution = self._start_step(
+          prepared, self._stream, self._stream.output)
+    return self._finish_step(prepared, annotation, execution)
+
+  def run_steps_parallel(self, steps):
+    """
+    Starts several independent steps, which run concurrently on a bounded
+    pool of worker threads.
+
+    Steps are recorded in the step history in the order given, regardless of
+    the order in which they complete. Under simulation the steps are run
+    inline, so expectations are identical to running them one after another.
+
+    Args:
+      steps: A list of steps to run.
+
+    Returns:
+      A list of StepFuture objects, one per step.
+    """
+    futures = []
+    for step in steps:
+      prepared = self._prepare_step(step)
+      future = StepFuture(self, prepared)
+      # pylint: disable=W0212
+      future._buffer = self._stream.new_buffer()
+      step_stream = annotator.StructuredAnnotationStream(
+          stream=future._buffer, flush_before=None)
+      start_fn = functools.partial(
+          self._start_step, prepared, step_stream, future._buffer)
+      if self._test_data.enabled:
+        future._run(start_fn)
+      elif self._use_step_loop:
+        if self._step_loop is None:
+          self._step_loop = step_loop.StepLoop(
+              max_children=self._step_loop_max_children,
+              grace_period=TIMEOUT_GRACE_PERIOD)
+        self._submit_to_step_loop(prepared, step_stream, future)
+      else:
+        if self._worker_pool is None:
+          self._worker_pool = _StepWorkerPool(self._max_parallel_steps)
+        self._worker_pool.submit(functools.partial(future._run, start_fn))
+      self._pending_futures.append(future)
+      futures.append(future)
+    return futures
+
+  def _collect_step(self, future):
+    """Waits for a StepFuture, and finishes it as if it were a serial step."""
+    # pylint: disable=W0212
+    self._emit_results()
+    with engine_profiler.blocked():
+      # Other steps' output is written out as they finish meanwhile.
+      while True:
+        self._flush_finished_steps()
+        if future.done():
+          break
+        with self._steps_finished:
+          if not any(f.done() and not f._flushed
+                     for f in self._pending_futures):
+            self._steps_finished.wait()
+    self._pending_futures.remove(future)
+    if future._exc_info:
+      # The step failed to start (e.g. the executable wasn't found). Emit what
+      # was annotated so far, then re-raise in the recipe's thread.
+      self._stream.write_buffer(future._buffer)
+      raise future._exc_info[0], future._exc_info[1], future._exc_info[2]
+    return self._finish_step(future._prepared, future._annotation,
+                             future._execution, future._buffer)
+
+  def _drain_pending_steps(self, raise_failures):
+    """Collects every StepFuture whose result the recipe never asked for."""
+    while self._pending_futures:
+      try:
+        self._pending_futures[0].result()
+      except recipe_api.StepFailure:
+        if raise_failures:
+          raise
 
   def run(self, steps_function, api, prop_defs):
     """Run a recipe represented by top level RunSteps function.
@@ -864,20 +1681,46 @@ class RecipeEngine(object):
       RecipeExecutionResult with status code and list of steps ran.
     """
     self._api = api
+    self._environment = step_env.StepEnvironment()
+    if self._python_worker_count:
+      self._python_workers = python_worker.WorkerPool(
+          self._python_worker_count)
     retcode = None
     final_result = None
 
     try:
       try:
-        retcode = loader.invoke_with_properties(
-          steps_function, api._engine.properties, prop_defs, api=api)
+        with trace_event.recording(self._trace_recorder), \
+             trace_event.span('RunSteps', 'recipe'):
+          invoke = functools.partial(
+            loader.invoke_with_properties,
+            steps_function, api._engine.properties, prop_defs, api=api)
+          if self._profiler is not None:
+            retcode = self._profiler.run(invoke)
+          else:
+            retcode = invoke()
         assert retcode is None, (
         "Non-None return from RunSteps is not supported yet")
 
+        self._drain_pending_steps(raise_failures=True)
+
         assert not self._test_data.enabled or not self._test_data.step_data, (
         "Unconsumed test data! %s" % (self._test_data.step_data,))
       finally:
+        self._drain_pending_steps(raise_failures=False)
         self._emit_results()
+        self._stream.flush()
+        if self._worker_pool is not None:
+          self._worker_pool.shutdown()
+          self._worker_pool = None
+        if self._step_loop is not None:
+          self._step_loop.close()
+          self._step_loop = None
+        if self._python_workers is not None:
+          self._python_workers.close()
+          self._python_workers = None
+        if self._resource_summary_path:
+          self._write_resource_summary()
     except recipe_api.StepFailure as f:
       retcode = f.retcode or 1
       final_result = {
@@ -922,7 +1765,27 @@ class RecipeEngine(object):
     if final_result is not None:
       self._step_history[final_result['name']] = final_result
 
-    return RecipeExecutionResult(retcode, self._step_history)
+    # The history shares the steps' frozen records while the recipe runs; its
+    # callers get plain dicts and lists, as they always have.
+    steps_ran = collections.OrderedDict(
+        (name, infra_types.thaw(step))
+        for name, step in self._step_history.iteritems())
+    return RecipeExecutionResult(retcode, steps_ran)
+
+  def _write_resource_summary(self):
+    """Writes the resources used by every step to the summary file."""
+    steps = []
+    totals = collections.defaultdict(int)
+    for name, usage in self._resource_usage.iteritems():
+      entry = usage._asdict()
+      for key, value in entry.iteritems():
+        if value is not None:
+          totals[key] += value
+      entry['name'] = name
+      steps.append(entry)
+    with open(self._resource_summary_path, 'w') as f:
+      json.dump({'steps': steps, 'total': totals}, f, indent=2,
+                sort_keys=True)
 
   def create_step(self, step):  # pylint: disable=R0201
     """Called by step module to instantiate a new step.
@@ -16,15 +16,25 @@ from . import expect_tests
 # doesn't know how to serialize it.
 _UNIVERSE = None
 
+# If set, each test writes a Chrome trace of its simulated run to
+# <_TRACE_DIR>/<recipe>.<test>.json. Set like _UNIVERSE.
+_TRACE_DIR = None
+
 def RunRecipe(test_data):
   from .third_party import annotator
   from . import run
   from . import config_types
+  from . import trace_event
 
   stream = annotator.StructuredAnnotationStream(stream=open(os.devnull, 'w'))
   config_types.ResetTostringFns()
+  recorder = trace_event.TraceRecorder() if _TRACE_DIR else None
   result = run.run_steps(
-      test_data.properties, stream, _UNIVERSE, test_data)
+      test_data.properties, stream, _UNIVERSE, test_data,
+      trace_recorder=recorder)
+  if recorder:
+    recorder.write(os.path.join(_TRACE_DIR, '%s.%s.json' % (
+        test_data.properties['recipe'].replace('/', '.'), test_data.name)))
 
   return expect_tests.Result(list(result.steps_ran.values()))
 
@@ -43,6 +53,19 @@ def cover_omit():
       omit.append(os.path.join(mod_dir_base, '*', 'resources', '*'))
   return omit
 
+
+def _pop_trace_output(args):
+  """Removes --trace-output DIR from |args|, which are otherwise passed to
+  expect_tests, and returns DIR (or None)."""
+  for i, arg in enumerate(args):
+    if arg == '--trace-output' and i + 1 < len(args):
+      del args[i]
+      return args.pop(i)
+    if arg.startswith('--trace-output='):
+      del args[i]
+      return arg.split('=', 1)[1]
+  return None
+
 @expect_tests.covers(test_gen_coverage)
 def GenerateTests():
   from . import loader
@@ -74,12 +97,14 @@ def GenerateTests():
       )
 
 
-def main(package_deps, args=None):
+def main(package_deps, args=None, universe=None):
   """Runs simulation tests on a given repo of recipes.
 
   Args:
     package_deps: a PackageDeps object to operate on
-    args: command line arguments to expect_tests
+    args: command line arguments to expect_tests, and optionally
+      --trace-output DIR to write a Chrome trace of each test to DIR.
+    universe: the RecipeUniverse of package_deps, if one is already loaded
   Returns:
     Doesn't -- exits with a status code
   """
@@ -95,8 +120,16 @@ def main(package_deps, args=None):
       logging.warn("Ignoring %s environment variable." % env_var)
       os.environ.pop(env_var)
 
-  global _UNIVERSE
-  _UNIVERSE = loader.RecipeUniverse(package_deps)
+  args = list(sys.argv[1:] if args is None else args)
+  trace_dir = _pop_trace_output(args)
+  if trace_dir:
+    trace_dir = os.path.abspath(trace_dir)
+    if not os.path.isdir(trace_dir):
+      os.makedirs(trace_dir)
+
+  global _UNIVERSE, _TRACE_DIR
+  _UNIVERSE = universe or loader.RecipeUniverse(package_deps)
+  _TRACE_DIR = trace_dir
 
   expect_tests.main('recipe_simulation_test', GenerateTests,
                     cover_omit=cover_omit(), args=args)
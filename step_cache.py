@@ -0,0 +1,279 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A local, content-addressed cache of step results.
+
+Steps which are pure functions of their command line, environment, working
+directory and input files may opt in with api.step(..., cacheable=True). Such a
+step is keyed on a hash of all of those (with temporary placeholder paths
+replaced by the contents or position of the placeholder), and a successful
+result is stored as:
+
+  <root>/<key>/
+    meta.json     - retcode, and the size of each of the files below
+    stdout        - the step's (filtered) stdout, as it was written to the log
+    stderr        - the step's (filtered) stderr
+    outputs/<n>   - the n'th output file (output placeholders, and redirected
+                    stdout/stderr)
+
+On a hit, the recorded output is written to the log and the output files are
+copied into the new placeholder paths, without running anything. The cache
+keeps a running total of its size as entries are stored, and once it grows past
+|max_bytes|, entries are evicted least-recently-used first.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from cStringIO import StringIO
+
+
+# Default size limit of the cache, in bytes.
+DEFAULT_MAX_BYTES = 5 * 1024 ** 3
+
+# Bump this when the layout or the key computation changes.
+CACHE_VERSION = 3
+
+
+def hash_path(path):
+  """Returns a digest of the file or directory tree at |path|."""
+  h = hashlib.sha256()
+  if os.path.isdir(path):
+    for root, dirs, files in os.walk(path):
+      dirs.sort()
+      for name in sorted(files):
+        full = os.path.join(root, name)
+        h.update(os.path.relpath(full, path))
+        h.update('\0')
+        h.update(hash_path(full))
+  elif os.path.exists(path):
+    with open(path, 'rb') as f:
+      for chunk in iter(lambda: f.read(1024 * 1024), ''):
+        h.update(chunk)
+  else:
+    return 'missing'
+  return h.hexdigest()
+
+
+def _dir_size(path):
+  total = 0
+  for root, _dirs, files in os.walk(path):
+    for name in files:
+      try:
+        total += os.path.getsize(os.path.join(root, name))
+      except OSError:
+        pass
+  return total
+
+
+class Tee(object):
+  """Writes to |primary|, and records everything written in |copy|."""
+
+  def __init__(self, primary, copy):
+    self._primary = primary
+    self._copy = copy
+
+  def write(self, data):
+    self._primary.write(data)
+    self._copy.write(data)
+
+  def flush(self):
+    self._primary.flush()
+
+
+class CacheEntry(object):
+  """The cache slot for one run of a step.
+
+  Passed to _run_annotated_step, which either restore()s a hit, or runs the
+  step through tee() and then save()s the result.
+  """
+
+  def __init__(self, cache, key, output_paths):
+    self._cache = cache
+    self.key = key
+    self._output_paths = output_paths
+    self._captured = {'stdout': StringIO(), 'stderr': StringIO()}
+    self.hit = False
+    self.retcode = None
+    # Only successful results are stored, so a restored one never timed out.
+    self.timed_out = None
+
+  def restore(self, stdout, stderr):
+    """Replays a cached result, if there is one.
+
+    Writes the recorded output to |stdout| and |stderr|, and copies the output
+    files into place. Returns True on a hit.
+    """
+    path = self._cache.entry_path(self.key)
+    blobs = []
+    try:
+      try:
+        with open(os.path.join(path, 'meta.json')) as f:
+          meta = json.load(f)
+        if len(meta['outputs']) != len(self._output_paths):
+          return False
+        # Open every file of the entry, and check its size, before writing
+        # anything: a damaged entry (or one evicted meanwhile) is a miss, not
+        # a partial restore. Open files stay readable if they are evicted.
+        expected = [meta['stdout'], meta['stderr']] + meta['outputs']
+        names = ['stdout', 'stderr'] + [
+            os.path.join('outputs', str(i))
+            for i in xrange(len(meta['outputs']))]
+        for name, size in zip(names, expected):
+          blobs.append(open(os.path.join(path, name), 'rb'))
+          if os.fstat(blobs[-1].fileno()).st_size != size:
+            return False
+        # Mark as recently used.
+        os.utime(os.path.join(path, 'meta.json'), None)
+      except (IOError, OSError, ValueError, KeyError, TypeError):
+        return False
+
+      for blob, dest in zip(blobs[2:], self._output_paths):
+        with open(dest, 'wb') as f:
+          shutil.copyfileobj(blob, f)
+      for blob, handle in zip(blobs[:2], (stdout, stderr)):
+        shutil.copyfileobj(blob, handle)
+        handle.flush()
+    finally:
+      for blob in blobs:
+        blob.close()
+    self.hit = True
+    self.retcode = meta['retcode']
+    return True
+
+  def tee(self, name, handle):
+    """Wraps |handle| so that the step's |name| ('stdout' or 'stderr') output
+    is recorded for save()."""
+    return Tee(handle, self._captured[name])
+
+  def save(self, retcode):
+    """Stores the result of the step, which exited with |retcode|."""
+    self._cache.store(self.key, retcode, self._captured['stdout'].getvalue(),
+                      self._captured['stderr'].getvalue(), self._output_paths)
+
+
+class StepCache(object):
+  def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+    self.root = root
+    self.max_bytes = max_bytes
+    self._lock = threading.Lock()
+    # The total size of the entries, or None until it's first needed. Only
+    # entries stored through this object are added; other processes' entries
+    # are counted when evict() next scans the cache.
+    self._size = None
+
+  def entry_path(self, key):
+    return os.path.join(self.root, key)
+
+  def entry(self, cmd, cwd, env, input_paths, output_paths,
+            placeholder_inputs=()):
+    """Returns the CacheEntry for a step.
+
+    Args:
+      cmd: the fully rendered command line.
+      cwd: the step's working directory.
+      env: the environment the step runs with.
+      input_paths: files or directories whose contents the step reads. Each is
+        keyed on its path and its contents.
+      output_paths: files the step writes, in a stable order. Paths which
+        appear in |cmd| are replaced there by their position in this list.
+      placeholder_inputs: temporary files the step reads, in a stable order.
+        Each is keyed on its position in this list and its contents, rather
+        than on its path.
+    Paths of inputs which appear in |cmd| are replaced there by the digest of
+    their contents.
+    """
+    digests = [hash_path(p) for p in input_paths]
+    placeholder_digests = [hash_path(p) for p in placeholder_inputs]
+    substitutions = {}
+    for path, digest in zip(input_paths, digests):
+      substitutions[path] = 'input:' + digest
+    for path, digest in zip(placeholder_inputs, placeholder_digests):
+      substitutions[path] = 'input:' + digest
+    for i, path in enumerate(output_paths):
+      substitutions[path] = 'output:%d' % i
+
+    key_data = {
+      'version': CACHE_VERSION,
+      'cmd': [substitutions.get(item, item) for item in cmd],
+      'cwd': cwd,
+      'env': sorted(env.iteritems()),
+      'inputs': sorted(zip(input_paths, digests)),
+      'placeholder_inputs': placeholder_digests,
+      'outputs': len(output_paths),
+    }
+    key = hashlib.sha256(json.dumps(key_data, sort_keys=True)).hexdigest()
+    return CacheEntry(self, key, output_paths)
+
+  def store(self, key, retcode, stdout, stderr, output_paths):
+    if not os.path.isdir(self.root):
+      try:
+        os.makedirs(self.root)
+      except OSError as e:
+        if e.errno != errno.EEXIST:
+          raise
+
+    # Build the entry next to its final location, then rename it into place so
+    # that concurrent readers never see a partial entry.
+    tmp = tempfile.mkdtemp(prefix='.tmp', dir=self.root)
+    try:
+      os.mkdir(os.path.join(tmp, 'outputs'))
+      for i, src in enumerate(output_paths):
+        shutil.copyfile(src, os.path.join(tmp, 'outputs', str(i)))
+      for name, data in (('stdout', stdout), ('stderr', stderr)):
+        with open(os.path.join(tmp, name), 'wb') as f:
+          f.write(data)
+      with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump({
+          'retcode': retcode,
+          'stdout': len(stdout),
+          'stderr': len(stderr),
+          'outputs': [os.path.getsize(os.path.join(tmp, 'outputs', str(i)))
+                      for i in xrange(len(output_paths))],
+        }, f)
+      size = _dir_size(tmp)
+      try:
+        os.rename(tmp, self.entry_path(key))
+      except OSError:
+        # Someone else stored the same key first.
+        return
+    finally:
+      if os.path.isdir(tmp):
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    with self._lock:
+      if self._size is not None:
+        self._size += size
+        if self._size <= self.max_bytes:
+          return
+    self.evict()
+
+  def evict(self):
+    """Deletes least recently used entries until the cache fits |max_bytes|.
+
+    Scans the whole cache, and resets the running total of its size.
+    """
+    entries = []
+    total = 0
+    for name in os.listdir(self.root):
+      path = os.path.join(self.root, name)
+      meta = os.path.join(path, 'meta.json')
+      if name.startswith('.') or not os.path.isfile(meta):
+        continue
+      size = _dir_size(path)
+      total += size
+      entries.append((os.path.getmtime(meta), size, path))
+
+    entries.sort()
+    while total > self.max_bytes and entries:
+      _, size, path = entries.pop(0)
+      shutil.rmtree(path, ignore_errors=True)
+      total -= size
+    with self._lock:
+      self._size = total
@@ -0,0 +1,146 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Builds steps' environments, and finds their executables.
+
+A StepEnvironment snapshots the engine's environment once, and builds each
+step's environment from it and the step's overrides. It also resolves each
+step's argv[0] against the step's own PATH, so that steps can be started with
+an absolute executable (Popen's |executable|, leaving argv[0] as the step gave
+it) without touching the engine's global os.environ (which subprocess would
+otherwise search).
+
+Lookups are memoized per (PATH, name). A cached result stays valid as long as
+none of the PATH directories it depends on (those before and including the
+one it was found in, or all of them for a miss) has changed mtime, i.e. had
+entries added, removed or renamed.
+"""
+
+import errno
+import os
+import sys
+import threading
+
+
+def _mtime(path):
+  try:
+    return os.stat(path).st_mtime
+  except OSError:
+    return None
+
+
+def _candidates(name):
+  """Returns the file names |name| may refer to, in order."""
+  if not sys.platform.startswith('win') or os.path.splitext(name)[1]:
+    return (name,)
+  exts = os.environ.get('PATHEXT', '.COM;.EXE;.BAT;.CMD').split(';')
+  return tuple(name + ext for ext in exts if ext)
+
+
+def _is_executable(path):
+  return os.path.isfile(path) and os.access(path, os.X_OK)
+
+
+class ExecutableResolver(object):
+  """A memoized, thread-safe equivalent of searching PATH for a command."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # (path, name) -> (result or None, ((dir, mtime), ...))
+    self._cache = {}
+
+  def resolve(self, name, path):
+    """Returns the absolute path of the executable |name| on |path| (an
+    os.pathsep separated list of directories), or None if it isn't there.
+
+    Names with a directory component are returned as they are.
+    """
+    if os.path.dirname(name):
+      return name
+    key = (path, name)
+    with self._lock:
+      cached = self._cache.get(key)
+    if cached is not None:
+      result, checked = cached
+      if all(_mtime(d) == mtime for d, mtime in checked):
+        return result
+
+    checked = []
+    result = None
+    for directory in path.split(os.pathsep):
+      directory = directory or os.curdir
+      checked.append((directory, _mtime(directory)))
+      for candidate in _candidates(name):
+        full = os.path.join(directory, candidate)
+        if _is_executable(full):
+          result = os.path.abspath(full)
+          break
+      if result:
+        break
+    with self._lock:
+      self._cache[key] = (result, tuple(checked))
+    return result
+
+
+class StepEnvironment(object):
+  """A snapshot of the engine's environment, from which steps' environments
+  are built."""
+
+  def __init__(self, base=None):
+    self._base = dict(os.environ if base is None else base)
+    self._lock = threading.Lock()
+    self._merged = {}
+    self._resolver = ExecutableResolver()
+
+  @property
+  def base(self):
+    return self._base
+
+  def merge(self, overrides):
+    """Returns a new environment dict with entries from |overrides|
+    overwriting those of the snapshot.
+
+    Keys whose value is None remove the variable. Values can contain %(KEY)s
+    strings, which are substituted with the values from the snapshot (useful
+    for amending, as opposed to overwriting, variables like PATH).
+    """
+    if not overrides:
+      return self._base.copy()
+    try:
+      key = frozenset(overrides.iteritems())
+    except TypeError:
+      # Some value isn't hashable (it only needs to be str()-able), so this
+      # one can't be memoized.
+      return self._merge(overrides)
+    with self._lock:
+      merged = self._merged.get(key)
+    if merged is None:
+      merged = self._merge(overrides)
+      with self._lock:
+        self._merged[key] = merged
+    return merged.copy()
+
+  def _merge(self, overrides):
+    merged = self._base.copy()
+    for k, v in overrides.iteritems():
+      if v is None:
+        merged.pop(k, None)
+      else:
+        merged[str(k)] = str(v) % self._base
+    return merged
+
+  def resolve_executable(self, cmd, env):
+    """Returns the path of |cmd|'s executable, resolved against the PATH of
+    |env| (or of the snapshot, if |env| has none, as subprocess would).
+
+    |cmd| itself is left alone, so that the program sees the argv[0] it was
+    given; start it with the result as Popen's |executable|.
+
+    Raises OSError(ENOENT) if the executable can't be found.
+    """
+    path = env.get('PATH', self._base.get('PATH', os.defpath))
+    executable = self._resolver.resolve(cmd[0], path)
+    if executable is None:
+      raise OSError(errno.ENOENT, 'No such file or directory: %r' % cmd[0])
+    return executable
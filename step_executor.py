@@ -0,0 +1,413 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""An executor daemon which starts steps' processes on the engine's behalf.
+
+Forking from the engine, a big python process with many modules loaded, is
+slow, and every recipe run pays for it again. An executor is a small, long
+lived process listening on a unix socket: the engine sends it each step's
+command, and it spawns the step (applying resource limits), hands the step's
+stdout and stderr back over the socket, and reports the exit status and
+resource usage. Consecutive `recipes.py run --executor <socket>` invocations on
+the same bot share one executor, which exits once it has been idle for a
+while.
+
+For each step the client makes a control connection and sends one JSON
+request line,
+    {"cmd": [...], "executable": path or null, "cwd": ..., "env": {...},
+     "limits": {"RLIMIT_...": n}, "stdin": path or null,
+     "stdout": path or null, "stderr": path or null}
+The executor answers with {"token": ..., "streams": [...]}, and the client
+makes one more connection for each of the named streams ("stdout" and/or
+"stderr", those not redirected to files), sending "<token> <stream>\\n" on it.
+The executor then starts the step and answers {"pid": n} (or
+{"error": [errno, message]} if it couldn't), and {"returncode": n,
+"rusage": {...}} once the step has exited.
+
+Each step runs in its own process group, so it can be signalled just like a
+step started with subprocess. POSIX only.
+
+This file is also the executor's main program, so it only imports the
+standard library.
+"""
+
+import argparse
+import collections
+import errno
+import json
+import os
+import select
+import socket
+import subprocess
+import sys
+import threading
+import time
+import uuid
+
+try:
+  import fcntl
+  import resource
+except ImportError:  # pragma: no cover
+  fcntl = resource = None
+
+
+_RUSAGE_FIELDS = ('ru_utime', 'ru_stime', 'ru_maxrss', 'ru_inblock',
+                  'ru_oublock')
+
+# The subset of resource.struct_rusage reported for a step.
+Rusage = collections.namedtuple('Rusage', ' '.join(_RUSAGE_FIELDS))
+
+# Seconds an executor waits, after answering a request, for the request's
+# stream connections.
+STREAM_TIMEOUT = 30
+
+# Seconds an executor started by ensure_executor() stays up without steps.
+DEFAULT_IDLE_TIMEOUT = 10 * 60
+
+
+def is_supported():
+  return (hasattr(socket, 'AF_UNIX') and hasattr(os, 'fork') and
+          fcntl is not None)
+
+
+def _retry_on_eintr(fn, *args):
+  while True:
+    try:
+      return fn(*args)
+    except (OSError, IOError, select.error, socket.error) as e:
+      if e.args[0] != errno.EINTR:
+        raise
+
+
+class ExecutorProcess(object):
+  """A step running in an executor. Quacks enough like subprocess.Popen for
+  the engine."""
+
+  def __init__(self, control, streams):
+    self._control = control
+    self._replies = control.makefile('rb')
+    self._streams = streams
+    self.stdout = self.stderr = None
+    if 'stdout' in streams:
+      self.stdout = streams['stdout'].makefile('rb')
+    if 'stderr' in streams:
+      self.stderr = streams['stderr'].makefile('rb')
+    self.returncode = None
+    reply = self._reply()
+    if 'error' in reply:
+      self._close()
+      raise OSError(*reply['error'])
+    self.pid = reply['pid']
+
+  def _reply(self):
+    line = _retry_on_eintr(self._replies.readline)
+    if not line:
+      raise OSError(errno.EPIPE, 'step executor went away')
+    return json.loads(line)
+
+  def _close(self):
+    for f in [self._replies, self._control] + self._streams.values():
+      f.close()
+    for f in (self.stdout, self.stderr):
+      if f is not None:
+        f.close()
+
+  def wait(self):
+    """Waits for the step to exit, and returns its Rusage."""
+    try:
+      reply = self._reply()
+    finally:
+      self._close()
+    self.returncode = reply['returncode']
+    return Rusage(**reply['rusage'])
+
+
+class ExecutorClient(object):
+  """Starts steps in the executor listening on |socket_path|.
+
+  If |launcher| is given, it is called to start a new executor when there is
+  none listening (e.g. because it exited while idle).
+  """
+
+  def __init__(self, socket_path, launcher=None):
+    self.socket_path = socket_path
+    self._launcher = launcher
+
+  def _try_connect(self):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      _retry_on_eintr(conn.connect, self.socket_path)
+    except:
+      conn.close()
+      raise
+    return conn
+
+  def _connect(self):
+    try:
+      return self._try_connect()
+    except socket.error as e:
+      if (self._launcher is None or
+          e.errno not in (errno.ENOENT, errno.ECONNREFUSED)):
+        raise
+    self._launcher()
+    return self._try_connect()
+
+  def ping(self):
+    """Returns True if an executor is listening."""
+    try:
+      conn = self._try_connect()
+    except socket.error:
+      return False
+    conn.close()
+    return True
+
+  def start(self, cmd, cwd, env, stdin=None, stdout=None, stderr=None,
+            limits=None, executable=None):
+    """Starts |cmd| in |cwd| with exactly the environment |env|.
+
+    |stdin|, |stdout| and |stderr| are paths to redirect the step's stdio to;
+    stdout and stderr are otherwise available from the returned
+    ExecutorProcess. |limits| maps names of resource.RLIMIT_* constants to
+    the (soft and hard) limit to set in the step. |executable| is the program
+    to run, if it isn't argv[0] looked up on the PATH of |env|.
+
+    Raises OSError if the command couldn't be started.
+    """
+    abspath = lambda p: p and os.path.abspath(p)
+    request = json.dumps({
+      'cmd': map(str, cmd), 'executable': executable, 'cwd': cwd, 'env': env,
+      'limits': limits or {},
+      'stdin': abspath(stdin), 'stdout': abspath(stdout),
+      'stderr': abspath(stderr),
+    })
+    control = self._connect()
+    streams = {}
+    try:
+      control.sendall(request + '\n')
+      replies = control.makefile('rb')
+      answer = json.loads(_retry_on_eintr(replies.readline) or 'null')
+      replies.close()
+      if not answer:
+        raise OSError(errno.EPIPE, 'step executor went away')
+      for name in answer['streams']:
+        conn = self._connect()
+        streams[name] = conn
+        conn.sendall('%s %s\n' % (answer['token'], name))
+      return ExecutorProcess(control, streams)
+    except:
+      control.close()
+      for conn in streams.itervalues():
+        conn.close()
+      raise
+
+
+def ensure_executor(socket_path, python=None,
+                    idle_timeout=DEFAULT_IDLE_TIMEOUT, startup_timeout=30):
+  """Returns an ExecutorClient for |socket_path|, which starts a detached
+  executor there whenever none is listening."""
+  def launch():
+    _launch_executor(socket_path, python, idle_timeout, startup_timeout)
+  client = ExecutorClient(socket_path, launcher=launch)
+  if not client.ping():
+    launch()
+  return client
+
+
+def _launch_executor(socket_path, python, idle_timeout, startup_timeout):
+  # Engines which find no executor at the same time take turns, so that none
+  # of them removes the socket of one another has just started.
+  with open(socket_path + '.lock', 'a') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    client = ExecutorClient(socket_path)
+    if client.ping():
+      return
+    if os.path.exists(socket_path):
+      os.unlink(socket_path)  # Left behind by an executor which died.
+    with open(os.devnull, 'r+') as devnull:
+      subprocess.Popen(
+          [python or sys.executable, os.path.abspath(__file__),
+           '--idle-timeout', str(idle_timeout), socket_path],
+          stdin=devnull, stdout=devnull, stderr=devnull, close_fds=True,
+          preexec_fn=os.setsid)
+    deadline = time.time() + startup_timeout
+    while not client.ping():
+      if time.time() > deadline:
+        raise OSError(errno.ETIMEDOUT,
+                      'step executor did not start on %s' % socket_path)
+      time.sleep(0.05)
+
+
+def _which(name, env):
+  """Resolves |name| against the PATH of the step's environment, as
+  subprocess would against the engine's."""
+  if os.sep in name:
+    return name
+  for directory in env.get('PATH', os.defpath).split(os.pathsep):
+    path = os.path.join(directory, name)
+    if os.path.isfile(path) and os.access(path, os.X_OK):
+      return path
+  return name
+
+
+def _run_child(request, streams, errpipe):
+  """Sets up and execs a request in the forked child. Never returns."""
+  try:
+    os.setpgrp()
+    for fd, name, mode in ((0, 'stdin', os.O_RDONLY),
+                           (1, 'stdout', os.O_WRONLY),
+                           (2, 'stderr', os.O_WRONLY)):
+      if name in streams:
+        os.dup2(streams[name].fileno(), fd)
+        continue
+      if mode == os.O_WRONLY:
+        mode |= os.O_CREAT | os.O_TRUNC
+      handle = os.open(request[name] or os.devnull, mode, 0666)
+      os.dup2(handle, fd)
+      os.close(handle)
+    for name, limit in request['limits'].iteritems():
+      resource.setrlimit(getattr(resource, name), (limit, limit))
+    if request['cwd']:
+      os.chdir(request['cwd'])
+    cmd = request['cmd']
+    executable = request['executable'] or _which(cmd[0], request['env'])
+    os.execve(executable, cmd, request['env'])
+  except BaseException as e:
+    os.write(errpipe, json.dumps(
+        [getattr(e, 'errno', None) or errno.EINVAL, str(e)]))
+  finally:
+    os._exit(127)
+
+
+class _Executor(object):
+  def __init__(self, socket_path, idle_timeout):
+    self._socket_path = socket_path
+    self._idle_timeout = idle_timeout
+    self._lock = threading.Condition()
+    self._active = 0
+    self._last_active = time.time()
+    self._pending_streams = {}
+
+  def _handle(self, conn):
+    try:
+      line = _retry_on_eintr(conn.makefile('rb').readline)
+      if not line:
+        conn.close()
+        return
+      words = line.split()
+      if len(words) == 2 and not line.startswith('{'):
+        # A stream connection for a request another thread is serving.
+        with self._lock:
+          self._pending_streams[tuple(words)] = conn
+          self._lock.notify_all()
+        return
+      self._serve_step(conn, json.loads(line))
+    except Exception:  # pylint: disable=W0703
+      conn.close()
+
+  def _serve_step(self, control, request):
+    with self._lock:
+      self._active += 1
+    try:
+      token = uuid.uuid4().hex
+      names = [n for n in ('stdout', 'stderr') if not request[n]]
+      control.sendall(json.dumps({'token': token, 'streams': names}) + '\n')
+
+      streams = {}
+      deadline = time.time() + STREAM_TIMEOUT
+      with self._lock:
+        while len(streams) < len(names) and time.time() < deadline:
+          for name in names:
+            conn = self._pending_streams.pop((token, name), None)
+            if conn is not None:
+              streams[name] = conn
+          if len(streams) < len(names):
+            self._lock.wait(1)
+      if len(streams) < len(names):
+        raise OSError(errno.ETIMEDOUT, 'stream connections never arrived')
+
+      errpipe_r, errpipe_w = os.pipe()
+      fcntl.fcntl(errpipe_w, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+      pid = os.fork()
+      if pid == 0:
+        os.close(errpipe_r)
+        _run_child(request, streams, errpipe_w)
+      os.close(errpipe_w)
+      for conn in streams.itervalues():
+        conn.close()
+      with os.fdopen(errpipe_r) as errpipe:
+        error = _retry_on_eintr(errpipe.read)
+      if error:
+        _retry_on_eintr(os.waitpid, pid, 0)
+        control.sendall(json.dumps({'error': json.loads(error)}) + '\n')
+        return
+
+      control.sendall(json.dumps({'pid': pid}) + '\n')
+      _, status, rusage = _retry_on_eintr(os.wait4, pid, 0)
+      if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+      else:
+        returncode = os.WEXITSTATUS(status)
+      control.sendall(json.dumps({
+        'returncode': returncode,
+        'rusage': dict((k, getattr(rusage, k)) for k in _RUSAGE_FIELDS),
+      }) + '\n')
+    finally:
+      control.close()
+      with self._lock:
+        self._active -= 1
+        self._last_active = time.time()
+
+  def _idle(self):
+    with self._lock:
+      return (self._idle_timeout and not self._active and
+              time.time() - self._last_active > self._idle_timeout)
+
+  def serve(self):
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Anyone who can connect can run commands as us.
+    old_umask = os.umask(0177)
+    try:
+      listener.bind(self._socket_path)
+    finally:
+      os.umask(old_umask)
+    inode = os.stat(self._socket_path).st_ino
+    listener.listen(64)
+    try:
+      while not self._idle():
+        ready, _, _ = _retry_on_eintr(select.select, [listener], [], [], 1)
+        if not ready:
+          continue
+        conn, _ = _retry_on_eintr(listener.accept)
+        thread = threading.Thread(target=self._handle, args=(conn,))
+        thread.daemon = True
+        thread.start()
+    finally:
+      listener.close()
+      # Unless it was already replaced, by an executor started after this one
+      # stopped answering.
+      try:
+        if os.stat(self._socket_path).st_ino == inode:
+          os.unlink(self._socket_path)
+      except OSError as e:
+        if e.errno != errno.ENOENT:
+          raise
+
+
+def serve(socket_path, idle_timeout=None):
+  """Serves steps on |socket_path|, until no step has run for |idle_timeout|
+  seconds (forever if None)."""
+  _Executor(socket_path, idle_timeout).serve()
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Runs steps for the engine.')
+  parser.add_argument('--idle-timeout', type=float,
+                      help='Exit after this many seconds without steps')
+  parser.add_argument('socket_path')
+  args = parser.parse_args(argv)
+  serve(args.socket_path, args.idle_timeout)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,265 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A checkpoint journal of a recipe run's steps, from which a crashed run can
+resume.
+
+Each step which completes is appended to the journal, and the journal is
+fsync'd, as a JSON line holding:
+
+  seq        - the step's position in the order the recipe issued steps
+  signature  - a digest of the step's name, command line, working directory
+               and environment overrides (with temporary placeholder paths
+               replaced by the contents or position of the placeholder)
+  name, cmd  - for humans
+  retcode, timed_out
+  stdout, stderr, outputs
+             - base64 of the step's output, and of each of its output files
+               (output placeholders, and redirected stdout/stderr), or null
+               for a file the step didn't write
+
+When a run is resumed from the journal, each step whose seq and signature
+match a journaled one is replayed from it, like a step cache hit, instead of
+being run. The first step which doesn't match (the recipe has taken another
+path) drops it and every later entry from the journal, and the run continues
+live from there.
+"""
+
+import base64
+import hashlib
+import json
+import os
+import threading
+
+from cStringIO import StringIO
+
+from . import step_cache
+
+
+# Bump this when the format or the signature computation changes.
+JOURNAL_VERSION = 1
+
+
+def signature(name, cmd, cwd, env, input_paths, output_paths):
+  """Returns the journal signature of a step.
+
+  Args:
+    name: the step's name.
+    cmd: the fully rendered command line.
+    cwd: the step's working directory.
+    env: the step's environment overrides.
+    input_paths: files the step reads, whose paths are temporary. They are
+      replaced in |cmd| by the digest of their contents.
+    output_paths: files the step writes, in a stable order. Paths which appear
+      in |cmd| are replaced there by their position in this list.
+  """
+  substitutions = {}
+  for path in input_paths:
+    substitutions[path] = 'input:' + step_cache.hash_path(path)
+  for i, path in enumerate(output_paths):
+    substitutions[path] = 'output:%d' % i
+  data = {
+    'version': JOURNAL_VERSION,
+    'name': name,
+    'cmd': [substitutions.get(item, item) for item in cmd],
+    'cwd': cwd,
+    'env': sorted((env or {}).iteritems()),
+    'outputs': len(output_paths),
+  }
+  return hashlib.sha256(json.dumps(data, sort_keys=True)).hexdigest()
+
+
+def _read_entries(path):
+  """Returns the well-formed entries of the journal at |path|. A line cut
+  short by a crash is dropped."""
+  entries = []
+  try:
+    f = open(path)
+  except IOError:
+    return entries
+  with f:
+    for line in f:
+      try:
+        entry = json.loads(line)
+      except ValueError:
+        break
+      if not isinstance(entry, dict) or 'seq' not in entry:
+        break
+      entries.append(entry)
+  return entries
+
+
+class JournalEntry(object):
+  """The journal slot for one step of the run.
+
+  Passed to _run_annotated_step in place of a step_cache.CacheEntry, which it
+  can wrap: it restore()s the journaled result if the run is being resumed
+  (or else the wrapped cache entry's), and otherwise records the step's
+  output through tee() for record().
+  """
+
+  def __init__(self, journal, seq, sig, name, cmd, output_paths, replay):
+    self._journal = journal
+    self.seq = seq
+    self._signature = sig
+    self._name = name
+    self._cmd = cmd
+    self._output_paths = output_paths
+    self._replay = replay
+    self._captured = {'stdout': StringIO(), 'stderr': StringIO()}
+    self._inner = None
+    self.replayed = False
+
+  def attach(self, cache_entry):
+    """Wraps |cache_entry| (or None), and returns self."""
+    self._inner = cache_entry
+    return self
+
+  @property
+  def key(self):
+    if self.replayed:
+      return 'journal entry %d' % self.seq
+    return self._inner.key
+
+  @property
+  def hit(self):
+    return self.replayed or bool(self._inner and self._inner.hit)
+
+  @property
+  def retcode(self):
+    if self.replayed:
+      return self._replay['retcode']
+    return self._inner.retcode
+
+  @property
+  def timed_out(self):
+    if self.replayed:
+      return self._replay['timed_out']
+    return self._inner.timed_out
+
+  def restore(self, stdout, stderr):
+    """Replays the journaled result, if the run is being resumed and the step
+    matches it, or the wrapped cache entry's result. Returns True if either
+    was restored."""
+    if self._replay is not None:
+      for data, dest in zip(self._replay['outputs'], self._output_paths):
+        if data is None:
+          if os.path.exists(dest):
+            os.unlink(dest)
+        else:
+          with open(dest, 'wb') as f:
+            f.write(base64.b64decode(data))
+      for name, handle in (('stdout', stdout), ('stderr', stderr)):
+        handle.write(base64.b64decode(self._replay[name]))
+        handle.flush()
+      self.replayed = True
+      return True
+    if self._inner is None:
+      return False
+    return self._inner.restore(self.tee('stdout', stdout),
+                               self.tee('stderr', stderr))
+
+  def tee(self, name, handle):
+    """Wraps |handle| so that the step's |name| ('stdout' or 'stderr') output
+    is recorded for record()."""
+    if self._inner is not None:
+      handle = self._inner.tee(name, handle)
+    return step_cache.Tee(handle, self._captured[name])
+
+  def save(self, retcode):
+    """Stores the result in the wrapped step cache entry, if there is one."""
+    if self._inner is not None:
+      self._inner.save(retcode)
+
+  def record(self, retcode, timed_out):
+    """Appends the step's result to the journal."""
+    outputs = []
+    for path in self._output_paths:
+      try:
+        with open(path, 'rb') as f:
+          outputs.append(base64.b64encode(f.read()))
+      except IOError:
+        outputs.append(None)
+    self._journal.append({
+      'seq': self.seq,
+      'signature': self._signature,
+      'name': self._name,
+      'cmd': self._cmd,
+      'retcode': retcode,
+      'timed_out': timed_out,
+      'stdout': base64.b64encode(self._captured['stdout'].getvalue()),
+      'stderr': base64.b64encode(self._captured['stderr'].getvalue()),
+      'outputs': outputs,
+    })
+
+
+class StepJournal(object):
+  """The journal file at |path|.
+
+  If |resume| is set, the results journaled there by an earlier run are
+  replayed; otherwise the journal is started afresh.
+  """
+
+  def __init__(self, path, resume=False):
+    self.path = path
+    self._lock = threading.Lock()
+    self._seq = 0
+    self._replay = {}
+    self._entries = []
+    if resume:
+      self._entries = _read_entries(path)
+      self._replay = dict((e['seq'], e) for e in self._entries)
+    # Rewrite what was kept, so that a line cut short by a crash doesn't run
+    # into the next one.
+    self._file = None
+    self._rewrite()
+
+  def _rewrite(self):
+    if self._file is not None:
+      self._file.close()
+    tmp = self.path + '.tmp'
+    with open(tmp, 'w') as f:
+      for entry in self._entries:
+        f.write(json.dumps(entry, sort_keys=True) + '\n')
+      f.flush()
+      os.fsync(f.fileno())
+    os.rename(tmp, self.path)
+    self._file = open(self.path, 'a')
+
+  def entry(self, name, cmd, cwd, env, input_paths, output_paths):
+    """Returns the JournalEntry for the next step the recipe issues.
+
+    Takes the arguments of signature().
+    """
+    sig = signature(name, cmd, cwd, env, input_paths, output_paths)
+    with self._lock:
+      seq = self._seq
+      self._seq += 1
+      replay = self._replay.get(seq)
+      if replay is not None and replay['signature'] != sig:
+        # The recipe has diverged from the journaled run: nothing from here on
+        # can be replayed.
+        replay = None
+        self._replay = {}
+        self._entries = [e for e in self._entries if e['seq'] < seq]
+        self._rewrite()
+    return JournalEntry(self, seq, sig, name, cmd, output_paths, replay)
+
+  def append(self, entry):
+    """Appends |entry| to the journal, and waits for it to reach the disk."""
+    line = json.dumps(entry, sort_keys=True) + '\n'
+    with self._lock:
+      # Entries are only needed to rewrite the journal if the recipe diverges
+      # from it, which can't happen once nothing is left to replay.
+      if self._replay:
+        self._entries.append(entry)
+      self._file.write(line)
+      self._file.flush()
+      os.fsync(self._file.fileno())
+
+  def close(self):
+    with self._lock:
+      if self._file is not None:
+        self._file.close()
+        self._file = None
@@ -0,0 +1,357 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Supervises the processes of many parallel steps from a single thread.
+
+By default each step started by run_steps_parallel occupies a worker thread,
+plus a thread per output pipe and a watchdog thread while its process runs. A
+StepLoop instead multiplexes every running step's pipes with poll(), enforces
+timeouts from the same loop and reaps the processes with wait4(WNOHANG), so
+that hundreds of steps can run at once without hundreds of threads. POSIX
+only; see is_supported().
+"""
+
+import collections
+import errno
+import math
+import os
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from . import output_pump
+
+
+# What a launch function passed to StepLoop.submit returns for a step whose
+# process is running: the process (a subprocess.Popen, or anything with a
+# blocking wait() which returns its rusage), the (inhandle, outhandle) pairs to
+# pump, and the step's timeouts.
+StepProcess = collections.namedtuple(
+    'StepProcess',
+    'proc pairs allow_subannotations timeout no_output_timeout')
+
+# Seconds between polls for a process which closed its output but hasn't been
+# reaped yet.
+_REAP_INTERVAL = 0.01
+
+_POLL_IN = getattr(select, 'POLLIN', 0) | getattr(select, 'POLLHUP', 0)
+
+
+class Cancelled(Exception):
+  """Reported for steps which were still running, or not yet launched, when
+  their StepLoop was closed."""
+
+
+def is_supported():
+  return hasattr(select, 'poll') and hasattr(os, 'wait4')
+
+
+def _kill_group(pid, sig):
+  try:
+    os.killpg(pid, sig)
+  except OSError as e:
+    if e.errno != errno.ESRCH:
+      raise
+
+
+class _Child(object):
+  def __init__(self, spec, on_done, on_error, now):
+    self.proc = spec.proc
+    self.allow_subannotations = spec.allow_subannotations
+    self.timeout = spec.timeout
+    # A step none of whose output is piped never produces any that can be
+    # seen, so it would always look stuck.
+    self.no_output_timeout = spec.pairs and spec.no_output_timeout or None
+    self.on_done = on_done
+    self.on_error = on_error
+
+    self.start = self.last_output = now
+    self.counts = [0] * len(spec.pairs)
+    self.open_fds = set()
+    self.rusage = None
+    self.exited = False
+    self.timed_out = None
+    self.kill_at = None
+    self.killed = False
+
+    # fd -> (index, outhandle, ChunkFilter)
+    self.readers = {}
+    for index, (inhandle, outhandle) in enumerate(spec.pairs):
+      fd = inhandle.fileno()
+      self.readers[fd] = (
+          index, outhandle, output_pump.ChunkFilter(self.allow_subannotations))
+      self.open_fds.add(fd)
+
+  def deadline(self):
+    """Returns the (time, kind) of the next thing this child must be checked
+    for, or None."""
+    if self.killed:
+      return None
+    if self.kill_at is not None:
+      return self.kill_at, 'kill'
+    deadlines = []
+    if self.timeout:
+      deadlines.append((self.start + self.timeout, 'timeout'))
+    if self.no_output_timeout:
+      deadlines.append(
+          (self.last_output + self.no_output_timeout, 'no_output_timeout'))
+    return min(deadlines) if deadlines else None
+
+
+class StepLoop(object):
+  """Runs steps' processes to completion on a single supervisor thread.
+
+  Steps are submitted with submit(). At most |max_children| of them run at
+  once (unbounded if None); the rest are launched, in order, as running ones
+  exit.
+  """
+
+  def __init__(self, max_children=None, grace_period=30,
+               read_size=output_pump.READ_SIZE):
+    self._max_children = max_children
+    self._grace_period = grace_period
+    self._read_size = read_size
+
+    self._lock = threading.Lock()
+    self._queue = collections.deque()
+    self._launching = 0
+    self._children = []
+    self._incoming = []
+    self._closed = False
+
+    self._wake_r, self._wake_w = os.pipe()
+    self._thread = threading.Thread(target=self._run, name='step_loop')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def submit(self, launch, on_done, on_error):
+    """Queues a step.
+
+    |launch| is called (on the calling thread if a slot is free, otherwise
+    later on the supervisor thread) to start the step, and returns a
+    StepProcess, or None if there is no process to supervise. Once the process
+    has exited, on_done(byte_counts, rusage, timed_out) is called on the
+    supervisor thread; byte_counts lists the bytes read from each pipe, and
+    timed_out is None, 'timeout' or 'no_output_timeout'. If the step has no
+    process, on_done(None, None, None) is called straight away. If anything
+    raises, on_error(exc_info) is called instead.
+    """
+    with self._lock:
+      assert not self._closed, 'StepLoop is closed'
+      if self._has_slot():
+        self._launching += 1
+      else:
+        self._queue.append((launch, on_done, on_error))
+        return
+    self._launch(launch, on_done, on_error)
+
+  def _has_slot(self):
+    running = len(self._children) + len(self._incoming) + self._launching
+    return self._max_children is None or running < self._max_children
+
+  def _launch(self, launch, on_done, on_error):
+    """Calls |launch|, and hands its process to the supervisor thread. Called
+    with a slot reserved in self._launching."""
+    try:
+      spec = launch()
+    except Exception:  # pylint: disable=W0703
+      spec = None
+      exc_info = sys.exc_info()
+    else:
+      exc_info = None
+
+    if spec is None:
+      with self._lock:
+        self._launching -= 1
+      if exc_info:
+        on_error(exc_info)
+      else:
+        self._call(on_done, on_error, None, None, None)
+      self._launch_queued()
+      return
+
+    with self._lock:
+      self._launching -= 1
+      self._incoming.append(_Child(spec, on_done, on_error, time.time()))
+    os.write(self._wake_w, 'x')
+
+  def _launch_queued(self):
+    while True:
+      with self._lock:
+        if not self._queue or not self._has_slot():
+          return
+        item = self._queue.popleft()
+        self._launching += 1
+      self._launch(*item)
+
+  @staticmethod
+  def _call(on_done, on_error, *args):
+    try:
+      on_done(*args)
+    except Exception:  # pylint: disable=W0703
+      on_error(sys.exc_info())
+
+  def close(self):
+    """Stops the supervisor thread. Steps which are still running are killed,
+    and steps which haven't been launched yet are dropped; both are reported
+    to their on_error as Cancelled."""
+    with self._lock:
+      if self._closed:
+        return
+      self._closed = True
+      dropped = list(self._queue)
+      self._queue.clear()
+    os.write(self._wake_w, 'x')
+    self._thread.join()
+    os.close(self._wake_r)
+    os.close(self._wake_w)
+    for _, _, on_error in dropped:
+      on_error(self._cancelled())
+
+  @staticmethod
+  def _cancelled():
+    try:
+      raise Cancelled('step cancelled by StepLoop.close()')
+    except Cancelled:
+      return sys.exc_info()
+
+  def _run(self):
+    poller = select.poll()
+    poller.register(self._wake_r, select.POLLIN)
+    owners = {}
+    while True:
+      with self._lock:
+        incoming, self._incoming = self._incoming, []
+        closed = self._closed
+      for child in incoming:
+        self._children.append(child)
+        for fd in child.open_fds:
+          owners[fd] = child
+          poller.register(fd, _POLL_IN)
+
+      if closed:
+        for child in list(self._children):
+          self._cancel(child, poller, owners)
+        return
+
+      timeout = self._poll_timeout()
+      try:
+        events = poller.poll(
+            None if timeout is None else int(math.ceil(timeout * 1000)))
+      except select.error as e:
+        if e.args[0] != errno.EINTR:
+          raise
+        events = []
+
+      for fd, _ in events:
+        if fd == self._wake_r:
+          os.read(self._wake_r, 4096)
+          continue
+        child = owners.get(fd)
+        if child is None:
+          continue
+        try:
+          self._read(child, fd, poller, owners)
+        except Exception:  # pylint: disable=W0703
+          self._fail(child, sys.exc_info(), poller, owners)
+
+      now = time.time()
+      for child in list(self._children):
+        try:
+          self._check(child, now, poller, owners)
+        except Exception:  # pylint: disable=W0703
+          self._fail(child, sys.exc_info(), poller, owners)
+
+  def _poll_timeout(self):
+    now = time.time()
+    timeouts = []
+    for child in self._children:
+      if not child.open_fds and not child.exited:
+        timeouts.append(_REAP_INTERVAL)
+      deadline = child.deadline()
+      if deadline is not None:
+        timeouts.append(max(0, deadline[0] - now))
+    return min(timeouts) if timeouts else None
+
+  def _read(self, child, fd, poller, owners):
+    index, outhandle, chunk_filter = child.readers[fd]
+    try:
+      data = os.read(fd, self._read_size)
+    except OSError as e:
+      if e.errno == errno.EINTR:
+        return
+      raise
+    if data:
+      child.counts[index] += len(data)
+      child.last_output = time.time()
+      data = chunk_filter.feed(data)
+    else:
+      data = chunk_filter.close()
+      poller.unregister(fd)
+      del owners[fd]
+      child.open_fds.discard(fd)
+    if data:
+      outhandle.write(data)
+      outhandle.flush()
+
+  def _check(self, child, now, poller, owners):
+    """Applies |child|'s timeouts, and completes it once its output is done
+    and its process has exited."""
+    deadline = child.deadline()
+    if deadline is not None and now >= deadline[0]:
+      if deadline[1] == 'kill':
+        _kill_group(child.proc.pid, signal.SIGKILL)
+        child.killed = True
+      else:
+        child.timed_out = deadline[1]
+        _kill_group(child.proc.pid, signal.SIGTERM)
+        child.kill_at = now + self._grace_period
+
+    if child.open_fds:
+      return
+    if not child.exited:
+      if not isinstance(child.proc, subprocess.Popen):
+        # Python workers and executors report the exit status right after the
+        # step's output ends.
+        child.rusage = child.proc.wait()
+      else:
+        pid, status, rusage = os.wait4(child.proc.pid, os.WNOHANG)
+        if not pid:
+          return
+        # Reaped, so Popen can't wait() for it; record its returncode the
+        # way Popen would.
+        if os.WIFSIGNALED(status):
+          child.proc.returncode = -os.WTERMSIG(status)
+        else:
+          child.proc.returncode = os.WEXITSTATUS(status)
+        child.rusage = rusage
+      child.exited = True
+
+    self._children.remove(child)
+    self._call(child.on_done, child.on_error,
+               child.counts, child.rusage, child.timed_out)
+    self._launch_queued()
+
+  def _forget(self, child, poller, owners):
+    for fd in child.open_fds:
+      poller.unregister(fd)
+      del owners[fd]
+    child.open_fds.clear()
+    if child in self._children:
+      self._children.remove(child)
+
+  def _fail(self, child, exc_info, poller, owners):
+    self._forget(child, poller, owners)
+    child.on_error(exc_info)
+    self._launch_queued()
+
+  def _cancel(self, child, poller, owners):
+    self._forget(child, poller, owners)
+    if not child.exited:
+      _kill_group(child.proc.pid, signal.SIGKILL)
+      child.proc.wait()
+    child.on_error(self._cancelled())
@@ -0,0 +1,140 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Computes the steps a recipe would run, without running them.
+
+A plan runs RunSteps like a simulation test with no test data: every step
+gets its default placeholder data and retcode 0, and nothing is executed.
+The steps are recorded as they are rendered, so the plan lists their
+commands, working directories, environment overrides and declared inputs
+and outputs, e.g. for prefetching inputs or warming caches before the real
+run starts.
+
+Paths are rendered with the machine's real path config (the path module gets
+no test data), so they are the ones the real run would use; note that this
+means api.path.exists() looks at the real filesystem, and api.path.mkdtemp()
+really creates its directory. Temporary placeholder files only exist during the
+real run, so in a step's 'cmd' each is given as [PLACEHOLDER:<n>], <n>
+indexing the step's 'placeholders'.
+
+Steps which depend on the results of earlier ones are planned as if those
+results were the defaults, and a recipe which can't cope with default data
+ends the plan early; the plan's status_code and reason say so.
+"""
+
+import json
+import os
+
+from . import recipe_test_api
+
+
+class PlanTestData(recipe_test_api.TestData):
+  """Test data with nothing but defaults, under which any exception the
+  recipe raises ends the plan instead of propagating."""
+
+  def __init__(self):
+    super(PlanTestData, self).__init__('plan')
+
+  def is_unexpected_exception(self, exception):
+    return False
+
+  def get_module_test_data(self, module_name):
+    if module_name == 'path':
+      return recipe_test_api.DisabledTestData()
+    return super(PlanTestData, self).get_module_test_data(module_name)
+
+
+def _placeholders(placeholders):
+  """Yields (placeholder, description) for every placeholder a step uses."""
+  for module_name in sorted(placeholders.cmd):
+    pholders = placeholders.cmd[module_name]
+    for placeholder_name in sorted(pholders):
+      for ph, _ in pholders[placeholder_name]:
+        yield ph, '%s.%s' % (module_name, placeholder_name)
+  for key in ('stdin', 'stdout', 'stderr'):
+    ph, _ = getattr(placeholders, key)
+    if ph:
+      yield ph, key
+
+
+class PlanRecorder(object):
+  """Records the steps a RecipeEngine prepares."""
+
+  def __init__(self):
+    self._steps = []
+    self.status_code = None
+    self.reason = None
+
+  @property
+  def steps(self):
+    return self._steps
+
+  def add(self, prepared):
+    """Records a run.PreparedStep."""
+    step = prepared.step
+    inputs = map(str, step.get('cache_inputs', ()))
+    outputs = []
+    placeholders = []
+    temporaries = {}
+    for ph, name in _placeholders(prepared.placeholders):
+      role = getattr(ph, 'cache_role', None)
+      # Only placeholders' files named by the recipe are known before the run;
+      # the others are temporary files, rendered with made up paths.
+      if getattr(ph, 'leak_to', None):
+        if role == 'output':
+          outputs.append(str(ph.leak_to))
+      else:
+        try:
+          path = ph.backing_file
+        except (AttributeError, ValueError):
+          path = None  # Output directories don't expose theirs.
+        if path:
+          temporaries[path] = '[PLACEHOLDER:%d]' % len(placeholders)
+      placeholders.append({'name': name, 'role': role})
+
+    self._steps.append({
+        'name': step['name'],
+        'cmd': [temporaries.get(str(item), str(item)) for item in step['cmd']],
+        'cwd': step.get('cwd') and str(step['cwd']),
+        'env': step.get('env') or {},
+        'nest_level': prepared.nest_level,
+        'infra_step': prepared.infra_step,
+        'cacheable': bool(step.get('cacheable')),
+        'inputs': inputs,
+        'outputs': outputs,
+        'placeholders': placeholders,
+    })
+
+  def to_json(self):
+    return {
+        'status_code': self.status_code,
+        'reason': self.reason,
+        'steps': self._steps,
+    }
+
+  def write(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.to_json(), f, indent=2, sort_keys=True)
+      f.write('\n')
+
+
+def plan(universe, properties):
+  """Plans the recipe named by properties['recipe'].
+
+  Returns the PlanRecorder.
+  """
+  from . import run
+  from .third_party import annotator
+
+  recorder = PlanRecorder()
+  with open(os.devnull, 'w') as devnull:
+    stream = annotator.StructuredAnnotationStream(stream=devnull)
+    result = run.run_steps(
+        properties, stream, universe, PlanTestData(), plan_recorder=recorder)
+  recorder.status_code = result.status_code
+  if result.steps_ran:
+    final = result.steps_ran.get('$final_result')
+    if final:
+      recorder.reason = final['reason']
+  return recorder
@@ -4,10 +4,18 @@
 
 """Contains the parsing system of the Chromium Buildbot Annotator."""
 
+import collections
+import json
+import mmap
 import os
+import re
+import stat
 import sys
+import threading
 import traceback
 
+from cStringIO import StringIO
+
 # These are maps of annotation key -> number of expected arguments.
 STEP_ANNOTATIONS = {
     'SET_BUILD_PROPERTY': 2,
@@ -70,6 +78,9 @@ OLD_STYLE_ANNOTATIONS = set((
 
 
 def emit(line, stream, flush_before=None):
+  if isinstance(stream, (BufferedAnnotationSink, JsonEventSink)):
+    stream.emit(line)
+    return
   if flush_before:
     flush_before.flush()
   print >> stream
@@ -85,6 +96,227 @@ def emit(line, stream, flush_before=None):
   stream.flush()
 
 
+def _write_console(stream, data):
+  # WinDOS can only handle 64kb of output to the console at a time, per process.
+  if sys.platform.startswith('win'):
+    lim = 2**15
+    while data:
+      to_print, data = data[:lim], data[lim:]
+      stream.write(to_print)
+  else:
+    stream.write(data)
+
+
+class BufferedAnnotationSink(object):
+  """Batches annotations on their way to |stream|.
+
+  Pass an instance as the |stream| of a StructuredAnnotationStream. Rather than
+  writing and flushing each annotation as it is emitted, annotations are
+  collected and written out together when:
+    * a step starts or ends (StructuredAnnotationStream flushes the sink),
+    * more than |max_size| bytes are pending,
+    * the oldest pending annotation is |max_latency| seconds old, or
+    * flush() or close() is called.
+  |flush_before| is flushed before each batch is written.
+
+  In |strict| mode every annotation is written through immediately, after
+  flushing |flush_before|, which keeps the exact ordering with respect to
+  |flush_before| that unbuffered emission provides. It still saves a write per
+  annotation.
+  """
+
+  def __init__(self, stream=sys.stdout, flush_before=sys.stderr,
+               max_size=64 * 1024, max_latency=1.0, strict=False):
+    self.stream = stream
+    self.flush_before = flush_before
+    self.max_size = max_size
+    self.max_latency = max_latency
+    self.strict = strict
+
+    self._lock = threading.Lock()
+    self._pending = []
+    self._pending_size = 0
+    self._timer = None
+
+  def emit(self, line):
+    data = '\n%s\n' % line
+    with self._lock:
+      self._pending.append(data)
+      self._pending_size += len(data)
+      if self.strict or self._pending_size >= self.max_size:
+        self._flush_locked()
+      elif self._timer is None and self.max_latency is not None:
+        self._timer = threading.Timer(self.max_latency, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+  def write(self, data):
+    """Writes non-annotation |data|, after any pending annotations."""
+    with self._lock:
+      self._flush_locked()
+      _write_console(self.stream, data)
+
+  def flush(self):
+    with self._lock:
+      self._flush_locked()
+
+  def close(self):
+    self.flush()
+
+  def _flush_locked(self):
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+    if self._pending:
+      if self.flush_before:
+        self.flush_before.flush()
+      data = ''.join(self._pending)
+      self._pending = []
+      self._pending_size = 0
+      _write_console(self.stream, data)
+    self.stream.flush()
+
+
+def _to_json_text(value):
+  # Log lines may hold arbitrary bytes, which json can't encode as-is.
+  if isinstance(value, str):
+    return value.decode('utf-8', 'replace')
+  return value
+
+
+class _AnnotationCapture(object):
+  """MatchAnnotation callback which records the annotation it was given."""
+
+  def __init__(self):
+    self.annotation = None
+
+  def __getattr__(self, name):
+    def capture(*args):
+      self.annotation = (name, args)
+    return capture
+
+
+class JsonEventSink(object):
+  """Writes annotations as JSON-lines events, and everything else separately.
+
+  Pass an instance as the |stream| of a StructuredAnnotationStream. Each
+  annotation becomes one line on |events|, e.g.
+    {"seq":7,"event":"STEP_LINK","step":"compile","args":["label","url"],
+     "output_offset":1024}
+  where |step| is the step the annotation applies to (the last STEP_CURSOR),
+  and |output_offset| is the number of bytes written to |output| before the
+  event, so that consumers can attribute output to steps without reading it.
+
+  Everything which isn't an annotation (step output, and the engine's own
+  messages) goes to |output| untouched. The exception is output lines which a
+  step emits as subannotations: step output is escaped unless subannotations
+  are allowed, so any complete output line which still looks like an
+  annotation is converted into an event too.
+  """
+
+  def __init__(self, events=sys.stdout, output=sys.stderr):
+    self.events = events
+    self.output = output
+    self._lock = threading.RLock()
+    self._seq = 0
+    self._step = None
+    self._output_offset = 0
+    self._at_line_start = True
+    self._partial = ''
+
+  def emit_event(self, name, args):
+    with self._lock:
+      if name == 'STEP_CURSOR':
+        self._step = args[0]
+      event = {
+        'seq': self._seq,
+        'event': name,
+        'args': [_to_json_text(a) for a in args],
+        'output_offset': self._output_offset,
+      }
+      if self._step is not None:
+        event['step'] = self._step
+      self._seq += 1
+      self.events.write(json.dumps(event, separators=(',', ':')) + '\n')
+
+  def emit(self, line):
+    """Writes a line of text from the engine to |output|."""
+    self.write('%s\n' % (line,))
+
+  def write(self, data):
+    """Writes step output to |output|, converting subannotations to events."""
+    with self._lock:
+      data = self._partial + data
+      self._partial = ''
+      for line in data.splitlines(True):
+        if self._at_line_start and line.startswith('@@@'[:len(line)]):
+          if not line.endswith('\n'):
+            # Might still become an annotation.
+            self._partial = line
+            break
+          annotation = self._parse_annotation(line.rstrip('\r\n'))
+          if annotation:
+            self.emit_event(*annotation)
+            continue
+        self._write_output(line)
+
+  def _parse_annotation(self, line):
+    capture = _AnnotationCapture()
+    try:
+      MatchAnnotation(line, capture)
+    except Exception:  # pylint: disable=W0703
+      return None
+    return capture.annotation
+
+  def _write_output(self, data):
+    _write_console(self.output, data)
+    self._output_offset += len(data)
+    self._at_line_start = data.endswith('\n')
+
+  def flush(self):
+    with self._lock:
+      self.output.flush()
+      self.events.flush()
+
+  def close(self):
+    with self._lock:
+      if self._partial:
+        self._write_output(self._partial)
+        self._partial = ''
+    self.flush()
+
+  def new_buffer(self):
+    """Returns a sink which records events and output until replay()ed."""
+    return _RecordingEventSink()
+
+  def replay(self, buf):
+    """Writes out, and forgets, everything recorded in a buffer from
+    new_buffer()."""
+    with self._lock:
+      for method, args in buf.records:
+        getattr(self, method)(*args)
+      del buf.records[:]
+
+
+class _RecordingEventSink(JsonEventSink):
+  """A JsonEventSink which only records what it is given. See new_buffer()."""
+
+  def __init__(self):  # pylint: disable=W0231
+    self.records = []
+
+  def emit_event(self, name, args):
+    self.records.append(('emit_event', (name, args)))
+
+  def write(self, data):
+    self.records.append(('write', (data,)))
+
+  def flush(self):
+    pass
+
+  def close(self):
+    pass
+
+
 class MetaAnnotationPrinter(type):
   def __new__(mcs, name, bases, dct):
     annotation_map = dct.get('ANNOTATIONS')
@@ -111,7 +343,10 @@ class MetaAnnotationPrinter(type):
     def printer(self, *args):
       if len(args) != n_args:
         raise TypeError(err % (len(args) + 1))
-      self.emit(fmt % args)
+      if isinstance(self.stream, JsonEventSink):
+        self.stream.emit_event(upname, args)
+      else:
+        self.emit(fmt % args)
     printer.__name__ = name
     printer.__doc__ = """Emits an annotation for %s.""" % name.upper()
 
@@ -201,6 +436,7 @@ class StructuredAnnotationStep(StepCommands, StepControlCommands):
 
   def step_started(self):
     self.control.step_started()
+    self.annotation_stream.flush()
     return self
 
   def __exit__(self, exc_type, exc_value, tb):
@@ -211,6 +447,7 @@ class StructuredAnnotationStep(StepCommands, StepControlCommands):
 
     self.control.step_closed()
     self.annotation_stream.current_step = ''
+    self.annotation_stream.flush()
     return not exc_type
 
   def step_exception_occured(self, exc_type, exc_value, tb):
@@ -223,6 +460,7 @@ class StructuredAnnotationStep(StepCommands, StepControlCommands):
     self.annotation_stream.step_cursor(self.annotation_stream.current_step)
     self.control.step_closed()
     self.annotation_stream.current_step = ''
+    self.annotation_stream.flush()
 
     return True
 
@@ -268,6 +506,39 @@ class StructuredAnnotationStream(AnnotationPrinter):
     return StructuredAnnotationStep(self, stream=self.stream,
                                     flush_before=self.flush_before)
 
+  def flush(self):
+    """Writes out any annotations held by a BufferedAnnotationSink or
+    JsonEventSink."""
+    if isinstance(self.stream, (BufferedAnnotationSink, JsonEventSink)):
+      self.stream.flush()
+
+  @property
+  def output(self):
+    """Where step output should be written, or None if it should go straight
+    to the process's stdout and stderr."""
+    if isinstance(self.stream, JsonEventSink):
+      return self.stream
+    return None
+
+  def new_buffer(self):
+    """Returns a buffer to use as the |stream| (and output) of a step's own
+    StructuredAnnotationStream, whose contents are held back until they are
+    passed to write_buffer(). A buffer can be written out more than once; each
+    time, what was added since the last."""
+    if isinstance(self.stream, JsonEventSink):
+      return self.stream.new_buffer()
+    return StringIO()
+
+  def write_buffer(self, buf):
+    """Writes out, and empties, a buffer from new_buffer()."""
+    if isinstance(self.stream, JsonEventSink):
+      self.stream.replay(buf)
+    else:
+      self.stream.write(buf.getvalue())
+      buf.seek(0)
+      buf.truncate()
+    self.stream.flush()
+
 
 def MatchAnnotation(line, callback_implementor):
   """Call back into |callback_implementor| if line contains an annotation.
@@ -322,6 +593,158 @@ def MatchAnnotation(line, callback_implementor):
   fn(*args)
 
 
+# An annotation found by parse_annotations. |command| is the annotation's
+# canonical name (deprecated aliases are resolved), |args| a tuple of its
+# arguments, and |offset| the position of its line in the input.
+Annotation = collections.namedtuple('Annotation', 'offset command args')
+
+# Annotation lines, other than one at the very start of the input: searching
+# for a literal '\n@@@' is much faster than anchoring on line starts. Lines
+# may end in '\r\n', as logs written on Windows do.
+_ANNOTATION_LINE_RE = re.compile(r'\n@@@([^\r\n]*)@@@(?=\r?(?:\n|\Z))')
+_FIRST_ANNOTATION_LINE_RE = re.compile(r'@@@([^\r\n]*)@@@(?=\r?(?:\n|\Z))')
+# Splits an annotation into its command and the rest, the same way
+# MatchAnnotation does.
+_COMMAND_RE = re.compile(r'(.[^@ ]*)(?:[@ ](.*))?\Z', re.S)
+
+# Bytes read at a time from sources which can't be mapped into memory.
+PARSE_CHUNK_SIZE = 1024 * 1024
+
+
+def _parse_annotation(offset, body, ignore_errors):
+  """Returns the Annotation for the text between the @@@s of an annotation
+  line, or None if it should be skipped."""
+  cmd_text, rest = _COMMAND_RE.match(body).groups()
+  cmd = DEPRECATED_ALIASES.get(cmd_text, cmd_text)
+  field_count = ALL_ANNOTATIONS.get(cmd)
+
+  error = None
+  if field_count is None:
+    error = 'Unrecognized annotator command "%s"' % cmd_text
+  elif field_count:
+    args = tuple(rest.split('@', field_count - 1)) if rest is not None else ()
+    if len(args) != field_count:
+      error = 'Annotator command "%s" expects %d args, got %d.' % (
+          cmd_text, field_count, len(args))
+  else:
+    args = ()
+    if rest is not None:
+      error = 'Annotator command "%s" expects no args, got cruft "%s".' % (
+          cmd_text, body[len(cmd_text):])
+
+  if error:
+    if ignore_errors:
+      return None
+    raise Exception('%s (at offset %d)' % (error, offset))
+  return Annotation(offset, cmd, args)
+
+
+def _parse_buffer(buf, base_offset, ignore_errors):
+  """Yields the Annotations in |buf|, which starts at a line boundary."""
+  first = _FIRST_ANNOTATION_LINE_RE.match(buf)
+  if first and first.group(1):
+    annotation = _parse_annotation(base_offset, first.group(1), ignore_errors)
+    if annotation:
+      yield annotation
+  for match in _ANNOTATION_LINE_RE.finditer(buf):
+    body = match.group(1)
+    if not body:
+      continue
+    annotation = _parse_annotation(
+        base_offset + match.start() + 1, body, ignore_errors)
+    if annotation:
+      yield annotation
+
+
+def _mapped_file(f):
+  """Returns a read-only mmap of the file object |f|, or None if it isn't a
+  regular, non-empty file."""
+  try:
+    fileno = f.fileno()
+    st = os.fstat(fileno)
+  except (AttributeError, IOError, OSError):
+    return None
+  if not stat.S_ISREG(st.st_mode) or not st.st_size:
+    return None
+  return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+
+
+def _iter_chunks(source, chunk_size):
+  if hasattr(source, 'read'):
+    return iter(lambda: source.read(chunk_size), '')
+  return iter(source)
+
+
+def parse_annotations(source, ignore_errors=False,
+                      chunk_size=PARSE_CHUNK_SIZE):
+  """Yields an Annotation for every annotation line in |source|.
+
+  Annotations are recognized with precompiled regular expressions over large
+  buffers, rather than line by line in python, and parsed like
+  MatchAnnotation parses them.
+
+  Args:
+    source - One of:
+      * a str, buffer or mmap, which is searched in place,
+      * a file object; regular files are mmap'd, others are read in chunks of
+        |chunk_size| bytes,
+      * an iterator of byte strings, split anywhere.
+    ignore_errors (bool) - If True, lines which look like annotations but
+      aren't valid are skipped. Otherwise they raise an Exception, as
+      MatchAnnotation does.
+  """
+  if isinstance(source, (str, buffer, mmap.mmap)):
+    for annotation in _parse_buffer(source, 0, ignore_errors):
+      yield annotation
+    return
+
+  mapped = _mapped_file(source) if hasattr(source, 'fileno') else None
+  if mapped is not None:
+    try:
+      for annotation in _parse_buffer(mapped, 0, ignore_errors):
+        yield annotation
+    finally:
+      mapped.close()
+    return
+
+  offset = 0
+  pending = ''
+  for chunk in _iter_chunks(source, chunk_size):
+    pending += chunk
+    end = pending.rfind('\n')
+    if end == -1:
+      continue
+    # The lookahead of the line regexps needs the final newline, so cut just
+    # after it; the next buffer then starts at a line boundary.
+    buf, pending = pending[:end + 1], pending[end + 1:]
+    for annotation in _parse_buffer(buf, offset, ignore_errors):
+      yield annotation
+    offset += len(buf)
+  if pending:
+    for annotation in _parse_buffer(pending, offset, ignore_errors):
+      yield annotation
+
+
+def parse_annotations_batched(source, callback, batch_size=1000, **kwargs):
+  """Calls |callback| with lists of up to |batch_size| Annotations from
+  |source|, in order. Takes the same arguments as parse_annotations.
+
+  Returns the number of annotations found.
+  """
+  batch = []
+  count = 0
+  for annotation in parse_annotations(source, **kwargs):
+    batch.append(annotation)
+    if len(batch) >= batch_size:
+      callback(batch)
+      count += len(batch)
+      batch = []
+  if batch:
+    callback(batch)
+    count += len(batch)
+  return count
+
+
 def print_step(step, env, stream):
   """Prints the step command and relevant metadata.
 
@@ -0,0 +1,107 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""Records where the time of a recipe run goes, as Chrome trace events.
+
+A TraceRecorder collects a 'complete' event (with a start time and a duration)
+for each step, api.step.nest block, composite step and defer_results block,
+and writes them in the JSON format understood by chrome://tracing and
+Perfetto. Steps run by run_steps_parallel show up on the thread that ran them.
+
+Only one recorder is active at a time; while none is, span() costs a global
+lookup.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+_ACTIVE = None
+
+
+class TraceRecorder(object):
+  def __init__(self, clock=time.time):
+    self._clock = clock
+    self._start = clock()
+    self._lock = threading.Lock()
+    self._events = []
+    self._threads = {}
+
+  def now(self):
+    return self._clock()
+
+  def complete(self, name, category, start, end, args=None):
+    """Records an event which started and ended at the |clock| times |start|
+    and |end|, on the current thread."""
+    thread = threading.current_thread()
+    event = {
+      'name': name,
+      'cat': category,
+      'ph': 'X',
+      'ts': int((start - self._start) * 1e6),
+      'dur': int((end - start) * 1e6),
+      'pid': os.getpid(),
+      'tid': thread.ident,
+    }
+    if args:
+      event['args'] = args
+    with self._lock:
+      self._events.append(event)
+      self._threads[thread.ident] = thread.name
+
+  @contextlib.contextmanager
+  def span(self, name, category, args=None):
+    start = self._clock()
+    try:
+      yield
+    finally:
+      self.complete(name, category, start, self._clock(), args)
+
+  def to_json(self):
+    with self._lock:
+      events = [{
+        'name': 'thread_name',
+        'ph': 'M',
+        'pid': os.getpid(),
+        'tid': tid,
+        'args': {'name': name},
+      } for tid, name in sorted(self._threads.iteritems())]
+      events.extend(sorted(self._events, key=lambda e: e['ts']))
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+  def write(self, path):
+    with open(path, 'w') as f:
+      json.dump(self.to_json(), f)
+
+
+def active():
+  """Returns the active TraceRecorder, or None."""
+  return _ACTIVE
+
+
+@contextlib.contextmanager
+def recording(recorder):
+  """Makes |recorder| (which may be None) the active TraceRecorder."""
+  global _ACTIVE
+  old = _ACTIVE
+  _ACTIVE = recorder
+  try:
+    yield
+  finally:
+    _ACTIVE = old
+
+
+@contextlib.contextmanager
+def span(name, category, args=None):
+  """Records the body of the with statement in the active TraceRecorder, if
+  there is one."""
+  recorder = _ACTIVE
+  if recorder is None:
+    yield
+    return
+  with recorder.span(name, category, args):
+    yield
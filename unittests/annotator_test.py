@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+from cStringIO import StringIO
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine.third_party import annotator
+
+
+class CountingStream(object):
+  def __init__(self):
+    self.buf = StringIO()
+    self.writes = 0
+    self.flushes = 0
+
+  def write(self, data):
+    self.writes += 1
+    self.buf.write(data)
+
+  def flush(self):
+    self.flushes += 1
+
+  def getvalue(self):
+    return self.buf.getvalue()
+
+
+class TestBufferedAnnotationSink(unittest.TestCase):
+  def _stream(self, **kwargs):
+    out = CountingStream()
+    sink = annotator.BufferedAnnotationSink(
+        stream=out, flush_before=None, max_latency=None, **kwargs)
+    return out, annotator.StructuredAnnotationStream(stream=sink)
+
+  def _run_step(self, stream):
+    with stream.step('compile') as s:
+      s.write_log_lines('log', ['line %d' % i for i in xrange(1000)])
+
+  def testSameOutputAsUnbuffered(self):
+    plain = StringIO()
+    self._run_step(annotator.StructuredAnnotationStream(
+        stream=plain, flush_before=None))
+    out, stream = self._stream()
+    self._run_step(stream)
+    self.assertEqual(plain.getvalue(), out.getvalue())
+
+  def testBatchesUntilStepBoundary(self):
+    out, stream = self._stream()
+    self._run_step(stream)
+    # One batch for the step's start, and one for the logs and the close.
+    self.assertEqual(2, out.writes)
+
+  def testSizeThreshold(self):
+    out, stream = self._stream(max_size=1024)
+    self._run_step(stream)
+    self.assertLess(out.writes, 40)
+    self.assertGreater(out.writes, 2)
+
+  def testStrictWritesThrough(self):
+    out, stream = self._stream(strict=True)
+    self._run_step(stream)
+    self.assertGreater(out.writes, 1000)
+
+  def testLatencyTimer(self):
+    out = CountingStream()
+    sink = annotator.BufferedAnnotationSink(
+        stream=out, flush_before=None, max_latency=0.01)
+    sink.emit('@@@STEP_TEXT@hi@@@')
+    sink._timer.join()  # pylint: disable=W0212
+    self.assertEqual('\n@@@STEP_TEXT@hi@@@\n', out.getvalue())
+
+
+class TestJsonEventSink(unittest.TestCase):
+  def setUp(self):
+    self.events = StringIO()
+    self.output = StringIO()
+    self.sink = annotator.JsonEventSink(events=self.events, output=self.output)
+    self.stream = annotator.StructuredAnnotationStream(stream=self.sink)
+
+  def _events(self):
+    return [json.loads(l) for l in self.events.getvalue().splitlines()]
+
+  def testStepEvents(self):
+    with self.stream.step('compile') as s:
+      s.step_link('logs', 'http://example.com')
+      s.write_log_lines('log', ['a'])
+    self.assertEqual(
+        [('SEED_STEP', ['compile']), ('STEP_CURSOR', ['compile']),
+         ('STEP_STARTED', []), ('STEP_LINK', ['logs', 'http://example.com']),
+         ('STEP_LOG_LINE', ['log', 'a']), ('STEP_LOG_END', ['log']),
+         ('STEP_CURSOR', ['compile']), ('STEP_CLOSED', [])],
+        [(e['event'], e['args']) for e in self._events()])
+    self.assertEqual(range(8), [e['seq'] for e in self._events()])
+    self.assertEqual('compile', self._events()[-1]['step'])
+    self.assertEqual('', self.output.getvalue())
+
+  def testOutputIsSeparate(self):
+    with self.stream.step('compile') as s:
+      self.stream.emit('running compile')
+      self.sink.write('step output\n')
+      s.step_text('done')
+    self.assertEqual('running compile\nstep output\n', self.output.getvalue())
+    text = [e for e in self._events() if e['event'] == 'STEP_TEXT'][0]
+    self.assertEqual(len(self.output.getvalue()), text['output_offset'])
+
+  def testSubannotations(self):
+    self.sink.write('out @@@\n@@@STEP_TEXT@f')
+    self.sink.write(
+        'rom step@@@\n@@@NOT_AN_ANNOTATION@@@\n!@@@STEP_TEXT@x@@@\n')
+    self.sink.close()
+    self.assertEqual(
+        'out @@@\n@@@NOT_AN_ANNOTATION@@@\n!@@@STEP_TEXT@x@@@\n',
+        self.output.getvalue())
+    self.assertEqual([('STEP_TEXT', ['from step'])],
+                     [(e['event'], e['args']) for e in self._events()])
+
+  def testBuffersReplayInOrder(self):
+    buf = self.stream.new_buffer()
+    step_stream = annotator.StructuredAnnotationStream(stream=buf)
+    with step_stream.step('shard') as s:
+      buf.write('shard output\n')
+      s.step_text('ok')
+    self.assertEqual('', self.events.getvalue())
+    self.stream.write_buffer(buf)
+    self.assertEqual('shard output\n', self.output.getvalue())
+    self.assertEqual(
+        ['SEED_STEP', 'STEP_CURSOR', 'STEP_STARTED', 'STEP_TEXT',
+         'STEP_CURSOR', 'STEP_CLOSED'],
+        [e['event'] for e in self._events()])
+    self.assertEqual('shard', self._events()[-1]['step'])
+    # Only what was added since is written out again.
+    buf.write('more output\n')
+    self.stream.write_buffer(buf)
+    self.assertEqual('shard output\nmore output\n', self.output.getvalue())
+    self.assertEqual(6, len(self._events()))
+
+  def testBinaryLogLines(self):
+    with self.stream.step('compile') as s:
+      s.write_log_lines('log', ['\xff'])
+    self.assertEqual(u'\ufffd', self._events()[3]['args'][1])
+
+
+class TestParseAnnotations(unittest.TestCase):
+  LOG = ('@@@SEED_STEP@compile@@@\n'
+         'output @@@STEP_TEXT@not this@@@\n'
+         '@@@BUILD_STEP compile@@@\n'
+         '@@@STEP_LOG_LINE@log@a@b@@@\n'
+         '@@@@@@\n'
+         '@@@STEP_TEXT@crlf@@@\r\n'
+         '@@@NOT_AN_ANNOTATION@@@ x\n'
+         '@@@BUILD_FAILED@@@\n'
+         '@@@STEP_CLOSED@@@')
+
+  @staticmethod
+  def _match_lines(data):
+    """Returns what MatchAnnotation finds in |data|, line by line, with the
+    line endings stripped."""
+    found = []
+    class Recorder(object):
+      def __getattr__(self, name):
+        return lambda *args: found.append((name, args))
+    offset = 0
+    for line in data.splitlines(True):
+      before = len(found)
+      annotator.MatchAnnotation(line.rstrip('\r\n'), Recorder())
+      if len(found) > before:
+        name, args = found.pop()
+        found.append(annotator.Annotation(offset, name, args))
+      offset += len(line)
+    return found
+
+  def testMatchesLineByLine(self):
+    annotations = list(annotator.parse_annotations(self.LOG))
+    self.assertEqual(self._match_lines(self.LOG), annotations)
+    self.assertEqual(
+        ['SEED_STEP', 'BUILD_STEP', 'STEP_LOG_LINE', 'STEP_TEXT',
+         'STEP_FAILURE', 'STEP_CLOSED'],
+        [a.command for a in annotations])
+    self.assertEqual(('log', 'a@b'), annotations[2].args)
+
+  def testCrlf(self):
+    log = 'out\r\n@@@STEP_TEXT@a@@@\r\n@@@SEED_STEP@b@@@\r'
+    expected = [annotator.Annotation(5, 'STEP_TEXT', ('a',)),
+                annotator.Annotation(24, 'SEED_STEP', ('b',))]
+    self.assertEqual(expected, list(annotator.parse_annotations(log)))
+    self.assertEqual(expected, list(annotator.parse_annotations(
+        StringIO(log), chunk_size=3)))
+    self.assertEqual([annotator.Annotation(0, 'STEP_TEXT', ('a',))],
+                     list(annotator.parse_annotations('@@@STEP_TEXT@a@@@\r\n')))
+
+  def testChunks(self):
+    chunks = [self.LOG[i:i + 5] for i in xrange(0, len(self.LOG), 5)]
+    self.assertEqual(list(annotator.parse_annotations(self.LOG)),
+                     list(annotator.parse_annotations(iter(chunks))))
+
+  def testFiles(self):
+    expected = list(annotator.parse_annotations(self.LOG))
+    with tempfile.TemporaryFile() as f:
+      f.write(self.LOG)
+      f.seek(0)
+      self.assertEqual(expected, list(annotator.parse_annotations(f)))
+    self.assertEqual(expected, list(annotator.parse_annotations(
+        StringIO(self.LOG), chunk_size=7)))
+
+  def testErrors(self):
+    bad = ('ok\n@@@STEP_TEXT@@@@\n@@@STEP_TEXT@@@\n@@@SEED_STEP@@@\n'
+           '@@@STEP_CLOSED@x@@@\n')
+    with self.assertRaises(Exception):
+      list(annotator.parse_annotations(bad))
+    self.assertEqual(
+        [annotator.Annotation(3, 'STEP_TEXT', ('',))],
+        list(annotator.parse_annotations(bad, ignore_errors=True)))
+
+  def testBatches(self):
+    batches = []
+    count = annotator.parse_annotations_batched(
+        self.LOG, batches.append, batch_size=2)
+    self.assertEqual(6, count)
+    self.assertEqual([2, 2, 2], map(len, batches))
+
+
+if __name__ == '__main__':
+  unittest.main()
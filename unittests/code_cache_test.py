@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import code_cache
+
+
+class TestCodeCache(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.root = os.path.join(self.tmp, 'code_cache')
+    self.script = os.path.join(self.tmp, 'recipe.py')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _write(self, source, mtime):
+    with open(self.script, 'w') as f:
+      f.write(source)
+    os.utime(self.script, (mtime, mtime))
+
+  def _run(self, cache):
+    script_vars = {}
+    exec cache.compile(self.script) in script_vars
+    return script_vars['VALUE']
+
+  def testCachesCode(self):
+    self._write('VALUE = 1\n', 1000)
+    self.assertEqual(1, self._run(code_cache.CodeCache(self.root)))
+    self.assertEqual(1, len(os.listdir(self.root)))
+
+    # Same path, mtime and size: the cached code is used, even by a new cache.
+    self._write('VALUE = 2\n', 1000)
+    self.assertEqual(1, self._run(code_cache.CodeCache(self.root)))
+
+  def testRecompilesChangedScript(self):
+    cache = code_cache.CodeCache(self.root)
+    self._write('VALUE = 1\n', 1000)
+    self.assertEqual(1, self._run(cache))
+    self._write('VALUE = 2\n', 2000)
+    self.assertEqual(2, self._run(cache))
+    self._write('VALUE = 30\n', 2000)
+    self.assertEqual(30, self._run(cache))
+    self.assertEqual(1, len(os.listdir(self.root)))
+
+  def testCorruptEntry(self):
+    cache = code_cache.CodeCache(self.root)
+    self._write('VALUE = 1\n', 1000)
+    self._run(cache)
+    entry = os.path.join(self.root, os.listdir(self.root)[0])
+    with open(entry, 'wb') as f:
+      f.write('garbage')
+    self.assertEqual(1, self._run(cache))
+
+  def testUnwritableRoot(self):
+    with open(self.root, 'w') as f:
+      f.write('not a directory')
+    self._write('VALUE = 1\n', 1000)
+    self.assertEqual(1, self._run(code_cache.CodeCache(self.root)))
+
+  def testCodeKeepsScriptPath(self):
+    self._write('def f():\n  raise ValueError()\n', 1000)
+    code = code_cache.CodeCache(self.root).compile(self.script)
+    self.assertEqual(self.script, code.co_filename)
+
+
+if __name__ == '__main__':
+  unittest.main()
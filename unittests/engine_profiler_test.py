@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import engine_profiler
+
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 0.0
+
+  def __call__(self):
+    return self.now
+
+  def tick(self, seconds):
+    self.now += seconds
+
+
+def make_method(module, name, body):
+  body.__module__ = 'RECIPE_MODULES.%s.api' % module
+  body.__name__ = name
+  return engine_profiler.profiled(body)
+
+
+class TestOverheadProfiler(unittest.TestCase):
+  def setUp(self):
+    self.clock = FakeClock()
+    self.profiler = engine_profiler.OverheadProfiler(clock=self.clock)
+
+  def testAttributesGaps(self):
+    def run_step():
+      self.clock.tick(1)
+      with engine_profiler.blocked():
+        self.clock.tick(10)
+    inner = make_method('git', 'checkout', lambda: run_step())
+    def outer_body():
+      self.clock.tick(2)
+      inner()
+    outer = make_method('bot_update', 'ensure_checkout', outer_body)
+    def steps():
+      self.clock.tick(0.5)
+      outer()
+      outer()
+      return 'done'
+
+    self.assertEqual('done', self.profiler.run(steps))
+    self.assertEqual(
+        [('bot_update.ensure_checkout', 2, 4.0), ('git.checkout', 2, 2.0),
+         (engine_profiler.RECIPE, 0, 0.5)],
+        self.profiler.summary())
+    summary = self.profiler.format_summary()
+    self.assertIn('RunSteps wall time:      26.500s', summary)
+    self.assertIn('Blocked on steps:        20.000s', summary)
+    self.assertIn('Recipe-side overhead:     6.500s', summary)
+    self.assertIsNone(engine_profiler._ACTIVE)  # pylint: disable=W0212
+
+  def testInactive(self):
+    method = make_method('git', 'checkout', lambda: 'x')
+    self.assertEqual('x', method())
+    with engine_profiler.blocked():
+      pass
+
+  def testOtherThreadsAreIgnored(self):
+    method = make_method('git', 'fetch', lambda: self.clock.tick(3))
+    def steps():
+      thread = threading.Thread(target=method)
+      thread.start()
+      thread.join()
+    self.profiler.run(steps)
+    self.assertEqual([(engine_profiler.RECIPE, 0, 3.0)],
+                     self.profiler.summary())
+
+  def testCProfile(self):
+    profiler = engine_profiler.OverheadProfiler(use_cprofile=True)
+    profiler.run(lambda: sum(xrange(1000)))
+    self.assertIn('cProfile self time by module', profiler.format_summary())
+    tmp = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tmp, 'stats')
+      profiler.write_pstats(path)
+      self.assertTrue(pstats.Stats(path).total_calls)
+    finally:
+      shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import loader, recipe_api, recipe_test_api
+
+
+class FakeModule(object):
+  def __init__(self, name, api, deps=None, properties=None):
+    self.NAME = name
+    self.API = api
+    self.LOADED_DEPS = deps or {}
+    self.PROPERTIES = properties or {}
+
+
+class FakeEngine(object):
+  def __init__(self, properties):
+    self.properties = properties
+
+
+class TestApiPlan(unittest.TestCase):
+  def setUp(self):
+    self.created = []
+    created = self.created
+
+    class BaseApi(recipe_api.RecipeApi):
+      def __init__(self, **kwargs):
+        super(BaseApi, self).__init__(**kwargs)
+        created.append(self._module.NAME)
+
+    class PropApi(recipe_api.RecipeApi):
+      def __init__(self, level, module, **kwargs):
+        super(PropApi, self).__init__(module=module, **kwargs)
+        self.level = level
+        created.append(module.NAME)
+
+    #     base
+    #     /  \
+    #   mid  prop
+    #     \  /
+    #     top
+    self.base = FakeModule('base', BaseApi)
+    self.mid = FakeModule('mid', BaseApi, {'base': self.base})
+    self.prop = FakeModule(
+        'prop', PropApi, {'base': self.base},
+        {'level': recipe_api.Property(default=1, kind=int)})
+    self.top = FakeModule('top', BaseApi, {'mid': self.mid, 'p': self.prop})
+    self.deps = {'top': self.top, 'base': self.base}
+
+  def testInstantiatesGraph(self):
+    plan = loader.ApiPlan(self.deps)
+    for level in (3, None):
+      del self.created[:]
+      props = {} if level is None else {'level': level}
+      api = plan.instantiate(FakeEngine(props),
+                             recipe_test_api.DisabledTestData())
+      self.assertEqual(4, len(self.created))
+      self.assertEqual('base', self.created[0])
+      self.assertEqual('top', self.created[-1])
+      # Each module is instantiated once, and shared by its dependents.
+      self.assertIs(api.base, api.top.m.mid.m.base)
+      self.assertIs(api.base, api.top.m.p.m.base)
+      self.assertEqual(level or 1, api.top.m.p.level)
+      self.assertIs(api.top.m.mid.test_api, api.top.test_api.m.mid)
+
+  def testRunsHaveTheirOwnInstances(self):
+    plan = loader.ApiPlan(self.deps)
+    engine = FakeEngine({})
+    first = plan.instantiate(engine, recipe_test_api.DisabledTestData())
+    second = plan.instantiate(engine, recipe_test_api.DisabledTestData())
+    self.assertIsNot(first.base, second.base)
+
+  def testPropertiesAreChecked(self):
+    plan = loader.ApiPlan(self.deps)
+    with self.assertRaises(TypeError):
+      plan.instantiate(FakeEngine({'level': 'high'}),
+                       recipe_test_api.DisabledTestData())
+
+  def testMissingPropertyDefinition(self):
+    self.prop.PROPERTIES = {}
+    with self.assertRaises(recipe_api.UndefinedPropertyException):
+      loader.ApiPlan(self.deps)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import log_store
+
+
+def _spool(lines):
+  spooler = log_store.LogSpooler(lines)
+  written = list(spooler)
+  return written, spooler.view()
+
+
+class TestLogSpooler(unittest.TestCase):
+  def setUp(self):
+    self._threshold = log_store.SPILL_THRESHOLD
+    self._batch_size = log_store.BATCH_SIZE
+    log_store.SPILL_THRESHOLD = 10
+
+  def tearDown(self):
+    log_store.SPILL_THRESHOLD = self._threshold
+    log_store.BATCH_SIZE = self._batch_size
+
+  def testSmallLogsStayInMemory(self):
+    lines = ['a', 'b']
+    written, view = _spool(lines)
+    self.assertEqual(lines, written)
+    self.assertIs(lines, view._lines)
+    self.assertEqual(lines, view)
+
+  def testBigLogsAreSpilled(self):
+    lines = ['line %d' % i for i in xrange(10)] + [u'sn\xf6', '']
+    written, view = _spool(lines)
+    self.assertEqual(lines, written)
+    self.assertIsNone(view._lines)
+    self.assertEqual(12, len(view))
+    self.assertEqual(lines, list(view))
+    self.assertEqual(u'sn\xf6', view[10])
+    self.assertIsInstance(view[10], unicode)
+    self.assertEqual(lines, view)
+
+  def testSpilledInBatches(self):
+    log_store.BATCH_SIZE = 30
+    lines = ['line %d' % i for i in xrange(20)] + [u'sn\xf6']
+    written, view = _spool(lines)
+    self.assertEqual(lines, written)
+    self.assertEqual(7, len(view._spilled[0]))
+    self.assertEqual(lines, list(view))
+    self.assertEqual(lines, [view[i] for i in xrange(len(lines))])
+    self.assertEqual(u'sn\xf6', view[-1])
+    self.assertEqual(lines[3:15:4], view[3:15:4])
+    with self.assertRaises(IndexError):
+      view[21]
+
+  def testSeveralSpilledLogs(self):
+    _, first = _spool(['x' * 20, 'y'])
+    _, second = _spool(['z' * 30])
+    self.assertEqual(['x' * 20, 'y'], list(first))
+    self.assertEqual(['z' * 30], list(second))
+
+  def testNonStringLines(self):
+    lines = ['x' * 20, 3]
+    written, view = _spool(lines)
+    self.assertEqual(lines, written)
+    self.assertEqual(lines, view)
+
+  def testGenerators(self):
+    written, view = _spool('line %d' % i for i in xrange(5))
+    self.assertEqual(written, list(view))
+
+  def testReadOnly(self):
+    _, view = _spool(['a'])
+    with self.assertRaises(TypeError):
+      view[0] = 'b'
+    self.assertFalse(hasattr(view, 'append'))
+
+
+if __name__ == '__main__':
+  unittest.main()
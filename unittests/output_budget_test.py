@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from cStringIO import StringIO
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import output_budget
+
+
+class TestOutputBudget(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _write(self, budget, chunks):
+    out = StringIO()
+    bounded = budget.wrap(out, 'compile (2)', 'stdout')
+    for chunk in chunks:
+      bounded.write(chunk)
+    return out, bounded.close()
+
+  def testFits(self):
+    budget = output_budget.OutputBudget(20, side_dir=self.tmp)
+    out, truncation = self._write(budget, ['0123456789\n', 'abcdefghi'])
+    self.assertIsNone(truncation)
+    self.assertEqual('0123456789\nabcdefghi', out.getvalue())
+    self.assertEqual([], os.listdir(self.tmp))
+
+  def testHeadIsWrittenStraightAway(self):
+    budget = output_budget.OutputBudget(20, side_dir=self.tmp)
+    out = StringIO()
+    bounded = budget.wrap(out, 'step', 'stdout')
+    bounded.write('0123456789abcdef')
+    self.assertEqual('0123456789', out.getvalue())
+    bounded.close()
+
+  def testKeepsHeadAndTail(self):
+    lines = ['line %03d\n' % i for i in xrange(100)]
+    budget = output_budget.OutputBudget(
+        100, head_fraction=0.3, side_dir=self.tmp)
+    out, truncation = self._write(budget, lines)
+
+    data = ''.join(lines)
+    head, rest = out.getvalue().split('\n[', 1)
+    note, tail = rest.split(']\n', 1)
+    self.assertEqual(data[:30], head)
+    # The tail starts at a line boundary, within the last 70 bytes.
+    self.assertEqual(''.join(lines[-7:]), tail)
+    self.assertEqual(len(data) - 30 - len(tail), truncation.dropped_bytes)
+    self.assertIn('%d bytes of output dropped' % truncation.dropped_bytes, note)
+
+    self.assertEqual(self.tmp, os.path.dirname(truncation.side_path))
+    self.assertTrue(os.path.basename(truncation.side_path).startswith(
+        'compile_2_.'))
+    self.assertTrue(truncation.side_path.endswith('.stdout.gz'))
+    with gzip.open(truncation.side_path) as f:
+      self.assertEqual(data, f.read())
+
+  def testTailDoesNotStartMidLine(self):
+    budget = output_budget.OutputBudget(10, side_dir=self.tmp)
+    out, truncation = self._write(
+        budget, ['head\n', 'x' * 100, ' @@@STEP_FAILURE@@@\n'])
+    self.assertFalse(out.getvalue().endswith('@@@STEP_FAILURE@@@\n'))
+    self.assertTrue(out.getvalue().endswith(truncation.side_path + ']\n'))
+
+  def testTailStartingOnLineBoundary(self):
+    budget = output_budget.OutputBudget(
+        10, head_fraction=0, side_dir=self.tmp)
+    out, truncation = self._write(budget, ['aaaa\n', 'bbbbbbbbb\n'])
+    self.assertEqual(5, truncation.dropped_bytes)
+    self.assertTrue(out.getvalue().endswith(']\nbbbbbbbbb\n'))
+
+    # A tail which begins where a dropped chunk ended mid-line still skips to
+    # the next line.
+    out, truncation = self._write(budget, ['aaaa', 'bbbbbbbbb\n'])
+    self.assertEqual(14, truncation.dropped_bytes)
+    self.assertTrue(out.getvalue().endswith(truncation.side_path + ']\n'))
+
+  def testForStep(self):
+    budget = output_budget.OutputBudget(100, head_fraction=0.2)
+    self.assertIs(budget, budget.for_step(None))
+    self.assertEqual((50, 0.2), (budget.for_step(50).limit,
+                                 budget.for_step(50).head_fraction))
+    out = StringIO()
+    self.assertIs(out, budget.for_step(0).wrap(out, 'step', 'stdout'))
+
+
+if __name__ == '__main__':
+  unittest.main()
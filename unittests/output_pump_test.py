@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import subprocess
+import sys
+import unittest
+
+from cStringIO import StringIO
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import output_pump
+
+
+def _filter(chunks, allow_subannotations=False):
+  f = output_pump.ChunkFilter(allow_subannotations)
+  return ''.join([f.feed(c) for c in chunks] + [f.close()])
+
+
+class TestChunkFilter(unittest.TestCase):
+  def testEscapesAnnotations(self):
+    self.assertEqual(
+        '!@@@STEP_TEXT@hi@@@\nok\n!@@@STEP_FAILURE@@@\n',
+        _filter(['@@@STEP_TEXT@hi@@@\nok\n@@@STEP_FAILURE@@@\n']))
+
+  def testAllowSubannotations(self):
+    self.assertEqual(
+        '@@@STEP_FAILURE@@@\n',
+        _filter(['@@@STEP_FAILURE@@@\n'], allow_subannotations=True))
+
+  def testOnlyEscapesLineStarts(self):
+    self.assertEqual('a @@@b@@@\n', _filter(['a @@@b@@@\n']))
+
+  def testAnnotationSplitAcrossChunks(self):
+    for split in xrange(1, 8):
+      data = 'x\n@@@STEP_FAILURE@@@\n'
+      self.assertEqual(
+          'x\n!@@@STEP_FAILURE@@@\n',
+          _filter([data[:split], data[split:]]), split)
+
+  def testPartialLineThenAnnotationLookalike(self):
+    self.assertEqual('ab@@@\n', _filter(['a', 'b', '@', '@@\n']))
+
+  def testHeldBackPrefixIsFlushedAtClose(self):
+    self.assertEqual('x\n@@', _filter(['x\n@@']))
+
+  def testUniversalNewlines(self):
+    self.assertEqual('a\nb\nc\n', _filter(['a\r', '\nb\rc\r\n']))
+    self.assertEqual('a\n', _filter(['a\r']))
+
+
+class TestPumps(unittest.TestCase):
+  PROGRAM = (
+      'import sys\n'
+      'for i in xrange(1000):\n'
+      '  sys.stdout.write("line %d\\n" % i)\n'
+      '  if i % 100 == 0:\n'
+      '    sys.stdout.write("@@@STEP_TEXT@%d@@@\\n" % i)\n'
+      'sys.stderr.write("done\\n")\n')
+
+  def _run(self, pump_fn):
+    proc = subprocess.Popen(
+        [sys.executable, '-c', self.PROGRAM], stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE, universal_newlines=True)
+    out, err = StringIO(), StringIO()
+    counts = pump_fn([(proc.stdout, out), (proc.stderr, err)], False)
+    proc.wait()
+    # The bytes the program wrote: the counts don't include the '!'s which
+    # escape its ten annotations.
+    self.assertEqual([9088, 5], counts)
+    return out.getvalue(), err.getvalue()
+
+  @unittest.skipIf(sys.platform.startswith('win'), 'select() needs POSIX')
+  def testPumpsAgree(self):
+    threaded = self._run(output_pump.pump_threaded)
+    self.assertEqual(threaded, self._run(output_pump.pump_multiplexed))
+    self.assertEqual('done\n', threaded[1])
+    self.assertIn('!@@@STEP_TEXT@900@@@\n', threaded[0])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -45,6 +45,25 @@ class TestProperties(unittest.TestCase):
 
     self.assertEqual([2, 3], prop.interpret([2, 3]))
 
+  def testTypeCheckedEveryTime(self):
+    """Tests that values are checked after others of their type passed."""
+    prop = self._makeProp(kind=config.List((int, str)))
+    self.assertEqual([1, 'a'], prop.interpret([1, 'a']))
+    self.assertEqual([2], prop.interpret([2]))
+    with self.assertRaises(TypeError):
+      prop.interpret([3, 4.0])
+
+    prop = self._makeProp(kind=int)
+    self.assertEqual(1, prop.interpret(1))
+    with self.assertRaises(TypeError):
+      prop.interpret('1')
+
+  def testInterpretDoesNotStoreValue(self):
+    """Tests that interpreting a value doesn't set it in the shared kind."""
+    kind = config.List(int)
+    self.assertEqual([1], self._makeProp(kind=kind).interpret([1]))
+    self.assertEqual([], kind.data)
+
 class TestInvoke(unittest.TestCase):
   def invoke(self, callable, all_properties, prop_defs, **kwargs):
     return loader.invoke_with_properties(
@@ -98,5 +117,29 @@ class TestInvoke(unittest.TestCase):
     with self.assertRaises(recipe_api.UndefinedPropertyException):
       self.invoke(func, {}, {})
 
+  def testBindingIsCached(self):
+    """Tests that a callable is only inspected once per set of definitions."""
+    def func(a, api):
+      return a, api
+
+    prop_defs = {'a': recipe_api.Property(default=0)}
+    inspected = []
+    getargspec = loader.inspect.getargspec
+    def counting_getargspec(fn):
+      inspected.append(fn)
+      return getargspec(fn)
+    loader.inspect.getargspec = counting_getargspec
+    try:
+      self.assertEqual((1, 'x'), self.invoke(func, {'a': 1}, prop_defs, api='x'))
+      self.assertEqual((0, 'y'), self.invoke(func, {}, prop_defs, api='y'))
+      self.assertEqual(1, len(inspected))
+
+      # New definitions are bound anew.
+      other_defs = {'a': recipe_api.Property(default=5)}
+      self.assertEqual((5, 'z'), self.invoke(func, {}, other_defs, api='z'))
+      self.assertEqual(2, len(inspected))
+    finally:
+      loader.inspect.getargspec = getargspec
+
 if __name__ == '__main__':
   unittest.main()
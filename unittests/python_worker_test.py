@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import python_worker
+
+
+SCRIPT = """
+import os, sys
+print os.getcwd()
+print os.environ.get('WORKER_TEST')
+print ' '.join(sys.argv[1:])
+sys.stderr.write('to stderr\\n')
+os.environ['LEAKED'] = '1'
+os.chdir('/')
+sys.exit(int(sys.argv[1]))
+"""
+
+
+class TestParseCommand(unittest.TestCase):
+  def testPythonScripts(self):
+    self.assertEqual((['s.py', 'a'], True),
+                     python_worker.parse_command(['python', '-u', 's.py', 'a']))
+    self.assertEqual((['s.py'], False),
+                     python_worker.parse_command(['python', 's.py']))
+
+  def testOtherCommands(self):
+    self.assertIsNone(python_worker.parse_command(['python']))
+    self.assertIsNone(python_worker.parse_command(['python', '-c', 'pass']))
+    self.assertIsNone(python_worker.parse_command(['python3', 's.py']))
+    self.assertIsNone(python_worker.parse_command(['echo', 'hi']))
+
+  def testStartupEnv(self):
+    self.assertTrue(python_worker.can_run(['python', 's.py'], {'FOO': '1'}))
+    self.assertFalse(
+        python_worker.can_run(['python', 's.py'], {'PYTHONPATH': 'x'}))
+
+
+@unittest.skipUnless(python_worker.is_supported(), 'POSIX only')
+class TestWorkerPool(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.script = os.path.join(self.tmp, 'script.py')
+    with open(self.script, 'w') as f:
+      f.write(SCRIPT)
+    self.pool = python_worker.WorkerPool(1, python=sys.executable)
+
+  def tearDown(self):
+    self.pool.close()
+    shutil.rmtree(self.tmp)
+
+  def _run(self, retcode, **kwargs):
+    env = {'WORKER_TEST': 'value %d' % retcode}
+    proc = self.pool.start([self.script, str(retcode), 'x'], True, self.tmp,
+                           env, **kwargs)
+    out, err = proc.stdout.read(), proc.stderr.read()
+    rusage = proc.wait()
+    return proc.returncode, out, err, rusage
+
+  def testRunsInIsolation(self):
+    # The one worker serves both steps; the second must not see anything the
+    # first changed.
+    for retcode in (3, 0):
+      returncode, out, err, rusage = self._run(retcode)
+      self.assertEqual(retcode, returncode)
+      self.assertEqual(
+          '%s\nvalue %d\n%d x\n' % (os.path.realpath(self.tmp), retcode,
+                                     retcode),
+          out.replace(self.tmp, os.path.realpath(self.tmp)))
+      self.assertEqual('to stderr\n', err)
+      self.assertGreater(rusage.ru_maxrss, 0)
+
+  def testRedirectsToFiles(self):
+    stdout = os.path.join(self.tmp, 'out')
+    returncode, out, err, _ = self._run(0, stdout=stdout)
+    self.assertEqual(0, returncode)
+    self.assertEqual('', out)
+    self.assertEqual('to stderr\n', err)
+    with open(stdout) as f:
+      self.assertIn('value 0', f.read())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import recipe_index
+
+
+class TestRecipeIndex(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.recipes = os.path.join(self.tmp, 'recipes')
+    self.modules = os.path.join(self.tmp, 'recipe_modules')
+    for path in ('recipes/a.py', 'recipes/_helper.py', 'recipes/sub/b.py',
+                 'recipes/notes.txt', 'recipe_modules/m/__init__.py',
+                 'recipe_modules/m/api.py', 'recipe_modules/m/example.py',
+                 'recipe_modules/n/__init__.py', 'recipe_modules/data/x.py'):
+      self._touch(path)
+    self._age()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _path(self, path):
+    return os.path.join(self.tmp, *path.split('/'))
+
+  def _touch(self, path):
+    path = self._path(path)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+
+  def _age(self):
+    """Makes every directory's mtime old enough for the index to trust."""
+    for root, dirs, _ in os.walk(self.tmp):
+      for d in dirs:
+        os.utime(os.path.join(root, d), (1000, 1000))
+
+  def _index(self):
+    return recipe_index.RecipeIndex(os.path.join(self.tmp, 'index'),
+                                    [self.recipes], [self.modules])
+
+  def testLookups(self):
+    index = self._index()
+    self.assertEqual(self._path('recipes/a.py'), index.recipe_path('a'))
+    self.assertEqual(self._path('recipes/sub/b.py'), index.recipe_path('sub/b'))
+    self.assertEqual(self._path('recipes/_helper.py'),
+                     index.recipe_path('_helper'))
+    self.assertIsNone(index.recipe_path('notes'))
+    self.assertEqual(self._path('recipe_modules/m'), index.module_path('m'))
+    self.assertIsNone(index.module_path('data'))
+    self.assertEqual(self._path('recipe_modules/m/example.py'),
+                     index.example_path('m'))
+    self.assertIsNone(index.example_path('n'))
+    self.assertEqual(
+        sorted([self._path('recipe_modules/m'), self._path('recipe_modules/n')]),
+        sorted(index.modules()))
+    self.assertEqual(
+        sorted([(self._path('recipes/a.py'), 'a'),
+                (self._path('recipes/sub/b.py'), os.path.join('sub', 'b')),
+                (self._path('recipe_modules/m/example.py'), 'm:example')]),
+        sorted(index.recipes()))
+
+  def testOnlyChangedDirectoriesAreListed(self):
+    self._index().modules()
+    self._touch('recipes/sub/c.py')
+    os.utime(self._path('recipes/sub'), (2000, 2000))
+
+    listed = []
+    real_listdir = os.listdir
+    def listdir(path):
+      listed.append(path)
+      return real_listdir(path)
+    os.listdir = listdir
+    try:
+      index = self._index()
+      self.assertEqual(self._path('recipes/sub/c.py'),
+                       index.recipe_path('sub/c'))
+    finally:
+      os.listdir = real_listdir
+    self.assertEqual([self._path('recipes/sub')], listed)
+
+  def testRecentlyModifiedDirectoryIsListedAgain(self):
+    self._touch('recipes/d.py')
+    self._index().modules()
+    # The directory may change again within its mtime's resolution.
+    self._touch('recipes/e.py')
+    self.assertEqual(self._path('recipes/e.py'),
+                     self._index().recipe_path('e'))
+
+  def testCorruptIndex(self):
+    with open(os.path.join(self.tmp, 'index'), 'w') as f:
+      f.write('garbage')
+    self.assertEqual(self._path('recipes/a.py'),
+                     self._index().recipe_path('a'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -3,8 +3,11 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import json
 import os
+import shutil
 import subprocess
+import tempfile
 import unittest
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -17,6 +20,54 @@ class RunTest(unittest.TestCase):
         'run', 'step:example'])
     self.assertEqual(0, exit_code)
 
+  def test_plan(self):
+    script_path = os.path.join(BASE_DIR, 'recipes.py')
+    tmp = tempfile.mkdtemp()
+    try:
+      output = os.path.join(tmp, 'plan.json')
+      package = os.path.join(BASE_DIR, 'infra', 'config', 'recipes.cfg')
+      exit_code = subprocess.call([
+          'python', script_path, '--package=%s' % package,
+          'plan', '--output', output, 'step:example'])
+      with open(output) as f:
+        plan = json.load(f)
+    finally:
+      shutil.rmtree(tmp)
+    self.assertEqual(0, exit_code)
+    steps = dict((step['name'], step) for step in plan['steps'])
+    self.assertEqual(['echo', 'Hello World'], steps['hello']['cmd'])
+    self.assertEqual({'friend': 'Darth Vader'}, steps['goodbye']['env'])
+    self.assertTrue(steps['cleanup']['infra_step'])
+
+  def test_run_journal(self):
+    script_path = os.path.join(BASE_DIR, 'recipes.py')
+    package = os.path.join(BASE_DIR, 'infra', 'config', 'recipes.cfg')
+    tmp = tempfile.mkdtemp()
+    try:
+      journal = os.path.join(tmp, 'journal')
+      exit_code = subprocess.call([
+          'python', script_path, '--package=%s' % package,
+          'run', '--journal', journal, 'step:example'])
+      self.assertEqual(0, exit_code)
+      with open(journal) as f:
+        entries = [json.loads(line) for line in f]
+      self.assertEqual(range(len(entries)), [e['seq'] for e in entries])
+      self.assertEqual('hello', entries[0]['name'])
+
+      # Resuming replays every journaled step instead of running it again.
+      proc = subprocess.Popen([
+          'python', script_path, '--package=%s' % package,
+          'run', '--journal', journal, '--resume', 'step:example'],
+          stdout=subprocess.PIPE)
+      output = proc.communicate()[0]
+      self.assertEqual(0, proc.returncode)
+      for entry in entries:
+        self.assertIn(
+            'step result restored from cache (journal entry %d)' % entry['seq'],
+            output)
+    finally:
+      shutil.rmtree(tmp)
+
 if __name__ == '__main__':
   unittest.TestCase.maxDiff = None
   unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+from cStringIO import StringIO
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import step_cache
+
+
+class TestStepCache(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.cache = step_cache.StepCache(os.path.join(self.tmp, 'cache'))
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _file(self, name, data):
+    path = os.path.join(self.tmp, name)
+    with open(path, 'wb') as f:
+      f.write(data)
+    return path
+
+  def _read(self, path):
+    with open(path, 'rb') as f:
+      return f.read()
+
+  def _entry(self, inp, out, cmd=('tool',), env=None):
+    return self.cache.entry(
+        list(cmd) + [inp, '--out', out], '/work', env or {'A': '1'},
+        [], [out], placeholder_inputs=[inp])
+
+  def testKeyIgnoresPlaceholderPaths(self):
+    a = self._entry(self._file('in1', 'data'), self._file('out1', ''))
+    b = self._entry(self._file('in2', 'data'), self._file('out2', ''))
+    self.assertEqual(a.key, b.key)
+
+  def testKeyDependsOnInputs(self):
+    out = self._file('out', '')
+    base = self._entry(self._file('in1', 'data'), out)
+    self.assertNotEqual(
+        base.key, self._entry(self._file('in2', 'other'), out).key)
+    self.assertNotEqual(
+        base.key, self._entry(self._file('in3', 'data'), out,
+                              cmd=('other_tool',)).key)
+    self.assertNotEqual(
+        base.key, self._entry(self._file('in4', 'data'), out,
+                              env={'A': '2'}).key)
+
+  def testKeyPairsInputsWithTheirContents(self):
+    a, b = os.path.join(self.tmp, 'a'), os.path.join(self.tmp, 'b')
+    self._file('a', 'one')
+    self._file('b', 'two')
+    before = self.cache.entry(['tool'], None, {}, [a, b], []).key
+    self._file('a', 'two')
+    self._file('b', 'one')
+    self.assertNotEqual(
+        before, self.cache.entry(['tool'], None, {}, [a, b], []).key)
+    self.assertEqual(
+        self.cache.entry(['tool'], None, {}, [b, a], []).key,
+        self.cache.entry(['tool'], None, {}, [a, b], []).key)
+
+  def testDirectoryInputs(self):
+    d = os.path.join(self.tmp, 'dir')
+    os.makedirs(os.path.join(d, 'sub'))
+    self._file(os.path.join('dir', 'sub', 'f'), 'one')
+    before = self.cache.entry(['tool'], None, {}, [d], []).key
+    self._file(os.path.join('dir', 'sub', 'f'), 'two')
+    self.assertNotEqual(
+        before, self.cache.entry(['tool'], None, {}, [d], []).key)
+
+  def testMissAndReplay(self):
+    inp, out = self._file('in', 'data'), self._file('out', '')
+    entry = self._entry(inp, out)
+    self.assertFalse(entry.restore(StringIO(), StringIO()))
+
+    # Run the "step".
+    entry.tee('stdout', StringIO()).write('hello\n')
+    entry.tee('stderr', StringIO()).write('warning\n')
+    self._file('out', 'result')
+    entry.save(0)
+
+    out2 = self._file('out2', '')
+    replay = self._entry(inp, out2)
+    stdout, stderr = StringIO(), StringIO()
+    self.assertTrue(replay.restore(stdout, stderr))
+    self.assertTrue(replay.hit)
+    self.assertEqual(0, replay.retcode)
+    self.assertEqual('hello\n', stdout.getvalue())
+    self.assertEqual('warning\n', stderr.getvalue())
+    self.assertEqual('result', self._read(out2))
+
+  def testDamagedEntryIsAMiss(self):
+    inp, out = self._file('in', 'data'), self._file('out', '')
+    entry = self._entry(inp, out)
+    entry.tee('stdout', StringIO()).write('hello\n')
+    self._file('out', 'result')
+    entry.save(0)
+
+    path = self.cache.entry_path(entry.key)
+    with open(os.path.join(path, 'outputs', '0'), 'wb') as f:
+      f.write('res')
+    out2 = self._file('out2', 'untouched')
+    replay = self._entry(inp, out2)
+    stdout = StringIO()
+    self.assertFalse(replay.restore(stdout, StringIO()))
+    self.assertFalse(replay.hit)
+    self.assertEqual('', stdout.getvalue())
+    self.assertEqual('untouched', self._read(out2))
+
+    os.unlink(os.path.join(path, 'stderr'))
+    self.assertFalse(replay.restore(stdout, StringIO()))
+    self.assertEqual('', stdout.getvalue())
+
+  def testScansOnlyWhenOverLimit(self):
+    scans = []
+    evict = self.cache.evict
+    def counting_evict():
+      scans.append(1)
+      evict()
+    self.cache.evict = counting_evict
+
+    def store(i):
+      out = self._file('out%d' % i, 'x' * 50)
+      entry = self._entry(self._file('in%d' % i, str(i)), out)
+      entry.save(0)
+      return step_cache._dir_size(self.cache.entry_path(entry.key))
+
+    # The first store finds out the size of the cache.
+    size = store(0)
+    self.assertEqual(1, len(scans))
+    self.cache.max_bytes = 2 * size
+    store(1)
+    self.assertEqual(1, len(scans))
+    store(2)
+    self.assertEqual(2, len(scans))
+    self.assertEqual(2, len(os.listdir(self.cache.root)))
+
+  def testEvictsLeastRecentlyUsed(self):
+    keys = []
+    for i in xrange(3):
+      out = self._file('out%d' % i, 'x' * 50)
+      entry = self._entry(self._file('in%d' % i, str(i)), out)
+      keys.append(entry.key)
+      entry.save(0)
+      # Make sure entries have distinct mtimes.
+      path = os.path.join(self.cache.entry_path(entry.key), 'meta.json')
+      os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+
+    # Leave room for two entries, and use the oldest one, so that the second
+    # one is evicted instead.
+    self.cache.max_bytes = 2 * step_cache._dir_size(
+        self.cache.entry_path(keys[0]))
+    self.assertTrue(self._entry(self._file('in0', '0'), self._file('o', ''))
+                    .restore(StringIO(), StringIO()))
+    self.cache.evict()
+    remaining = [k for k in keys
+                 if os.path.isdir(self.cache.entry_path(k))]
+    self.assertEqual([keys[0], keys[2]], remaining)
+
+
+if __name__ == '__main__':
+  unittest.main()
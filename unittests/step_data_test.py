@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import run
+
+
+class TestStepData(unittest.TestCase):
+  def _step(self):
+    return {'name': 'compile', 'cmd': ['ninja', '-C', 'out'],
+            'env': {'GOMA': '1'}}
+
+  def testStepIsMutableCopy(self):
+    record = self._step()
+    result = run.StepData(record, 0)
+    step = result.step
+    self.assertEqual(['ninja', '-C', 'out', 'all'], step['cmd'] + ['all'])
+    step['cmd'].append('all')
+    step['env']['GOMA'] = '0'
+    self.assertIs(step, result.step)
+    self.assertEqual(['ninja', '-C', 'out'], record['cmd'])
+    self.assertEqual({'GOMA': '1'}, record['env'])
+
+  def testFrozenRecordIsShared(self):
+    result = run.StepData(self._step(), 0)
+    frozen = result._freeze()  # pylint: disable=W0212
+    self.assertIs(frozen, result._step)  # pylint: disable=W0212
+    step = result.step
+    self.assertIsInstance(step['cmd'], list)
+    step['cmd'].append('all')
+    self.assertEqual(['ninja', '-C', 'out'], list(frozen['cmd']))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import errno
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import step_env
+
+
+class TestExecutableResolver(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.first = os.path.join(self.tmp, 'first')
+    self.second = os.path.join(self.tmp, 'second')
+    os.mkdir(self.first)
+    os.mkdir(self.second)
+    self.path = os.pathsep.join([self.first, self.second])
+    self.resolver = step_env.ExecutableResolver()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _add(self, directory, name, executable=True):
+    full = os.path.join(directory, name)
+    with open(full, 'w') as f:
+      f.write('#!/bin/sh\n')
+    if executable:
+      os.chmod(full, 0755)
+    # Make sure the directory's mtime moves, whatever its resolution.
+    stamp = time.time() + 10 * len(os.listdir(directory))
+    os.utime(directory, (stamp, stamp))
+    return full
+
+  def testFindsFirstExecutable(self):
+    self._add(self.first, 'tool', executable=False)
+    second = self._add(self.second, 'tool')
+    self.assertEqual(second, self.resolver.resolve('tool', self.path))
+    self.assertIsNone(self.resolver.resolve('missing', self.path))
+    self.assertEqual('./tool', self.resolver.resolve('./tool', self.path))
+
+  def testInvalidatesOnDirectoryChange(self):
+    second = self._add(self.second, 'tool')
+    self.assertEqual(second, self.resolver.resolve('tool', self.path))
+    first = self._add(self.first, 'tool')
+    self.assertEqual(first, self.resolver.resolve('tool', self.path))
+
+    self.assertIsNone(self.resolver.resolve('new', self.path))
+    new = self._add(self.second, 'new')
+    self.assertEqual(new, self.resolver.resolve('new', self.path))
+
+  def testKeyedOnPath(self):
+    first = self._add(self.first, 'tool')
+    second = self._add(self.second, 'tool')
+    self.assertEqual(first, self.resolver.resolve('tool', self.path))
+    self.assertEqual(second, self.resolver.resolve('tool', self.second))
+
+
+class TestStepEnvironment(unittest.TestCase):
+  def setUp(self):
+    self.environment = step_env.StepEnvironment(
+        {'PATH': os.path.dirname(sys.executable), 'KEEP': 'k', 'DROP': 'd'})
+
+  def testMerge(self):
+    merged = self.environment.merge(
+        {'PATH': '/extra:%(PATH)s', 'DROP': None, 'NEW': 1})
+    self.assertEqual({
+        'PATH': '/extra:' + os.path.dirname(sys.executable),
+        'KEEP': 'k',
+        'NEW': '1',
+    }, merged)
+    # Callers get their own copy.
+    merged['KEEP'] = 'changed'
+    self.assertEqual('k', self.environment.merge({'DROP': None})['KEEP'])
+    self.assertEqual('d', self.environment.merge(None)['DROP'])
+
+  def testMergeUnhashableValue(self):
+    overrides = {'FLAGS': ['-O2']}
+    self.assertEqual("['-O2']", self.environment.merge(overrides)['FLAGS'])
+    merged = self.environment.merge(overrides)
+    merged['FLAGS'] = 'changed'
+    self.assertEqual("['-O2']", self.environment.merge(overrides)['FLAGS'])
+
+  def testResolveExecutable(self):
+    name = os.path.basename(sys.executable)
+    cmd = [name, '-c', 'pass']
+    self.assertEqual(
+        os.path.join(os.path.dirname(sys.executable), name),
+        self.environment.resolve_executable(cmd, {}))
+    self.assertEqual([name, '-c', 'pass'], cmd)
+    with self.assertRaises(OSError) as cm:
+      self.environment.resolve_executable([name], {'PATH': '/nonexistent'})
+    self.assertEqual(errno.ENOENT, cm.exception.errno)
+
+
+if __name__ == '__main__':
+  unittest.main()
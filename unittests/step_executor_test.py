@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import errno
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import step_executor
+
+
+SCRIPT = """
+import os, resource, sys
+print os.getcwd()
+print os.environ.get('EXECUTOR_TEST')
+print resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+sys.stderr.write('to stderr\\n')
+sys.exit(int(sys.argv[1]))
+"""
+
+
+@unittest.skipUnless(step_executor.is_supported(), 'POSIX only')
+class TestExecutor(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.script = os.path.join(self.tmp, 'script.py')
+    with open(self.script, 'w') as f:
+      f.write(SCRIPT)
+    self.socket_path = os.path.join(self.tmp, 'executor')
+    self.client = step_executor.ensure_executor(
+        self.socket_path, idle_timeout=0.5)
+
+  def tearDown(self):
+    self._wait_for_exit()
+    shutil.rmtree(self.tmp)
+
+  def _wait_for_exit(self):
+    # The executor exits by itself once idle.
+    deadline = time.time() + 10
+    while os.path.exists(self.socket_path) and time.time() < deadline:
+      time.sleep(0.05)
+    self.assertFalse(os.path.exists(self.socket_path))
+
+  def _start(self, retcode, **kwargs):
+    env = {'EXECUTOR_TEST': 'value %d' % retcode,
+           'PATH': os.path.dirname(sys.executable)}
+    return self.client.start(
+        [os.path.basename(sys.executable), self.script, str(retcode)],
+        self.tmp, env, **kwargs)
+
+  def testRunsSteps(self):
+    proc = self._start(3, limits={'RLIMIT_NOFILE': 100})
+    out, err = proc.stdout.read(), proc.stderr.read()
+    rusage = proc.wait()
+    self.assertEqual(3, proc.returncode)
+    self.assertEqual('%s\nvalue 3\n100\n' % os.path.realpath(self.tmp),
+                     out.replace(self.tmp, os.path.realpath(self.tmp)))
+    self.assertEqual('to stderr\n', err)
+    self.assertGreater(rusage.ru_maxrss, 0)
+
+  def testConcurrentSteps(self):
+    procs = [self._start(i) for i in xrange(5)]
+    outputs = [[None] for _ in procs]
+    def read(proc, output):
+      output[0] = proc.stdout.read()
+      proc.stderr.read()
+      proc.wait()
+    threads = [threading.Thread(target=read, args=(p, o))
+               for p, o in zip(procs, outputs)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEqual(range(5), [p.returncode for p in procs])
+    for i, output in enumerate(outputs):
+      self.assertIn('value %d' % i, output[0])
+
+  def testRedirectsToFiles(self):
+    stdout = os.path.join(self.tmp, 'out')
+    proc = self._start(0, stdout=stdout)
+    self.assertIsNone(proc.stdout)
+    self.assertEqual('to stderr\n', proc.stderr.read())
+    proc.wait()
+    with open(stdout) as f:
+      self.assertIn('value 0', f.read())
+
+  def testExecutableKeepsArgv0(self):
+    proc = self.client.start(
+        ['renamed', '-c', 'echo $0'], self.tmp, {'PATH': self.tmp},
+        executable='/bin/sh')
+    self.assertEqual('renamed\n', proc.stdout.read())
+    proc.stderr.read()
+    proc.wait()
+    self.assertEqual(0, proc.returncode)
+
+  def testMissingCommand(self):
+    with self.assertRaises(OSError) as cm:
+      self.client.start(['no-such-command'], self.tmp, {'PATH': self.tmp})
+    self.assertEqual(errno.ENOENT, cm.exception.errno)
+
+  def testReusesRunningExecutor(self):
+    proc = self._start(0)
+    proc.stdout.read()
+    proc.stderr.read()
+    proc.wait()
+    again = step_executor.ensure_executor(self.socket_path)
+    proc = again.start(['true'], self.tmp, {'PATH': os.environ['PATH']})
+    proc.wait()
+    self.assertEqual(0, proc.returncode)
+
+  def testSocketIsPrivate(self):
+    self.assertEqual(0600, stat.S_IMODE(os.stat(self.socket_path).st_mode))
+
+  def testLaunchKeepsLiveExecutor(self):
+    inode = os.stat(self.socket_path).st_ino
+    step_executor._launch_executor(  # pylint: disable=W0212
+        self.socket_path, None, 0.5, 10)
+    self.assertEqual(inode, os.stat(self.socket_path).st_ino)
+
+  def testRestartsIdleExecutor(self):
+    self._wait_for_exit()
+    proc = self.client.start(['true'], self.tmp, {'PATH': os.environ['PATH']})
+    proc.wait()
+    self.assertEqual(0, proc.returncode)
+
+
+if __name__ == '__main__':
+  unittest.main()
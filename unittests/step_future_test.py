@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import recipe_api
+from recipe_engine import run
+
+
+class FakeEngine(object):
+  def __init__(self, outcome):
+    self.outcome = outcome
+    self.collected = 0
+
+  def _collect_step(self, future):
+    self.collected += 1
+    if isinstance(self.outcome, Exception):
+      raise self.outcome
+    return self.outcome
+
+
+class TestStepFuture(unittest.TestCase):
+  def _future(self, outcome):
+    engine = FakeEngine(outcome)
+    return engine, run.StepFuture(engine, None)
+
+  def testResult(self):
+    engine, future = self._future('data')
+    self.assertEqual('data', future.result())
+    self.assertEqual('data', future.result())
+    self.assertEqual(1, engine.collected)
+
+  def testStepFailure(self):
+    failure = recipe_api.StepFailure('failed')
+    engine, future = self._future(failure)
+    for _ in xrange(2):
+      with self.assertRaises(recipe_api.StepFailure) as cm:
+        future.result()
+      self.assertIs(failure, cm.exception)
+    self.assertEqual(1, engine.collected)
+
+  def testOtherErrors(self):
+    error = OSError('no such file')
+    engine, future = self._future(error)
+    for _ in xrange(2):
+      with self.assertRaises(OSError) as cm:
+        future.result()
+      self.assertIs(error, cm.exception)
+    self.assertEqual(1, engine.collected)
+
+
+if __name__ == '__main__':
+  unittest.main()
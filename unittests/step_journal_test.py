@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from cStringIO import StringIO
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import step_cache
+from recipe_engine import step_journal
+
+
+class TestStepJournal(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmp, 'journal')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmp)
+
+  def _output(self, name):
+    return os.path.join(self.tmp, name)
+
+  def _run(self, journal, name, output, data, retcode=0):
+    """Runs a fake step which writes |data| to its output placeholder."""
+    entry = journal.entry(name, ['tool', '--out', output], None, None, [],
+                          [output]).attach(None)
+    out = StringIO()
+    if not entry.restore(out, out):
+      entry.tee('stdout', out).write('ran %s\n' % name)
+      with open(output, 'w') as f:
+        f.write(data)
+      entry.record(retcode, None)
+    with open(output) as f:
+      return entry, out.getvalue(), f.read()
+
+  def _journaled(self):
+    with open(self.path) as f:
+      return [json.loads(line)['name'] for line in f]
+
+  def testResumeReplaysSteps(self):
+    journal = step_journal.StepJournal(self.path)
+    self._run(journal, 'a', self._output('a1'), 'A')
+    self._run(journal, 'b', self._output('b1'), 'B', retcode=1)
+    journal.close()
+    self.assertEqual(['a', 'b'], self._journaled())
+
+    journal = step_journal.StepJournal(self.path, resume=True)
+    # Output placeholders get new temporary paths in the new run.
+    entry, out, data = self._run(journal, 'a', self._output('a2'), 'new')
+    self.assertTrue(entry.replayed and entry.hit)
+    self.assertEqual(('ran a\n', 'A', 0), (out, data, entry.retcode))
+    entry, _, data = self._run(journal, 'b', self._output('b2'), 'new')
+    self.assertEqual(('B', 1), (data, entry.retcode))
+    entry, out, data = self._run(journal, 'c', self._output('c2'), 'C')
+    self.assertFalse(entry.replayed)
+    journal.close()
+    self.assertEqual(['a', 'b', 'c'], self._journaled())
+
+  def testDivergenceDropsLaterEntries(self):
+    journal = step_journal.StepJournal(self.path)
+    for name in ('a', 'b', 'c'):
+      self._run(journal, name, self._output(name), name)
+    journal.close()
+
+    journal = step_journal.StepJournal(self.path, resume=True)
+    self.assertTrue(self._run(journal, 'a', self._output('a2'), '')[0].replayed)
+    entry, out, data = self._run(journal, 'x', self._output('x'), 'X')
+    self.assertFalse(entry.replayed)
+    entry, _, _ = self._run(journal, 'c', self._output('c2'), 'C')
+    self.assertFalse(entry.replayed)
+    journal.close()
+    self.assertEqual(['a', 'x', 'c'], self._journaled())
+
+  def testTornLineIsDropped(self):
+    journal = step_journal.StepJournal(self.path)
+    self._run(journal, 'a', self._output('a'), 'A')
+    journal.close()
+    with open(self.path, 'a') as f:
+      f.write('{"seq": 1, "name": "b", "ret')
+
+    journal = step_journal.StepJournal(self.path, resume=True)
+    self.assertTrue(self._run(journal, 'a', self._output('a2'), '')[0].replayed)
+    self.assertFalse(self._run(journal, 'b', self._output('b'), 'B')[0].replayed)
+    journal.close()
+    self.assertEqual(['a', 'b'], self._journaled())
+
+  def testWithoutResumeStartsAfresh(self):
+    journal = step_journal.StepJournal(self.path)
+    self._run(journal, 'a', self._output('a'), 'A')
+    journal.close()
+    journal = step_journal.StepJournal(self.path)
+    self.assertFalse(self._run(journal, 'a', self._output('a'), 'A')[0].replayed)
+    journal.close()
+
+  def testSignature(self):
+    inp = self._output('input')
+    with open(inp, 'w') as f:
+      f.write('data')
+    sig = step_journal.signature(
+        'a', ['tool', inp, '/tmp/out1'], None, {}, [inp], ['/tmp/out1'])
+    self.assertEqual(sig, step_journal.signature(
+        'a', ['tool', inp, '/tmp/out2'], None, None, [inp], ['/tmp/out2']))
+    with open(inp, 'w') as f:
+      f.write('other')
+    self.assertNotEqual(sig, step_journal.signature(
+        'a', ['tool', inp, '/tmp/out1'], None, {}, [inp], ['/tmp/out1']))
+
+  def testWrapsCacheEntry(self):
+    cache = step_cache.StepCache(os.path.join(self.tmp, 'cache'))
+    output = self._output('out')
+    journal = step_journal.StepJournal(self.path)
+    entry = journal.entry('a', ['tool'], None, None, [], [output])
+    entry.attach(cache.entry(['tool'], None, {}, [], [output]))
+    out = StringIO()
+    self.assertFalse(entry.restore(out, out))
+    entry.tee('stdout', out).write('hello\n')
+    with open(output, 'w') as f:
+      f.write('result')
+    entry.save(0)
+    entry.record(0, None)
+
+    # A new journal replays the step from the step cache, and journals it.
+    journal = step_journal.StepJournal(self.path)
+    entry = journal.entry('a', ['tool'], None, None, [], [output])
+    entry.attach(cache.entry(['tool'], None, {}, [], [output]))
+    out = StringIO()
+    self.assertTrue(entry.restore(out, out))
+    self.assertTrue(entry.hit)
+    self.assertFalse(entry.replayed)
+    entry.record(entry.retcode, None)
+    journal.close()
+    with open(self.path) as f:
+      self.assertEqual('hello\n', json.loads(f.readline())['stdout'].decode(
+          'base64'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import errno
+import os
+import subprocess
+import sys
+import threading
+import time
+import unittest
+
+from cStringIO import StringIO
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import step_loop
+
+
+class Result(object):
+  def __init__(self):
+    self.done = threading.Event()
+    self.args = None
+    self.exc_info = None
+
+  def on_done(self, *args):
+    self.args = args
+    self.done.set()
+
+  def on_error(self, exc_info):
+    self.exc_info = exc_info
+    self.done.set()
+
+
+@unittest.skipUnless(step_loop.is_supported(), 'POSIX only')
+class TestStepLoop(unittest.TestCase):
+  def setUp(self):
+    self.loop = step_loop.StepLoop(grace_period=1)
+
+  def tearDown(self):
+    self.loop.close()
+
+  def _submit(self, script, timeout=None, no_output_timeout=None,
+              loop=None):
+    out = StringIO()
+    result = Result()
+    result.out = out
+    def launch():
+      result.proc = subprocess.Popen(
+          [sys.executable, '-c', script], stdout=subprocess.PIPE,
+          stderr=subprocess.PIPE, preexec_fn=os.setpgrp)
+      return step_loop.StepProcess(
+          result.proc, [(result.proc.stdout, out), (result.proc.stderr, out)],
+          False, timeout, no_output_timeout)
+    (loop or self.loop).submit(launch, result.on_done, result.on_error)
+    return result
+
+  def testRunsManyAtOnce(self):
+    results = [
+        self._submit('import sys; print "@@@STEP_TEXT@x@@@"; sys.exit(%d)' % i)
+        for i in xrange(20)]
+    for i, result in enumerate(results):
+      self.assertTrue(result.done.wait(30))
+      self.assertIsNone(result.exc_info)
+      counts, rusage, timed_out = result.args
+      self.assertEqual(i, result.proc.returncode)
+      self.assertEqual([18, 0], counts)
+      self.assertIsNotNone(rusage)
+      self.assertIsNone(timed_out)
+      self.assertEqual('!@@@STEP_TEXT@x@@@\n', result.out.getvalue())
+
+  def testTimeouts(self):
+    slow = self._submit('import time; time.sleep(30)', timeout=0.2)
+    quiet = self._submit('import time; time.sleep(30)', no_output_timeout=0.2)
+    for result, kind in ((slow, 'timeout'), (quiet, 'no_output_timeout')):
+      self.assertTrue(result.done.wait(10))
+      self.assertEqual(kind, result.args[2])
+      self.assertNotEqual(0, result.proc.returncode)
+
+  def testNoOutputTimeoutNeedsPipedOutput(self):
+    result = Result()
+    def launch():
+      with open(os.devnull, 'w') as devnull:
+        result.proc = subprocess.Popen(
+            [sys.executable, '-c', 'import time; time.sleep(0.5)'],
+            stdout=devnull, stderr=devnull, preexec_fn=os.setpgrp)
+      return step_loop.StepProcess(result.proc, [], False, None, 0.1)
+    self.loop.submit(launch, result.on_done, result.on_error)
+    self.assertTrue(result.done.wait(10))
+    self.assertIsNone(result.args[2])
+    self.assertEqual(0, result.proc.returncode)
+
+  def testMaxChildren(self):
+    loop = step_loop.StepLoop(max_children=1)
+    try:
+      start = time.time()
+      results = [self._submit('import time; time.sleep(0.2)', loop=loop)
+                 for _ in xrange(3)]
+      for result in results:
+        self.assertTrue(result.done.wait(10))
+        self.assertEqual(0, result.proc.returncode)
+      self.assertGreater(time.time() - start, 0.6)
+    finally:
+      loop.close()
+
+  def testLaunchFailures(self):
+    nothing = Result()
+    self.loop.submit(lambda: None, nothing.on_done, nothing.on_error)
+    self.assertEqual((None, None, None), nothing.args)
+
+    def launch():
+      raise OSError(errno.ENOENT, 'no such file')
+    failed = Result()
+    self.loop.submit(launch, failed.on_done, failed.on_error)
+    self.assertEqual(errno.ENOENT, failed.exc_info[1].errno)
+
+  def testClose(self):
+    result = self._submit('import time; time.sleep(30)')
+    self.loop.close()
+    self.assertIsInstance(result.exc_info[1], step_loop.Cancelled)
+    self.assertIsNotNone(result.proc.returncode)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import collections
+import json
+import os
+import sys
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import step_plan
+
+
+# Stand-ins for run.PreparedStep and run.Placeholders, which can't be imported
+# without the engine's dependencies.
+Prepared = collections.namedtuple(
+    'Prepared', 'step ok_ret infra_step nest_level step_test placeholders')
+Placeholders = collections.namedtuple(
+    'Placeholders', 'cmd stdout stderr stdin')
+
+
+class FakePlaceholder(object):
+  def __init__(self, cache_role=None, leak_to=None, backing_file=None):
+    self.cache_role = cache_role
+    self.leak_to = leak_to
+    self.backing_file = backing_file or leak_to
+
+
+class TestPlanRecorder(unittest.TestCase):
+  def testRecordsSteps(self):
+    recorder = step_plan.PlanRecorder()
+    json_out = FakePlaceholder('output', leak_to='/out/result.json')
+    recorder.add(Prepared(
+        {'name': 'compile',
+         'cmd': ['ninja', '-C', 'out', 3, '/path/to/tmp/in'], 'cwd': '/src',
+         'env': {'GOMA': '1'}, 'cacheable': True,
+         'cache_inputs': ['/src/build.ninja']},
+        (0,), False, 1, None,
+        Placeholders(
+            {'json': {'output': [(json_out, None)]},
+             'raw_io': {'input': [(FakePlaceholder(
+                 'input', backing_file='/path/to/tmp/in'), None)]}},
+            (FakePlaceholder('output'), None), (None, None), (None, None))))
+    recorder.add(Prepared(
+        {'name': 'cleanup', 'cmd': ['rm', '-rf', 'out']},
+        (0,), True, 0, None, Placeholders({}, *[(None, None)] * 3)))
+    recorder.status_code = 0
+
+    plan = json.loads(json.dumps(recorder.to_json()))
+    self.assertEqual(0, plan['status_code'])
+    compile_step, cleanup = plan['steps']
+    self.assertEqual({
+        'name': 'compile',
+        'cmd': ['ninja', '-C', 'out', '3', '[PLACEHOLDER:1]'],
+        'cwd': '/src',
+        'env': {'GOMA': '1'},
+        'nest_level': 1,
+        'infra_step': False,
+        'cacheable': True,
+        'inputs': ['/src/build.ninja'],
+        'outputs': ['/out/result.json'],
+        'placeholders': [
+            {'name': 'json.output', 'role': 'output'},
+            {'name': 'raw_io.input', 'role': 'input'},
+            {'name': 'stdout', 'role': 'output'},
+        ],
+    }, compile_step)
+    self.assertEqual(None, cleanup['cwd'])
+    self.assertEqual({}, cleanup['env'])
+    self.assertTrue(cleanup['infra_step'])
+
+  def testPlanTestData(self):
+    test_data = step_plan.PlanTestData()
+    self.assertTrue(test_data.enabled)
+    self.assertFalse(test_data.is_unexpected_exception(ValueError()))
+    # Paths are the real ones.
+    self.assertFalse(test_data.get_module_test_data('path').enabled)
+    self.assertTrue(test_data.get_module_test_data('json').enabled)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import trace_event
+
+
+class FakeClock(object):
+  def __init__(self):
+    self.now = 100.0
+
+  def __call__(self):
+    return self.now
+
+
+class TestTraceRecorder(unittest.TestCase):
+  def setUp(self):
+    self.clock = FakeClock()
+    self.recorder = trace_event.TraceRecorder(clock=self.clock)
+
+  def _events(self, phase='X'):
+    return [e for e in self.recorder.to_json()['traceEvents']
+            if e['ph'] == phase]
+
+  def testNestedSpans(self):
+    with trace_event.recording(self.recorder):
+      with trace_event.span('outer', 'nest'):
+        self.clock.now += 1
+        with trace_event.span('inner', 'step', {'retcode': 0}):
+          self.clock.now += 0.5
+    self.assertEqual(
+        [('outer', 'nest', 0, 1500000), ('inner', 'step', 1000000, 500000)],
+        [(e['name'], e['cat'], e['ts'], e['dur']) for e in self._events()])
+    self.assertEqual({'retcode': 0}, self._events()[1]['args'])
+    self.assertIsNone(trace_event.active())
+
+  def testSpansWithoutRecorder(self):
+    with trace_event.span('ignored', 'step'):
+      pass
+    self.assertEqual([], self._events())
+
+  def testSpanOnError(self):
+    with self.assertRaises(ValueError):
+      with self.recorder.span('failed', 'step'):
+        raise ValueError()
+    self.assertEqual(['failed'], [e['name'] for e in self._events()])
+
+  def testThreads(self):
+    def step():
+      self.recorder.complete('parallel', 'step', 100.0, 101.0)
+    thread = threading.Thread(target=step, name='worker')
+    thread.start()
+    thread.join()
+    self.recorder.complete('serial', 'step', 101.0, 102.0)
+
+    tids = dict((e['name'], e['tid']) for e in self._events())
+    self.assertNotEqual(tids['parallel'], tids['serial'])
+    self.assertEqual(
+        'worker',
+        [e['args']['name'] for e in self._events('M')
+         if e['tid'] == tids['parallel']][0])
+
+  def testWrite(self):
+    tmp = tempfile.mkdtemp()
+    try:
+      path = os.path.join(tmp, 'trace.json')
+      self.recorder.complete('step', 'step', 100.0, 100.25)
+      self.recorder.write(path)
+      with open(path) as f:
+        self.assertEqual(self.recorder.to_json(), json.load(f))
+    finally:
+      shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+  unittest.main()
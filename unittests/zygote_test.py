@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+import os
+import shutil
+import signal
+import socket
+import stat
+import sys
+import tempfile
+import time
+import unittest
+
+from cStringIO import StringIO
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__)))))
+
+from recipe_engine import zygote
+
+
+# Set in the zygote, and so seen by the commands it forks.
+PRELOADED = []
+
+
+def handler(argv):
+  """Runs a fake command."""
+  if argv[0] == 'kill':
+    os.kill(os.getpid(), signal.SIGKILL)
+  if argv[0] == 'raise':
+    raise ValueError('oops')
+  sys.stdout.write('%s %s %s\n' % (
+      os.getcwd(), os.environ.get('ZYGOTE_TEST'), PRELOADED))
+  sys.stdout.write('x' * 200000 + '\n')
+  sys.stderr.write('to stderr\n')
+  return int(argv[0])
+
+
+@unittest.skipUnless(zygote.is_supported(), 'POSIX only')
+class TestZygote(unittest.TestCase):
+  def setUp(self):
+    self.tmp = os.path.realpath(tempfile.mkdtemp())
+    self.socket_path = os.path.join(self.tmp, 'zygote')
+    self.watched = os.path.join(self.tmp, 'watched.py')
+    with open(self.watched, 'w') as f:
+      f.write('')
+    os.utime(self.watched, (1000, 1000))
+    self.pids = []
+    self.client = zygote.ZygoteClient(
+        self.socket_path, 'package', launcher=self._launch)
+    self._launch()
+
+  def tearDown(self):
+    # The zygote exits by itself once idle.
+    deadline = time.time() + 10
+    while os.path.exists(self.socket_path) and time.time() < deadline:
+      time.sleep(0.05)
+    self.assertFalse(os.path.exists(self.socket_path))
+    for pid in self.pids:
+      os.waitpid(pid, 0)
+    shutil.rmtree(self.tmp)
+
+  def _launch(self):
+    pid = os.fork()
+    if pid == 0:
+      try:
+        PRELOADED.append(len(self.pids) + 1)
+        zygote.serve(self.socket_path, 'package', handler,
+                     files=[self.watched], idle_timeout=0.5)
+      finally:
+        os._exit(0)
+    deadline = time.time() + 10
+    while not self.client.ping() and time.time() < deadline:
+      time.sleep(0.01)
+    self.pids.append(pid)
+
+  def _run(self, argv, client=None):
+    out, err = StringIO(), StringIO()
+    old_cwd = os.getcwd()
+    os.chdir(self.tmp)
+    os.environ['ZYGOTE_TEST'] = 'value'
+    try:
+      code = (client or self.client).run(argv, stdout=out, stderr=err)
+    finally:
+      os.chdir(old_cwd)
+      del os.environ['ZYGOTE_TEST']
+    return code, out.getvalue(), err.getvalue()
+
+  def testRunsCommands(self):
+    for i in xrange(3):
+      code, out, err = self._run([str(i)])
+      self.assertEqual(i, code)
+      lines = out.splitlines()
+      self.assertEqual('%s value [1]' % self.tmp, lines[0])
+      self.assertEqual(200000, len(lines[1]))
+      self.assertEqual('to stderr\n', err)
+    self.assertEqual(1, len(self.pids))
+
+  def testFailures(self):
+    code, _, err = self._run(['raise'])
+    self.assertEqual(1, code)
+    self.assertIn('ValueError: oops', err)
+    self.assertEqual(128 + signal.SIGKILL, self._run(['kill'])[0])
+
+  def testStaleZygoteIsReplaced(self):
+    os.utime(self.watched, (2000, 2000))
+    without_launcher = zygote.ZygoteClient(self.socket_path, 'package')
+    with self.assertRaises(zygote.ZygoteError):
+      self._run(['0'], client=without_launcher)
+    # That zygote has exited; a new one is started.
+    code, out, _ = self._run(['0'])
+    self.assertEqual(0, code)
+    self.assertIn('[2]', out.splitlines()[0])
+
+  def testSocketIsPrivate(self):
+    self.assertEqual(0600, stat.S_IMODE(os.stat(self.socket_path).st_mode))
+
+  def testKeepsReplacementSocket(self):
+    # Another zygote takes over the path while this one is still running.
+    os.rename(self.socket_path, self.socket_path + '.old')
+    replacement = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    replacement.bind(self.socket_path)
+    try:
+      os.waitpid(self.pids.pop(), 0)
+      self.assertTrue(os.path.exists(self.socket_path))
+    finally:
+      replacement.close()
+      os.unlink(self.socket_path)
+
+  def testOtherPackage(self):
+    other = zygote.ZygoteClient(self.socket_path, 'other')
+    with self.assertRaises(zygote.ZygoteError):
+      self._run(['0'], client=other)
+    self.assertEqual(0, self._run(['0'])[0])
+
+
+if __name__ == '__main__':
+  unittest.main()
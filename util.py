@@ -2,6 +2,7 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import collections
 import functools
 import os
 
@@ -31,6 +32,11 @@ class ModuleInjectionSite(object):
 
 class Placeholder(object):
   """Base class for json placeholders. Do not use directly."""
+  # How the step result cache treats backing_file: 'input' if the step reads
+  # it, 'output' if the step writes it. Steps using a placeholder with any other
+  # role are never cached.
+  cache_role = None
+
   def __init__(self):
     self.name_pieces = None
 
@@ -120,6 +126,25 @@ def cached_unary(f):
   return cached_f
 
 
+class ReadOnlyMapping(collections.Mapping):
+  """A read-only view of a mapping. Changes to the mapping show through."""
+
+  def __init__(self, data):
+    self._data = data
+
+  def __getitem__(self, key):
+    return self._data[key]
+
+  def __iter__(self):
+    return iter(self._data)
+
+  def __len__(self):
+    return len(self._data)
+
+  def __repr__(self):
+    return 'ReadOnlyMapping(%r)' % (self._data,)
+
+
 def scan_directory(path, predicate):
   """Recursively scans a directory and yields paths that match predicate."""
   for root, _dirs, files in os.walk(path):
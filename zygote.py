@@ -0,0 +1,501 @@
+# Copyright 2015 The Chromium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be
+# found in the LICENSE file.
+
+"""A fork server (zygote) for recipes.py commands.
+
+Every `recipes.py run` or `simulation_test` starts a new interpreter, imports
+the engine, reads the package's dependencies and loads the recipe's modules
+before doing anything; for a short recipe, that is most of its run time. A
+zygote is a long lived process which has done all of that once, with every
+recipe module loaded, and listens on a unix socket. `recipes.py --zygote
+<socket> ...` sends its command line there, and the zygote fork()s a child
+which runs the command as if it had been started afresh: in the client's
+working directory and environment, with its stdout and stderr relayed to the
+client through named pipes. The child's exit status is the client's.
+
+For each command the client makes a connection and sends one JSON request
+line,
+    {"argv": [...], "cwd": ..., "env": {...}, "package": path,
+     "stdout": fifo path, "stderr": fifo path}
+The child answers {"pid": n} once it has opened the pipes, and the zygote
+{"returncode": n} once the child has exited; or else the zygote answers
+{"error": message} without forking. A zygote serves one package, and exits
+(answering "stale") as soon as any of the files it loaded changes, so that
+the client starts a fresh one. It also exits once it has been idle for a
+while.
+
+Children run in their own process group, so that a client which is
+interrupted can signal the whole command. The child's stdin is /dev/null.
+POSIX only.
+
+Clients only need the standard library and this file.
+"""
+
+import errno
+import json
+import os
+import random
+import select
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+try:
+  import fcntl
+except ImportError:  # pragma: no cover
+  fcntl = None
+
+
+# Seconds a zygote waits for a client's request line.
+REQUEST_TIMEOUT = 10
+
+# The error a zygote answers once any of its files has changed.
+STALE = 'stale'
+
+
+class ZygoteError(Exception):
+  """Raised when a zygote refuses a command."""
+
+
+def is_supported():
+  return (hasattr(socket, 'AF_UNIX') and hasattr(os, 'fork') and
+          hasattr(os, 'mkfifo') and fcntl is not None)
+
+
+def _retry_on_eintr(fn, *args):
+  while True:
+    try:
+      return fn(*args)
+    except (OSError, IOError, select.error, socket.error) as e:
+      if e.args[0] != errno.EINTR:
+        raise
+
+
+def _set_cloexec(fd):
+  flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+  fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+
+
+def loaded_files():
+  """Returns the source files of every module imported so far."""
+  files = set()
+  for module in sys.modules.values():
+    path = getattr(module, '__file__', None)
+    if path:
+      if path.endswith(('.pyc', '.pyo')):
+        path = path[:-1]
+      files.add(os.path.abspath(path))
+  return sorted(files)
+
+
+def _mtimes(files):
+  mtimes = []
+  for path in files:
+    try:
+      mtimes.append(os.stat(path).st_mtime)
+    except OSError:
+      mtimes.append(None)
+  return mtimes
+
+
+class ZygoteClient(object):
+  """Runs commands in the zygote listening on |socket_path|.
+
+  If |launcher| is given, it is called to start a new zygote when there is
+  none listening, or the one listening is stale.
+  """
+
+  def __init__(self, socket_path, package, launcher=None):
+    self.socket_path = socket_path
+    self.package = package
+    self._launcher = launcher
+
+  def _try_connect(self):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      _retry_on_eintr(conn.connect, self.socket_path)
+    except:
+      conn.close()
+      raise
+    return conn
+
+  def ping(self):
+    """Returns True if a zygote is listening."""
+    try:
+      conn = self._try_connect()
+    except socket.error:
+      return False
+    conn.close()
+    return True
+
+  def run(self, argv, stdout=None, stderr=None):
+    """Runs the recipes.py command line |argv| in the zygote, in this
+    process's working directory and environment, copying its output to
+    |stdout| and |stderr| (default: sys.stdout and sys.stderr). Returns its
+    exit code, as sys.exit() takes it.
+
+    Raises ZygoteError if the zygote refused the command.
+    """
+    try:
+      return self._run(argv, stdout or sys.stdout, stderr or sys.stderr)
+    except ZygoteError as e:
+      if self._launcher is None or e.args[0] != STALE:
+        raise
+    self._launcher()
+    return self._run(argv, stdout or sys.stdout, stderr or sys.stderr)
+
+  def _connect(self):
+    try:
+      return self._try_connect()
+    except socket.error as e:
+      if (self._launcher is None or
+          e.errno not in (errno.ENOENT, errno.ECONNREFUSED)):
+        raise
+    self._launcher()
+    return self._try_connect()
+
+  def _run(self, argv, stdout, stderr):
+    tmp = tempfile.mkdtemp(prefix='recipes_zygote.')
+    pipes = {}
+    control = None
+    try:
+      for name in ('stdout', 'stderr'):
+        os.mkfifo(os.path.join(tmp, name), 0600)
+        # Opened before the child opens them for writing, which would block
+        # until then.
+        pipes[name] = os.open(os.path.join(tmp, name),
+                              os.O_RDONLY | os.O_NONBLOCK)
+      control = _LineReader(self._connect())
+      control.conn.sendall(json.dumps({
+        'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ),
+        'package': self.package,
+        'stdout': os.path.join(tmp, 'stdout'),
+        'stderr': os.path.join(tmp, 'stderr'),
+      }) + '\n')
+      reply = control.read_reply()
+      if 'error' in reply:
+        raise ZygoteError(reply['error'])
+      if 'pid' in reply:
+        reply = self._relay(reply['pid'], control, {
+          pipes['stdout']: stdout, pipes['stderr']: stderr})
+      if reply['returncode'] < 0:
+        return 128 - reply['returncode']
+      return reply['returncode']
+    finally:
+      if control is not None:
+        control.conn.close()
+      for fd in pipes.itervalues():
+        os.close(fd)
+      shutil.rmtree(tmp, ignore_errors=True)
+
+  def _relay(self, pid, control, outputs):
+    """Copies the child's output to |outputs| (by pipe) until the zygote
+    reports its exit, and returns that reply."""
+    def forward(signum, _frame):
+      try:
+        os.killpg(pid, signum)
+      except OSError:
+        pass
+    old_term = signal.signal(signal.SIGTERM, forward)
+    try:
+      open_pipes = set(outputs)
+      while not control.has_line():
+        try:
+          ready, _, _ = _retry_on_eintr(
+              select.select, list(open_pipes) + [control.conn], [], [])
+        except KeyboardInterrupt:
+          forward(signal.SIGINT, None)
+          continue
+        for fd in ready:
+          if fd is control.conn:
+            control.fill()
+          elif _copy(fd, outputs[fd]) == '':
+            open_pipes.discard(fd)
+      # Whatever the child wrote is in the pipes by now. Output its detached
+      # descendants write later is dropped, as it would be once a process
+      # started directly has exited.
+      for fd in open_pipes:
+        while _copy(fd, outputs[fd]):
+          pass
+      return control.read_reply()
+    finally:
+      signal.signal(signal.SIGTERM, old_term)
+
+
+class _LineReader(object):
+  """Reads the zygote's reply lines from the socket |conn|."""
+
+  def __init__(self, conn):
+    self.conn = conn
+    self._buf = ''
+    self._eof = False
+
+  def has_line(self):
+    return self._eof or '\n' in self._buf
+
+  def fill(self):
+    data = _retry_on_eintr(self.conn.recv, 4096)
+    self._buf += data
+    self._eof = not data
+
+  def read_reply(self):
+    while not self.has_line():
+      self.fill()
+    if '\n' not in self._buf:
+      raise ZygoteError('zygote went away')
+    line, self._buf = self._buf.split('\n', 1)
+    return json.loads(line)
+
+
+def _copy(fd, output):
+  """Copies what can be read from the non-blocking |fd| to |output|. Returns
+  what was read: '' at the end of the pipe, or None if nothing was ready."""
+  try:
+    data = _retry_on_eintr(os.read, fd, 65536)
+  except OSError as e:
+    if e.errno != errno.EAGAIN:
+      raise
+    return None
+  if data:
+    output.write(data)
+    output.flush()
+  return data
+
+
+def ensure_zygote(socket_path, package, launch_cmd, startup_timeout=120):
+  """Returns a ZygoteClient for |socket_path|, which starts a detached zygote
+  there, by running |launch_cmd|, whenever none is listening."""
+  def launch():
+    _launch_zygote(socket_path, package, launch_cmd, startup_timeout)
+  client = ZygoteClient(socket_path, package, launcher=launch)
+  if not client.ping():
+    launch()
+  return client
+
+
+def _launch_zygote(socket_path, package, launch_cmd, startup_timeout):
+  # Runs which find no zygote at the same time take turns, so that none of
+  # them removes the socket of one another has just started.
+  with open(socket_path + '.lock', 'a') as lock:
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    client = ZygoteClient(socket_path, package)
+    if client.ping():
+      return
+    if os.path.exists(socket_path):
+      os.unlink(socket_path)  # Left behind by a zygote which died.
+    with open(os.devnull, 'r+') as devnull:
+      subprocess.Popen(launch_cmd, stdin=devnull, stdout=devnull,
+                       stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+    deadline = time.time() + startup_timeout
+    while not client.ping():
+      if time.time() > deadline:
+        raise OSError(errno.ETIMEDOUT,
+                      'zygote did not start on %s' % socket_path)
+      time.sleep(0.05)
+
+
+class _Zygote(object):
+  def __init__(self, socket_path, package, handler, files, idle_timeout):
+    self._socket_path = socket_path
+    self._package = package
+    self._handler = handler
+    self._files = files
+    self._mtimes = _mtimes(files)
+    self._idle_timeout = idle_timeout
+    self._children = {}
+    self._last_active = time.time()
+    self._listener = None
+    self._wake_r = self._wake_w = None
+
+  def _on_sigchld(self, _signum, _frame):
+    try:
+      os.write(self._wake_w, 'x')
+    except OSError:
+      pass
+
+  def _reap(self):
+    while self._children:
+      try:
+        pid, status = _retry_on_eintr(os.waitpid, -1, os.WNOHANG)
+      except OSError as e:
+        if e.errno != errno.ECHILD:
+          raise
+        return
+      if not pid:
+        return
+      self._report(pid, status)
+
+  def _report(self, pid, status):
+    """Sends the exit status of the child |pid| to its client."""
+    control = self._children.pop(pid, None)
+    if control is None:
+      return
+    if os.WIFSIGNALED(status):
+      returncode = -os.WTERMSIG(status)
+    else:
+      returncode = os.WEXITSTATUS(status)
+    try:
+      control.sendall(json.dumps({'returncode': returncode}) + '\n')
+    except socket.error:
+      pass
+    control.close()
+    self._last_active = time.time()
+
+  def _accept(self):
+    """Serves one connection. Returns False if the zygote is stale."""
+    conn, _ = _retry_on_eintr(self._listener.accept)
+    try:
+      conn.settimeout(REQUEST_TIMEOUT)
+      line = _retry_on_eintr(conn.makefile('rb').readline)
+      conn.settimeout(None)
+    except socket.error:
+      conn.close()
+      return True
+    if not line:  # A ping.
+      conn.close()
+      return True
+
+    error = None
+    try:
+      request = json.loads(line)
+    except ValueError:
+      conn.close()
+      return True
+    if _mtimes(self._files) != self._mtimes:
+      error = STALE
+    elif request['package'] != self._package:
+      error = 'this zygote serves %s, not %s' % (
+          self._package, request['package'])
+    if error:
+      try:
+        conn.sendall(json.dumps({'error': error}) + '\n')
+      except socket.error:
+        pass
+      conn.close()
+      return error != STALE
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    pid = os.fork()
+    if pid == 0:
+      self._run_child(conn, request)
+    self._children[pid] = conn
+    self._last_active = time.time()
+    return True
+
+  def _run_child(self, control, request):
+    """Runs |request| in the forked child. Never returns."""
+    code = 1
+    try:
+      try:
+        os.setpgrp()
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        self._listener.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        for conn in self._children.itervalues():
+          conn.close()
+
+        for fd, path, mode in ((0, os.devnull, os.O_RDONLY),
+                               (1, request['stdout'], os.O_WRONLY),
+                               (2, request['stderr'], os.O_WRONLY)):
+          handle = os.open(path, mode)
+          os.dup2(handle, fd)
+          os.close(handle)
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        random.seed()
+
+        control.sendall(json.dumps({'pid': os.getpid()}) + '\n')
+        control.close()
+        code = self._handler(request['argv'])
+      except SystemExit as e:
+        code = e.code
+      except BaseException:
+        traceback.print_exc()
+        code = 1
+      if code is None:
+        code = 0
+      elif not isinstance(code, int):
+        sys.stderr.write('%s\n' % code)
+        code = 1
+      sys.stdout.flush()
+      sys.stderr.flush()
+    finally:
+      os._exit(code)
+
+  def serve(self):
+    self._wake_r, self._wake_w = os.pipe()
+    for fd in (self._wake_r, self._wake_w):
+      _set_cloexec(fd)
+      fcntl.fcntl(fd, fcntl.F_SETFL,
+                  fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    old_chld = signal.signal(signal.SIGCHLD, self._on_sigchld)
+
+    self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    _set_cloexec(self._listener.fileno())
+    # Anyone who can connect can run recipes as us.
+    old_umask = os.umask(0177)
+    try:
+      self._listener.bind(self._socket_path)
+    finally:
+      os.umask(old_umask)
+    inode = os.stat(self._socket_path).st_ino
+    self._listener.listen(64)
+    try:
+      while True:
+        timeout = None
+        if self._idle_timeout:
+          timeout = self._last_active + self._idle_timeout - time.time()
+          if timeout <= 0 and not self._children:
+            break
+          timeout = max(timeout, 1)
+        ready, _, _ = _retry_on_eintr(
+            select.select, [self._listener, self._wake_r], [], [], timeout)
+        if self._wake_r in ready:
+          try:
+            os.read(self._wake_r, 4096)
+          except OSError:
+            pass
+        self._reap()
+        if self._listener in ready and not self._accept():
+          break
+    finally:
+      self._listener.close()
+      # Unless it was already replaced, by a zygote started after this one
+      # stopped answering. Either way, the children's exit codes still need
+      # reporting below.
+      try:
+        if os.stat(self._socket_path).st_ino == inode:
+          os.unlink(self._socket_path)
+      except OSError as e:
+        if e.errno != errno.ENOENT:
+          raise
+      signal.signal(signal.SIGCHLD, old_chld)
+      # Children still running report to their clients through this
+      # process, so it waits for them.
+      while self._children:
+        pid, status = _retry_on_eintr(os.waitpid, -1, 0)
+        self._report(pid, status)
+
+
+def serve(socket_path, package, handler, files=None, idle_timeout=None):
+  """Serves commands for |package| on |socket_path|, until none has run for
+  |idle_timeout| seconds (forever if None), or any of |files| (default:
+  loaded_files()) changes.
+
+  |handler| is called in a forked child with the command's argv, and returns
+  its exit code.
+  """
+  if files is None:
+    files = loaded_files()
+  _Zygote(socket_path, package, handler, files, idle_timeout).serve()